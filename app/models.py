@@ -21,20 +21,329 @@ You should have received a copy of the GNU General Public License
 along with rq.  If not, see <http://www.gnu.org/licenses/>.
 """
 from peewee import *
+from peewee import mysql, Entity
 from app import RPM_URI, SRPM_URI
 from playhouse.db_url import connect
 from collections import namedtuple
+import hashlib
+import re
+import sre_parse
+import sre_constants
 
 rpm_db  = connect(RPM_URI)
 srpm_db = connect(SRPM_URI)
 
+# names that have to be told apart by case (see BinaryCharField) are stored as bytes on MySQL
+for db in (rpm_db, srpm_db):
+    db.field_overrides['binary_string'] = 'VARBINARY' if isinstance(db, MySQLDatabase) else 'VARCHAR'
+
+# the version of the tables below; databases created with an older version are missing columns
+# (or have them empty, or sort keys encoded differently) and have to be recreated and their tags
+# imported again
+SCHEMA_VERSION = 4
+
 def create_tables():
     rpm_db.connect()
-    rpm_db.create_tables([RPM_File, RPM_User, RPM_Group, RPM_Package, RPM_Provides, RPM_Requires,
-               RPM_Symbols, RPM_Flags, RPM_Tag, RPM_AlreadySeen], True) # only create if it doesn't already exist
+    rpm_db.create_tables([RPM_File, RPM_User, RPM_Group, RPM_Package, RPM_ProvideName, RPM_Provides,
+               RPM_RequireName, RPM_Requires, RPM_SymbolName, RPM_Symbols, RPM_Flags, RPM_Tag,
+               RPM_AlreadySeen, RPM_Analysis, RPM_FileTrigram, RPM_Dirname, RPM_TagCounts, RPM_Schema], True) # only create if it doesn't already exist
     srpm_db.connect()
     srpm_db.create_tables([SRPM_File, SRPM_Package, SRPM_Source, SRPM_BuildRequires, SRPM_Tag, SRPM_Ctag,
-               SRPM_AlreadySeen], True)
+               SRPM_AlreadySeen, SRPM_FileTrigram, SRPM_Dirname, SRPM_TagCounts, SRPM_Schema], True)
+
+    for (schema, package) in ((RPM_Schema, RPM_Package), (SRPM_Schema, SRPM_Package)):
+        if not schema.select().exists():
+            # packages that are already there were imported by an older version
+            if package.select().exists():
+                schema.create(version=0)
+            else:
+                schema.create(version=SCHEMA_VERSION)
+
+
+def schema_version(schema):
+    """
+    Function to return the schema version recorded in the database of the schema model; 0 if the
+    database predates the version being recorded
+    """
+    if not schema.table_exists():
+        return 0
+    try:
+        return schema.get().version
+    except schema.DoesNotExist:
+        return 0
+
+
+class BinaryCharField(CharField):
+    """
+    A CharField that is compared byte for byte rather than by the collation of its table; MySQL's
+    default collations would find 'root' when asked for 'Root', and let a unique index on the
+    column refuse one of them
+    """
+    db_field = 'binary_string'
+
+
+class BulkInsert:
+    """
+    Class to accumulate rows for a model and write them out with multi-row inserts of up
+    to chunk rows at a time.  Callers should wrap this in a transaction and call flush()
+    when they are done adding rows
+    """
+
+    def __init__(self, model, chunk=500):
+        self.model = model
+        self.chunk = chunk
+        self.rows  = []
+        self.count = 0
+
+    def add(self, **row):
+        """
+        Queue a row for insertion, writing out the queued rows if we have a full chunk
+        :param row: field values for the row
+        :return: nothing
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        """
+        Write out any queued rows
+        :return: int (number of rows written so far)
+        """
+        if self.rows:
+            self.model.insert_many(self.rows).execute()
+            self.count += len(self.rows)
+            self.rows   = []
+        return self.count
+
+
+def file_trigrams(name):
+    """
+    Returns the set of lowercased trigrams in a file name, packed into integers, for the file
+    name indexes.  Trigrams with non-ASCII bytes are left out as the database may not fold
+    their case the way we do, so they can't be used to rule out a match
+    :param name: the file name, or part of one
+    :return: set
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    name  = name.lower()
+    grams = set()
+    for x in xrange(len(name) - 2):
+        (a, b, c) = (ord(name[x]), ord(name[x + 1]), ord(name[x + 2]))
+        if a < 128 and b < 128 and c < 128:
+            grams.add(a << 16 | b << 8 | c)
+    return grams
+
+
+def trigram_candidates(model, name, tid=None, pick=3, probe=1000):
+    """
+    Returns a query for the ids of the files whose names contain the most selective trigrams of
+    name, or None if name has no trigrams to look up and the index can't help.  Trigrams such as
+    'usr' or 'lib' are in most file names and would only make the intersection bigger, so the
+    entries of each trigram are counted (up to probe of them) and only the pick rarest are used.
+    The candidates may still not contain name, so the caller has to compare the names as well
+    :param model: RPM_FileTrigram or SRPM_FileTrigram
+    :param name: the substring being searched for, or a list of substrings that must all be present
+    :param tid: tag id to limit the search to, if any
+    :param pick: number of trigrams to intersect
+    :param probe: number of entries of a trigram to count at most when judging how rare it is
+    :return: query or None
+    """
+    if isinstance(name, (list, tuple)):
+        grams = set()
+        for n in name:
+            grams |= file_trigrams(n)
+    else:
+        grams = file_trigrams(name)
+    if not grams:
+        return None
+
+    if len(grams) > pick:
+        counts = []
+        for gram in grams:
+            query = model.select(model.id).where(model.gram == gram)
+            if tid:
+                query = query.where(model.tid == tid)
+            counts.append((query.limit(probe).count(), gram))
+        grams = set(gram for (count, gram) in sorted(counts)[:pick])
+
+    query = model.select(model.fid).where(model.gram << list(grams))
+    if tid:
+        query = query.where(model.tid == tid)
+    # each trigram is only stored once per file
+    return query.group_by(model.fid).having(fn.COUNT(model.gram) == len(grams))
+
+
+def shared_transaction(db):
+    """
+    Function to return the transaction to add rows in that other processes may be adding at the same
+    time, such as the name dictionaries.  On MySQL this is a transaction on a connection of its own
+    that is committed as soon as the rows are in, so other --jobs workers see them straight away,
+    and their unique index locks are not held until the caller's (per-package) transaction ends.
+    Rows added this way stay even if the caller's transaction is rolled back.  SQLite only allows
+    one writer at a time, so there it is a savepoint in the caller's transaction
+    :param db: the database
+    :return: context manager
+    """
+    if isinstance(db, MySQLDatabase):
+        return db.execution_context()
+    return db.atomic()
+
+
+def shared_ids(field, rows, chunk=500):
+    """
+    Function to return the ids of rows looked up by the unique field, adding the rows that are not
+    in the database yet in a shared_transaction().  Rows are inserted in the same order by every
+    process so that two of them adding the same rows wait on each other instead of deadlocking
+    :param field: the unique field, whose values are byte strings
+    :param rows: dict of the columns of each row, keyed by its value of field
+    :param chunk: number of rows to look up or insert per query
+    :return: dict of ids keyed by the value of field
+    """
+    model = field.model_class
+    db    = model._meta.database
+    ids   = {}
+
+    def lookup(want):
+        for x in xrange(0, len(want), chunk):
+            for (rid, key) in model.select(model.id, field).where(field << want[x:x + chunk]).tuples():
+                if isinstance(key, unicode):
+                    key = key.encode('utf-8')
+                ids[key] = rid
+
+    lookup(rows.keys())
+    missing = sorted(k for k in rows if k not in ids)
+    if missing:
+        # on MySQL the lookup after the inserts is the first read in the new transaction, so it
+        # sees the rows other processes committed while we were inserting as well
+        with shared_transaction(db):
+            try:
+                with db.atomic():
+                    for x in xrange(0, len(missing), chunk):
+                        model.insert_many([rows[k] for k in missing[x:x + chunk]]).execute()
+            except IntegrityError:
+                # another process added some of these since we looked, so go one at a time
+                for k in missing:
+                    try:
+                        with db.atomic():
+                            model.insert(**rows[k]).execute()
+                    except IntegrityError:
+                        pass
+            lookup(missing)
+
+    return ids
+
+
+def name_ids(model, names, chunk=500):
+    """
+    Function to return the ids of the provided names from one of the name dictionary tables (see
+    RPMNameModel), adding any that are not in the database yet
+    :return: dict of ids keyed by name
+    """
+    digests = dict((hashlib.sha1(n).hexdigest(), n) for n in set(names))
+    ids     = shared_ids(model.digest, dict((d, model.new_row(n, d)) for (d, n) in digests.items()), chunk)
+    return dict((digests[d], nid) for (d, nid) in ids.items())
+
+
+def regexp_literals(pattern):
+    """
+    Function to find the literal strings that anything matching the regular expression pattern has
+    to contain, so a substring search can narrow things down before the (much slower) expression is
+    evaluated.  Python's parser is used, so anything it may read differently than the database does
+    (POSIX classes, escaped letters, inline flags such as (?i)) is given up on and no literals are
+    returned
+    :param pattern: the regular expression
+    :return: tuple of the literal the match has to start with, if any, and the list of literals
+    """
+    if re.search(r'\[\[[:.=]|\\[a-zA-Z0-9]|\(\?', pattern):
+        return ('', [])
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError, ValueError, AssertionError):
+        return ('', [])
+
+    def runs(items, literals):
+        run = []
+        for (op, av) in items:
+            if op == sre_constants.LITERAL:
+                run.append(chr(av))
+                continue
+            if run:
+                literals.append(''.join(run))
+                run = []
+            # a group, or something repeated at least once, has to be there as well
+            if op == sre_constants.SUBPATTERN:
+                runs(av[1], literals)
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+                runs(av[2], literals)
+        if run:
+            literals.append(''.join(run))
+        return literals
+
+    items    = list(parsed)
+    literals = runs(items, [])
+    prefix   = ''
+    if items and items[0] == (sre_constants.AT, sre_constants.AT_BEGINNING):
+        for (op, av) in items[1:]:
+            if op != sre_constants.LITERAL:
+                break
+            prefix += chr(av)
+    # single characters don't narrow anything down
+    return (prefix, [l for l in literals if len(l) > 1])
+
+
+def regexp_match(field, pattern):
+    """
+    Function to return the expression matching field against the regular expression pattern; the
+    literals the pattern requires are compared with LIKE first so the database only has to evaluate
+    the expression itself for the rows that contain them
+    :param field: the field to match
+    :param pattern: the regular expression
+    :return: expression
+    """
+    expr = None
+    for literal in regexp_literals(pattern)[1]:
+        expr = field.contains(literal) if expr is None else (expr & field.contains(literal))
+    if expr is None:
+        return field.regexp(pattern)
+    return expr & field.regexp(pattern)
+
+
+def tag_counts(query):
+    """
+    Function to count the matches of a select query per tag in the database, without fetching
+    any of the matching rows
+    :return: list of (tid, matches, packages) tuples
+    """
+    model = query.model_class
+    pid   = model._meta.fields.get('pid', model._meta.primary_key)
+    query = query.select(model.tid, fn.COUNT(model._meta.primary_key), fn.COUNT(fn.DISTINCT(pid)))
+    return list(query.order_by().group_by(model.tid).tuples())
+
+
+def stream(query):
+    """
+    Function to iterate over the rows of a select query without holding the whole result set in
+    memory; on MySQL the rows are read from an unbuffered (server-side) cursor as they arrive, so
+    no other query can be run on the same connection until the iteration is done
+    """
+    db = query.database
+    if not isinstance(db, MySQLDatabase):
+        for row in query.iterator():
+            yield row
+        return
+
+    sql, params = query.sql()
+    cursor      = db.get_conn().cursor(mysql.cursors.SSCursor)
+    try:
+        cursor.execute(sql, params or ())
+        wrapper = query._get_result_wrapper()(query.model_class, cursor, query.get_query_meta())
+        for row in wrapper.iterator():
+            yield row
+    finally:
+        cursor.close()
+
 
 # tid is always tag id
 # pid is always package id
@@ -64,9 +373,57 @@ class SRPMModel(Model):
         return
 
 
+# names shared by many source rpm rows, see RPMNameModel
+class SRPMNameModel(SRPMModel):
+    name   = TextField(null=False)
+    digest = CharField(max_length=40, unique=True)
+
+    @classmethod
+    def get_ids(cls, names, chunk=500):
+        """
+        Returns the ids for the provided names, adding any that are not in the database yet
+        :param names: list of names
+        :param chunk: number of names to look up or insert per query
+        :return: dict
+        """
+        return name_ids(cls, names, chunk)
+
+    @classmethod
+    def new_row(cls, name, digest):
+        """
+        Returns the columns of a new row for the provided name
+        :param name: the name to add
+        :param digest: the sha1 of the name
+        :return: dict
+        """
+        return {'name': name, 'digest': digest}
+
+    @classmethod
+    def find(cls, name):
+        """
+        Returns a query for the id of the provided name
+        :param name: the name to lookup
+        :return: query
+        """
+        return cls.select(cls.id).where(cls.digest == hashlib.sha1(name).hexdigest())
+
+    def __repr__(self):
+        return '<{name} {self.name}>'.format(name=self.__class__.__name__, self=self)
+
+
 # the binary rpm user model
 class RPM_User(RPMModel):
-    user = CharField(null=False)  # f_user
+    user = BinaryCharField(null=False, unique=True)  # f_user
+
+    @classmethod
+    def get_ids(cls, names, chunk=500):
+        """
+        Returns the ids for the provided user names, adding any that are not in the database yet
+        :param names: list of user names
+        :param chunk: number of names to look up or insert per query
+        :return: dict
+        """
+        return shared_ids(RPM_User.user, dict((n, {'user': n}) for n in set(names)), chunk)
 
     @classmethod
     def get_id(cls, name):
@@ -100,7 +457,17 @@ class RPM_User(RPMModel):
 
 # the binary rpm group model
 class RPM_Group(RPMModel):
-    group = CharField(null=False)  # f_group
+    group = BinaryCharField(null=False, unique=True)  # f_group
+
+    @classmethod
+    def get_ids(cls, names, chunk=500):
+        """
+        Returns the ids for the provided group names, adding any that are not in the database yet
+        :param names: list of group names
+        :param chunk: number of names to look up or insert per query
+        :return: dict
+        """
+        return shared_ids(RPM_Group.group, dict((n, {'group': n}) for n in set(names)), chunk)
 
     @classmethod
     def get_id(cls, name):
@@ -153,6 +520,14 @@ class RPM_Tag(RPMModel):  # tags
         except:
             return None
 
+    @classmethod
+    def get_names(cls):
+        """
+        Returns the names of all tags
+        :return: dict of tag names keyed by tag id
+        """
+        return dict(RPM_Tag.select(RPM_Tag.id, RPM_Tag.tag).tuples())
+
     @classmethod
     def get_id(cls, name):
         """
@@ -174,6 +549,21 @@ class RPM_Tag(RPMModel):  # tags
         """
         return RPM_Tag.select().order_by(RPM_Tag.tag)
 
+    @classmethod
+    def get_versions(cls, tag=None):
+        """
+        Returns the state of tags for the query cache: the dates each tag was added and last updated
+        and its newest package, which change whenever packages are added, updated or removed
+        :param tag: the tag name to limit this to, if any
+        :return: list
+        """
+        query = (RPM_Tag.select(RPM_Tag.id, RPM_Tag.tdate, RPM_Tag.update_date, fn.MAX(RPM_Package.id)).join(
+                    RPM_Package, JOIN_LEFT_OUTER, on=(RPM_Package.tid == RPM_Tag.id)).group_by(
+                    RPM_Tag.id, RPM_Tag.tdate, RPM_Tag.update_date).order_by(RPM_Tag.id))
+        if tag:
+            query = query.where(RPM_Tag.tag == tag)
+        return list(query.tuples())
+
     @classmethod
     def info(cls, tag):
         """
@@ -204,18 +594,20 @@ class RPM_Tag(RPMModel):  # tags
     @property
     def package_count(self):
         """
-        Return the number of packages
+        Return the number of packages, from the counters kept for the tag
         :return: int
         """
-        return RPM_Package.select().where(RPM_Package.tid == self.id).count()
+        counts = RPM_TagCounts.select(RPM_TagCounts.packages).where(RPM_TagCounts.tid == self.id).first()
+        return counts.packages if counts else 0
 
     @property
     def update_count(self):
         """
-        Return the number of updates packages
+        Return the number of updates packages, from the counters kept for the tag
         :return: int
         """
-        return RPM_Package.select().where((RPM_Package.tid == self.id) & (RPM_Package.update == 1)).count()
+        counts = RPM_TagCounts.select(RPM_TagCounts.updates).where(RPM_TagCounts.tid == self.id).first()
+        return counts.updates if counts else 0
 
 
     def __repr__(self):
@@ -233,6 +625,8 @@ class RPM_Package(RPMModel):
     srpm     = TextField(null=False)  # p_srpm
     fullname = TextField(null=False)  # p_fullname
     update   = IntegerField(default=0)  # p_update
+    sortkey  = CharField(default='', index=True)  # epoch-version-release, see rq.basics.evr_sortkey()
+    size     = BigIntegerField(default=0)  # size of the package file in bytes
 
     @property
     def tag(self):
@@ -268,6 +662,22 @@ class RPM_Package(RPMModel):
             return True
         return False
 
+    @classmethod
+    def latest(cls, match):
+        """
+        Returns the newest version of each package (per tag and arch) that matches; the newest
+        versions are picked out by the database rather than by sorting through every version
+        :param match: expression the packages have to match
+        :return: SelectQuery
+        """
+        newest = RPM_Package.select(RPM_Package.tid, RPM_Package.package, RPM_Package.arch,
+                                    fn.MAX(RPM_Package.sortkey).alias('sortkey')).where(match).group_by(
+            RPM_Package.tid, RPM_Package.package, RPM_Package.arch).alias('newest')
+        return RPM_Package.select().join(newest, on=((RPM_Package.tid == Entity('newest', 'tid_id')) &
+                                                     (RPM_Package.package == Entity('newest', 'package')) &
+                                                     (RPM_Package.arch == Entity('newest', 'arch')) &
+                                                     (RPM_Package.sortkey == Entity('newest', 'sortkey')))).where(match)
+
     @classmethod
     def exists(cls, tid, name):
         """
@@ -296,62 +706,155 @@ class RPM_Package(RPMModel):
         return '<RPM Package {self.package}>'.format(self=self)
 
 
-# the binary rpm provides model
-class RPM_Provides(RPMModel):  # provides
-    pid  = ForeignKeyField(RPM_Package, related_name='provides')  # p_record
-    tid  = ForeignKeyField(RPM_Tag, related_name='provides')  # t_record
-    name = TextField(null=False)  # pv_name
+# names that are shared by many rows (symbols, requires, provides, directories) are stored once and
+# referenced by id.  Names can be too long to index, so the unique index is on the sha1 of
+# the name
+class RPMNameModel(RPMModel):
+    name   = TextField(null=False)
+    digest = CharField(max_length=40, unique=True)
 
     @classmethod
-    def get_id(cls, name):
+    def get_ids(cls, names, chunk=500):
+        """
+        Returns the ids for the provided names, adding any that are not in the database yet
+        :param names: list of names
+        :param chunk: number of names to look up or insert per query
+        :return: dict
         """
-        Returns the provides id for the provided provides name
+        return name_ids(cls, names, chunk)
+
+    @classmethod
+    def new_row(cls, name, digest):
+        """
+        Returns the columns of a new row for the provided name
+        :param name: the name to add
+        :param digest: the sha1 of the name
+        :return: dict
+        """
+        return {'name': name, 'digest': digest}
+
+    @classmethod
+    def find(cls, name):
+        """
+        Returns a query for the id of the provided name
         :param name: the name to lookup
-        :return: int
+        :return: query
         """
-        try:
-            pid = RPM_Provides.get(RPM_Provides.name == name)
-            return pid.id
-        except:
-            return None
+        return cls.select(cls.id).where(cls.digest == hashlib.sha1(name).hexdigest())
 
     def __repr__(self):
-        return '<RPM Provides {self.name}>'.format(self=self)
+        return '<{name} {self.name}>'.format(name=self.__class__.__name__, self=self)
 
 
-# the binary rpm requires model
-class RPM_Requires(RPMModel):  # requires
-    pid  = ForeignKeyField(RPM_Package, related_name='requires')  # p_record
-    tid  = ForeignKeyField(RPM_Tag, related_name='requires')  # t_record
-    name = TextField(null=False)  # rq_name
+# the binary rpm symbol names; the start of each name is kept in an indexed column as well so that
+# prefix searches are index range scans
+class RPM_SymbolName(RPMNameModel):
+    prefix = BinaryCharField(max_length=128, default='', index=True)
 
     @classmethod
-    def get_id(cls, name):
+    def new_row(cls, name, digest):
         """
-        Returns the requires id for the provided requires name
-        :param name: the name to lookup
-        :return: int
+        Returns the columns of a new row for the provided name
+        :param name: the name to add
+        :param digest: the sha1 of the name
+        :return: dict
         """
-        try:
-            rid = RPM_Requires.get(RPM_Requires.name == name)
-            return rid.id
-        except:
-            return None
+        return {'name': name, 'digest': digest, 'prefix': name[:128]}
+
+    @classmethod
+    def find_prefix(cls, prefix):
+        """
+        Returns a query for the ids of the names that start with prefix; like find(), this is case
+        sensitive whatever the collation of the table
+        :param prefix: the start of the names to lookup
+        :return: query
+        """
+        start = prefix[:128]
+        if isinstance(start, str):
+            start = start.decode('utf-8', 'replace')
+        # nothing that starts with start sorts after it followed by the highest code point
+        query = cls.select(cls.id).where((cls.prefix >= start) & (cls.prefix < start + u'\U0010ffff'))
+        if len(prefix) > 128:
+            # the prefix column only holds the start of longer names
+            name = fn.SUBSTR(cls.name, 1, len(prefix))
+            if isinstance(cls._meta.database, MySQLDatabase):
+                name = Clause(SQL('BINARY'), name)
+            query = query.where(name == prefix)
+        return query
+
+    @classmethod
+    def find_regexp(cls, pattern):
+        """
+        Returns a query for the ids of the names that match the regular expression pattern.  The
+        database matches expressions case insensitively, so a start the pattern is anchored to is
+        looked for with LIKE (which folds case the same way) rather than find_prefix()
+        :param pattern: the regular expression
+        :return: query
+        """
+        query  = cls.select(cls.id).where(regexp_match(cls.name, pattern))
+        prefix = regexp_literals(pattern)[0]
+        if prefix:
+            query = query.where(cls.name.startswith(prefix))
+        return query
+
+
+# the directory names of binary rpm files
+class RPM_Dirname(RPMNameModel):
+    pass
+
+
+# the binary rpm provides names
+class RPM_ProvideName(RPMNameModel):  # provides_names
+    pass
+
+
+# the binary rpm requires names
+class RPM_RequireName(RPMNameModel):  # requires_names
+    pass
+
+
+# the binary rpm provides model
+class RPM_Provides(RPMModel):  # provides
+    pid  = ForeignKeyField(RPM_Package, related_name='provides')  # p_record
+    tid  = ForeignKeyField(RPM_Tag, related_name='provides')  # t_record
+    nid  = ForeignKeyField(RPM_ProvideName, related_name='provides')  # pv_record
 
     def __repr__(self):
-        return '<RPM Requires {self.name}>'.format(self=self)
+        return '<RPM Provides {self.nid}>'.format(self=self)
 
 
-# the binary rpm files model
+# the binary rpm requires model
+class RPM_Requires(RPMModel):  # requires
+    pid  = ForeignKeyField(RPM_Package, related_name='requires')  # p_record
+    tid  = ForeignKeyField(RPM_Tag, related_name='requires')  # t_record
+    nid  = ForeignKeyField(RPM_RequireName, related_name='requires')  # rq_record
+
+    def __repr__(self):
+        return '<RPM Requires {self.nid}>'.format(self=self)
+
+
+# the binary rpm files model.  file is the full path, which the substring and regexp searches and
+# the output use; basename and did split it up again for the exact -m basename and -m path lookups,
+# at the cost of storing the name twice.  Databases from before the split have neither filled in,
+# so they are refused (see SCHEMA_VERSION) rather than silently left out of those lookups
 class RPM_File(RPMModel):
-    pid     = ForeignKeyField(RPM_Package, related_name='file')  # p_record
-    tid     = ForeignKeyField(RPM_Tag, related_name='file')  # t_record
-    uid     = ForeignKeyField(RPM_User, related_name='file')  # u_record
-    gid     = ForeignKeyField(RPM_Group, related_name='file')  # g_record
-    file    = TextField()  # files
-    is_suid = IntegerField(default=0)  # f_is_suid
-    is_sgid = IntegerField(default=0)  # f_is_sgid
-    perms   = CharField()  # f_perms
+    pid      = ForeignKeyField(RPM_Package, related_name='file')  # p_record
+    tid      = ForeignKeyField(RPM_Tag, related_name='file')  # t_record
+    uid      = ForeignKeyField(RPM_User, related_name='file')  # u_record
+    gid      = ForeignKeyField(RPM_Group, related_name='file')  # g_record
+    file     = TextField()  # files
+    basename = CharField(default='')  # the file name without its directory
+    did      = ForeignKeyField(RPM_Dirname, null=True, related_name='file')  # the directory of the file
+    is_suid  = IntegerField(default=0)  # f_is_suid
+    is_sgid  = IntegerField(default=0)  # f_is_sgid
+    perms    = CharField()  # f_perms
+
+    class Meta:
+        indexes = (
+            (('basename', 'did'), False),
+            (('tid', 'is_suid'), False),
+            (('tid', 'is_sgid'), False),
+        )
 
     @classmethod
     def find_id(cls, file, tid, pid):
@@ -382,6 +885,15 @@ class RPM_File(RPMModel):
         except:
             return None
 
+    @classmethod
+    def get_ids(cls, pid):
+        """
+        Returns the ids of all files in a package, keyed by file name
+        :param pid: the package id to lookup
+        :return: dict
+        """
+        return dict((f, i) for (i, f) in RPM_File.select(RPM_File.id, RPM_File.file).where(RPM_File.pid == pid).tuples())
+
     @classmethod
     def get_sxid(cls, tid, db_col):
         """
@@ -395,42 +907,56 @@ class RPM_File(RPMModel):
         elif db_col == 'is_sgid':
             sxid_cond = ((RPM_File.is_sgid == 1))
 
-        # TODO would really love to get this to work, but it doesn't yet give me the values for user, group, etc just files
-        # TODO getting this to work would save some extra lame queries
-        query = (RPM_File.select().join(
-                    RPM_Package, on=(RPM_File.pid == RPM_Package.id)).join(
-                    RPM_User, JOIN_LEFT_OUTER, on=(RPM_File.uid == RPM_User.id)).join(
+        query = (RPM_File.select(RPM_Package.package, RPM_File.file, RPM_User.user, RPM_Group.group, RPM_File.perms).join(
+                    RPM_Package, on=(RPM_File.pid == RPM_Package.id)).switch(RPM_File).join(
+                    RPM_User, JOIN_LEFT_OUTER, on=(RPM_File.uid == RPM_User.id)).switch(RPM_File).join(
                     RPM_Group, JOIN_LEFT_OUTER, on=(RPM_File.gid == RPM_Group.id)).where(
                     sxid_cond & (RPM_File.tid == tid)).order_by(
                     RPM_Package.package.asc()))
 
-        #print query
-        out = []
         s = namedtuple('s', 'package file user group perms')
-        for q in query:
-            u = RPM_User.get(RPM_User.id == q.uid)
-            g = RPM_Group.get(RPM_Group.id == q.gid)
-            p = RPM_Package.get(RPM_Package.id == q.pid)
-            out.append(s(package=p.package, file=q.file, user=u.user, group=g.group, perms=q.perms))
-        return out
-
-        # query = "SELECT p_package, files, f_user, f_group, f_perms FROM files JOIN packages ON \
-        # (files.p_record = packages.p_record) LEFT JOIN user_names ON (files.u_record = user_names.u_record) \
-        # LEFT JOIN group_names ON (files.g_record = group_names.g_record) WHERE %s = 1 AND files.t_record = %s \
-        # ORDER BY p_package ASC" % (db_col, tid)
-        # results = self.db.fetch_all(query)
+        return [s._make(row) for row in query.tuples()]
 
 
     def __repr__(self):
         return '<RPM File {self.file}>'.format(self=self)
 
 
+# the binary rpm file name trigram index; lets substring searches on file names narrow things
+# down to a few files before the names themselves are compared.  Every distinct trigram of a file
+# name is a row, which comes to about one row per character of the name (a package of 100 files
+# of 50 characters adds some 5000 rows), so this is the biggest table in the database: with the
+# (gram, tid, fid) index, expect it to take several times the space of the file table
+class RPM_FileTrigram(RPMModel):
+    tid  = IntegerField()
+    pid  = IntegerField()
+    fid  = IntegerField()
+    gram = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('gram', 'tid', 'fid'), False),
+            (('pid',), False),
+            (('tid',), False),
+        )
+
+    @classmethod
+    def candidates(cls, name, tid=None):
+        """
+        Returns a query for the ids of the files whose names may contain name
+        :param name: the substring being searched for, or a list of them
+        :param tid: tag id to limit the search to, if any
+        :return: query or None if the index can't be used
+        """
+        return trigram_candidates(RPM_FileTrigram, name, tid)
+
+
 # the binary rpm symbols model
 class RPM_Symbols(RPMModel):  # symbols
     pid     = ForeignKeyField(RPM_Package, related_name='symbols') # p_record
     tid     = ForeignKeyField(RPM_Tag, related_name='symbols') # t_record
     fid     = ForeignKeyField(RPM_File, related_name='symbols') # f_id
-    symbols = TextField(null=False)
+    sid     = ForeignKeyField(RPM_SymbolName, related_name='symbols')
 
     @classmethod
     def delete_tags(cls, tid):
@@ -444,7 +970,7 @@ class RPM_Symbols(RPMModel):  # symbols
         return removed
 
     def __repr__(self):
-        return '<RPM Symbol {self.symbols}>'.format(self=self)
+        return '<RPM Symbol {self.sid}>'.format(self=self)
 
 
 # the binary rpm flags model
@@ -470,6 +996,15 @@ class RPM_Flags(RPMModel):  # flags
         except:
             return None
 
+        return RPM_Flags.describe(f)
+
+    @classmethod
+    def describe(cls, f):
+        """
+        Returns described flags for a flags record, or for a query row with the flag columns
+        :param f: object with relro, ssp, pie, fortify and nx attributes
+        :return: object
+        """
         # these are the default values
         newflags = namedtuple('newflags', 'relro ssp nx pie fortify')
         relro    = 'none'
@@ -511,6 +1046,94 @@ class RPM_Flags(RPMModel):  # flags
         return removed
 
 
+# ELF analysis results keyed by the file digest from the rpm header; these are shared
+# between tags so the same binary is only analyzed once
+class RPM_Analysis(RPMModel):
+    digest  = CharField(max_length=128, unique=True)
+    elf     = IntegerField(default=1)
+    relro   = IntegerField(default=0)
+    ssp     = IntegerField(default=0)
+    pie     = IntegerField(default=0)
+    fortify = IntegerField(default=0)
+    nx      = IntegerField(default=0)
+    symbols = TextField(default='')  # newline separated
+
+    @classmethod
+    def get_digests(cls, digests, chunk=500):
+        """
+        Returns the cached analysis for each of the provided digests that we have seen before
+        :param digests: list of file digests to look up
+        :param chunk: number of digests to look up per query
+        :return: dict
+        """
+        found   = {}
+        digests = list(set(digests))
+        for x in xrange(0, len(digests), chunk):
+            for a in RPM_Analysis.select().where(RPM_Analysis.digest << digests[x:x + chunk]):
+                found[a.digest] = a
+        return found
+
+    @classmethod
+    def new_digest(cls, flags=None, symbols=None, digest=''):
+        """
+        Returns an unsaved analysis of a file; files that are not ELF binaries have no flags
+        :param flags: dict of flags from Binary.get_binary_flags() or None if the file is not ELF
+        :param symbols: list of symbols from Binary.get_binary_symbols()
+        :param digest: the file digest
+        :return: object
+        """
+        if flags is None:
+            return RPM_Analysis(digest=digest, elf=0)
+
+        return RPM_Analysis(
+            digest  = digest,
+            elf     = 1,
+            relro   = flags['relro'],
+            ssp     = flags['ssp'],
+            pie     = flags['pie'],
+            fortify = flags['fortify_source'],
+            nx      = flags['nx'],
+            symbols = '\n'.join(symbols or [])
+        )
+
+    @classmethod
+    def add_digest(cls, digest, flags=None, symbols=None):
+        """
+        Stores the analysis of a file
+        :param digest: the file digest
+        :param flags: dict of flags from Binary.get_binary_flags() or None if the file is not ELF
+        :param symbols: list of symbols from Binary.get_binary_symbols()
+        :return: object
+        """
+        analysis = RPM_Analysis.new_digest(flags, symbols, digest)
+        # committed straight away so other workers can use it, see shared_transaction()
+        with shared_transaction(rpm_db):
+            try:
+                with rpm_db.atomic():
+                    analysis.save()
+                return analysis
+            except IntegrityError:
+                # another process analyzed the same file since we looked; this is the first read
+                # in the shared transaction, so it sees their row
+                return RPM_Analysis.get(RPM_Analysis.digest == digest)
+
+    def get_flags(self):
+        """
+        Returns the cached flags in the form used by Binary.get_binary_flags()
+        :return: dict
+        """
+        return {'relro': self.relro, 'ssp': self.ssp, 'pie': self.pie, 'fortify_source': self.fortify, 'nx': self.nx}
+
+    def get_symbols(self):
+        """
+        Returns the cached symbols as a list
+        :return: list
+        """
+        if not self.symbols:
+            return []
+        return self.symbols.split('\n')
+
+
 # the binary alreadyseen model
 class RPM_AlreadySeen(RPMModel):
     fullname = TextField(null=False)
@@ -530,6 +1153,43 @@ class RPM_AlreadySeen(RPMModel):
         return False
 
 
+# running totals of the records in each tag, kept up to date as packages are added and removed
+# (see Tag.count_added()) so they don't have to be counted every time they are shown
+class RPM_TagCounts(RPMModel):
+    tid      = ForeignKeyField(RPM_Tag, related_name='counts', unique=True)
+    packages = IntegerField(default=0)
+    updates  = IntegerField(default=0)
+    files    = IntegerField(default=0)
+    requires = IntegerField(default=0)
+    provides = IntegerField(default=0)
+    flags    = IntegerField(default=0)
+    symbols  = IntegerField(default=0)
+    bytes    = BigIntegerField(default=0)
+
+    @classmethod
+    def add(cls, tid, counts):
+        """
+        Adds to the counters of a tag; negative numbers subtract
+        :param tid: the tag id
+        :param counts: dict of the amounts to add, keyed by counter
+        :return: None
+        """
+        changes = dict((getattr(cls, k), getattr(cls, k) + v) for (k, v) in counts.items() if v)
+        if changes:
+            RPM_TagCounts.update(changes).where(RPM_TagCounts.tid == tid).execute()
+
+    def __repr__(self):
+        return '<RPM Tag Counts {self.tid_id}>'.format(self=self)
+
+
+# the version of the tables in this database, see SCHEMA_VERSION
+class RPM_Schema(RPMModel):
+    version = IntegerField(default=0)
+
+    def __repr__(self):
+        return '<RPM Schema {self.version}>'.format(self=self)
+
+
 #############################################################################
 #
 # SRPM Model Definitions
@@ -557,6 +1217,14 @@ class SRPM_Tag(SRPMModel):  # tags
         except:
             return None
 
+    @classmethod
+    def get_names(cls):
+        """
+        Returns the names of all tags
+        :return: dict of tag names keyed by tag id
+        """
+        return dict(SRPM_Tag.select(SRPM_Tag.id, SRPM_Tag.tag).tuples())
+
     @classmethod
     def get_id(cls, name):
         """
@@ -578,6 +1246,21 @@ class SRPM_Tag(SRPMModel):  # tags
         """
         return SRPM_Tag.select().order_by(SRPM_Tag.tag)
 
+    @classmethod
+    def get_versions(cls, tag=None):
+        """
+        Returns the state of tags for the query cache: the dates each tag was added and last updated
+        and its newest package, which change whenever packages are added, updated or removed
+        :param tag: the tag name to limit this to, if any
+        :return: list
+        """
+        query = (SRPM_Tag.select(SRPM_Tag.id, SRPM_Tag.tdate, SRPM_Tag.update_date, fn.MAX(SRPM_Package.id)).join(
+                    SRPM_Package, JOIN_LEFT_OUTER, on=(SRPM_Package.tid == SRPM_Tag.id)).group_by(
+                    SRPM_Tag.id, SRPM_Tag.tdate, SRPM_Tag.update_date).order_by(SRPM_Tag.id))
+        if tag:
+            query = query.where(SRPM_Tag.tag == tag)
+        return list(query.tuples())
+
     @classmethod
     def info(cls, tag):
         """
@@ -608,18 +1291,20 @@ class SRPM_Tag(SRPMModel):  # tags
     @property
     def package_count(self):
         """
-        Return the number of packages
+        Return the number of packages, from the counters kept for the tag
         :return: int
         """
-        return SRPM_Package.select().where(SRPM_Package.tid == self.id).count()
+        counts = SRPM_TagCounts.select(SRPM_TagCounts.packages).where(SRPM_TagCounts.tid == self.id).first()
+        return counts.packages if counts else 0
 
     @property
     def update_count(self):
         """
-        Return the number of updates packages
+        Return the number of updates packages, from the counters kept for the tag
         :return: int
         """
-        return SRPM_Package.select().where((SRPM_Package.tid == self.id) & (SRPM_Package.update == 1)).count()
+        counts = SRPM_TagCounts.select(SRPM_TagCounts.updates).where(SRPM_TagCounts.tid == self.id).first()
+        return counts.updates if counts else 0
 
 
     def __repr__(self):
@@ -635,6 +1320,8 @@ class SRPM_Package(SRPMModel):
     date     = TextField(null=False)  # p_date
     fullname = TextField(null=False)  # p_fullname
     update   = IntegerField(default=0)  # p_update
+    sortkey  = CharField(default='', index=True)  # epoch-version-release, see rq.basics.evr_sortkey()
+    size     = BigIntegerField(default=0)  # size of the package file in bytes
 
     @property
     def tag(self):
@@ -722,12 +1409,24 @@ class SRPM_Source(SRPMModel):
         return '<SRPM Source {self.file}>'.format(self=self)
 
 
-# the source rpm files model
+# the directory names of source rpm files
+class SRPM_Dirname(SRPMNameModel):
+    pass
+
+
+# the source rpm files model, see RPM_File
 class SRPM_File(SRPMModel):
-    pid     = ForeignKeyField(SRPM_Package, related_name='sfile')  # p_record
-    tid     = ForeignKeyField(SRPM_Tag, related_name='sfile')  # t_record
-    sid     = ForeignKeyField(SRPM_Source, related_name='sfile')  # s_record
-    file    = TextField()  # f_file
+    pid      = ForeignKeyField(SRPM_Package, related_name='sfile')  # p_record
+    tid      = ForeignKeyField(SRPM_Tag, related_name='sfile')  # t_record
+    sid      = ForeignKeyField(SRPM_Source, related_name='sfile')  # s_record
+    file     = TextField()  # f_file
+    basename = CharField(default='')  # the file name without its directory
+    did      = ForeignKeyField(SRPM_Dirname, null=True, related_name='sfile')  # the directory of the file
+
+    class Meta:
+        indexes = (
+            (('basename', 'did'), False),
+        )
 
     @classmethod
     def find_id(cls, file, tid, pid):
@@ -773,6 +1472,31 @@ class SRPM_File(SRPMModel):
         return '<SRPM File {self.file}>'.format(self=self)
 
 
+# the source rpm file name trigram index, see RPM_FileTrigram
+class SRPM_FileTrigram(SRPMModel):
+    tid  = IntegerField()
+    pid  = IntegerField()
+    fid  = IntegerField()
+    gram = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('gram', 'tid', 'fid'), False),
+            (('pid',), False),
+            (('tid',), False),
+        )
+
+    @classmethod
+    def candidates(cls, name, tid=None):
+        """
+        Returns a query for the ids of the files whose names may contain name
+        :param name: the substring being searched for, or a list of them
+        :param tid: tag id to limit the search to, if any
+        :return: query or None if the index can't be used
+        """
+        return trigram_candidates(SRPM_FileTrigram, name, tid)
+
+
 # the source rpm buildrequires model
 class SRPM_BuildRequires(SRPMModel):  # provides
     pid  = ForeignKeyField(SRPM_Package, related_name='buildrequires')  # p_record
@@ -840,3 +1564,39 @@ class SRPM_AlreadySeen(SRPMModel):  # a_record
         if SRPM_AlreadySeen.select().where((SRPM_AlreadySeen.tid == tid) & (SRPM_AlreadySeen.fullname == name)):
             return True
         return False
+
+
+# running totals of the records in each tag, kept up to date as packages are added and removed
+# (see Tag.count_added()) so they don't have to be counted every time they are shown
+class SRPM_TagCounts(SRPMModel):
+    tid       = ForeignKeyField(SRPM_Tag, related_name='counts', unique=True)
+    packages  = IntegerField(default=0)
+    updates   = IntegerField(default=0)
+    files     = IntegerField(default=0)
+    sources   = IntegerField(default=0)
+    ctags     = IntegerField(default=0)
+    buildreqs = IntegerField(default=0)
+    bytes     = BigIntegerField(default=0)
+
+    @classmethod
+    def add(cls, tid, counts):
+        """
+        Adds to the counters of a tag; negative numbers subtract
+        :param tid: the tag id
+        :param counts: dict of the amounts to add, keyed by counter
+        :return: None
+        """
+        changes = dict((getattr(cls, k), getattr(cls, k) + v) for (k, v) in counts.items() if v)
+        if changes:
+            SRPM_TagCounts.update(changes).where(SRPM_TagCounts.tid == tid).execute()
+
+    def __repr__(self):
+        return '<SRPM Tag Counts {self.tid_id}>'.format(self=self)
+
+
+# the version of the tables in this database, see SCHEMA_VERSION
+class SRPM_Schema(SRPMModel):
+    version = IntegerField(default=0)
+
+    def __repr__(self):
+        return '<SRPM Schema {self.version}>'.format(self=self)
@@ -25,7 +25,806 @@ import logging
 import os
 import sys
 import re
+import bz2
+import zlib
+import mmap
+import struct
+import time
 import commands
+import sqlite3
+import cPickle
+import hashlib
+import subprocess
+import multiprocessing
+
+try:
+    import lzma
+except ImportError:
+    # python 2 needs backports.lzma for xz payloads, otherwise we use the xz command
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+RPM_LEAD_MAGIC   = '\xed\xab\xee\xdb'
+RPM_HEADER_MAGIC = '\x8e\xad\xe8\x01'
+
+# the header tags (from rpmtag.h) that we read from each package
+RPM_TAGS = {1000: 'name',
+            1001: 'version',
+            1002: 'release',
+            1003: 'epoch',
+            1006: 'buildtime',
+            1022: 'arch',
+            1027: 'oldfilenames',
+            1030: 'filemodes',
+            1035: 'filedigests',
+            1039: 'fileusername',
+            1040: 'filegroupname',
+            1044: 'sourcerpm',
+            1047: 'providename',
+            1048: 'requireflags',
+            1049: 'requirename',
+            1050: 'requireversion',
+            1112: 'provideflags',
+            1113: 'provideversion',
+            1116: 'dirindexes',
+            1117: 'basenames',
+            1118: 'dirnames',
+            1125: 'payloadcompressor'}
+
+# dependency sense flags, used to print requires and provides the way rpm does
+RPMSENSE_LESS    = 0x02
+RPMSENSE_GREATER = 0x04
+RPMSENSE_EQUAL   = 0x08
+
+
+class RPMHeader:
+    """
+    Class to read the lead, signature and header of an RPM package in a single pass, without
+    calling out to rpm
+    """
+
+    def __init__(self, rpm_file):
+        self.rpm_file = rpm_file
+        self.tags     = {}
+
+        with open(rpm_file, 'rb') as f:
+            lead = f.read(96)
+            if len(lead) != 96 or lead[:4] != RPM_LEAD_MAGIC:
+                raise ValueError('%s is not an rpm file (bad lead)' % rpm_file)
+
+            # the signature header is padded out to an 8 byte boundary
+            sig_size = self.__read_header(f, False)
+            f.seek((8 - (sig_size % 8)) % 8, os.SEEK_CUR)
+
+            self.__read_header(f, True)
+            self.payload_offset = f.tell()
+
+
+    def __read_header(self, f, keep):
+        """
+        Function to read a header structure at the current file position; the tags we want are
+        stored if keep is True.  Returns the size of the header structure
+        """
+        intro = f.read(16)
+        if len(intro) != 16 or intro[:4] != RPM_HEADER_MAGIC:
+            raise ValueError('%s has a corrupt header' % self.rpm_file)
+
+        (nindex, hsize) = struct.unpack('>II', intro[8:])
+        index = f.read(nindex * 16)
+        store = f.read(hsize)
+        if len(index) != nindex * 16 or len(store) != hsize:
+            raise ValueError('%s has a truncated header' % self.rpm_file)
+
+        if keep:
+            for i in xrange(nindex):
+                (tag, htype, offset, count) = struct.unpack('>iiii', index[i * 16:i * 16 + 16])
+                if tag in RPM_TAGS:
+                    self.tags[RPM_TAGS[tag]] = self.__get_value(store, htype, offset, count)
+
+        return 16 + nindex * 16 + hsize
+
+
+    def __get_value(self, store, htype, offset, count):
+        """
+        Function to decode one header value from the header data store
+        """
+        if htype in (1, 2):     # CHAR, INT8
+            return list(struct.unpack('>%dB' % count, store[offset:offset + count]))
+        if htype == 3:          # INT16
+            return list(struct.unpack('>%dH' % count, store[offset:offset + count * 2]))
+        if htype == 4:          # INT32
+            return list(struct.unpack('>%dI' % count, store[offset:offset + count * 4]))
+        if htype == 5:          # INT64
+            return list(struct.unpack('>%dQ' % count, store[offset:offset + count * 8]))
+        if htype == 6:          # STRING
+            return store[offset:store.index('\0', offset)]
+        if htype == 7:          # BIN
+            return store[offset:offset + count]
+        if htype in (8, 9):     # STRING_ARRAY, I18NSTRING
+            values = []
+            for x in xrange(count):
+                end = store.index('\0', offset)
+                values.append(store[offset:end])
+                offset = end + 1
+            return values
+        return None
+
+
+    def get(self, name, default=None):
+        """
+        Function to return a single header value such as the name or buildtime
+        """
+        value = self.tags.get(name)
+        if value is None:
+            return default
+        if isinstance(value, list):
+            return value[0]
+        return value
+
+
+    def files(self):
+        """
+        Function to return the list of file names in the package
+        """
+        if 'basenames' in self.tags:
+            dirnames = self.tags.get('dirnames', [])
+            return ['%s%s' % (dirnames[d], b) for (d, b) in zip(self.tags.get('dirindexes', []), self.tags['basenames'])]
+
+        return list(self.tags.get('oldfilenames', []))
+
+
+    def dependencies(self, dtype):
+        """
+        Function to return the requires or provides of the package formatted the way
+        'rpm -q --requires' and 'rpm -q --provides' would
+        """
+        names    = self.tags.get('%sname' % dtype, [])
+        flags    = self.tags.get('%sflags' % dtype, [])
+        versions = self.tags.get('%sversion' % dtype, [])
+        deps     = []
+
+        for x in xrange(len(names)):
+            dep = names[x]
+            if x < len(versions) and versions[x] and x < len(flags):
+                op = ''
+                if flags[x] & RPMSENSE_LESS:
+                    op += '<'
+                if flags[x] & RPMSENSE_GREATER:
+                    op += '>'
+                if flags[x] & RPMSENSE_EQUAL:
+                    op += '='
+                if op:
+                    dep = '%s %s %s' % (dep, op, versions[x])
+            deps.append(dep)
+
+        return deps
+
+
+    def fields(self):
+        """
+        Function to return the values we use from the header as a dictionary
+        """
+        files  = []
+        modes  = self.tags.get('filemodes', [])
+        users  = self.tags.get('fileusername', [])
+        groups  = self.tags.get('filegroupname', [])
+        digests = self.tags.get('filedigests', [])
+
+        for (x, fname) in enumerate(self.files()):
+            files.append({'file'  : fname,
+                          'mode'  : modes[x] if x < len(modes) else 0,
+                          'user'  : users[x] if x < len(users) else 'root',
+                          'group' : groups[x] if x < len(groups) else 'root',
+                          'digest': digests[x] if x < len(digests) else ''})
+
+        return {'name'          : self.get('name', ''),
+                'version'       : self.get('version', ''),
+                'release'       : self.get('release', ''),
+                'epoch'         : self.get('epoch'),
+                'buildtime'     : str(self.get('buildtime', '')),
+                'arch'          : self.get('arch', ''),
+                'sourcerpm'     : self.get('sourcerpm', '(none)'),
+                'files'         : files,
+                'requires'      : self.dependencies('require'),
+                'provides'      : self.dependencies('provide'),
+                'payload_offset': self.payload_offset,
+                'payload_comp'  : self.get('payloadcompressor', 'gzip')}
+
+
+class RPMStream:
+    """
+    Class to present a compressed payload as a file-like object that decompresses as it is read
+    """
+
+    def __init__(self, f, decompressor):
+        self.f            = f
+        self.decompressor = decompressor
+        self.buf          = ''
+        self.pos          = 0
+
+
+    def read(self, size):
+        while len(self.buf) - self.pos < size:
+            chunk = self.f.read(65536)
+            if not chunk:
+                break
+            self.buf = self.buf[self.pos:] + self.decompressor.decompress(chunk)
+            self.pos = 0
+
+        data      = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+
+class RPMMember:
+    """
+    Class to describe a single member of an RPM payload; the contents can be read while the
+    member is current
+    """
+
+    def __init__(self, stream, name, mode, size, ino, nlink):
+        self.stream = stream
+        self.name   = name
+        self.mode   = mode
+        self.size   = size
+        self.ino    = ino
+        self.nlink  = nlink
+        self.left   = size
+
+
+    def read(self, size=65536):
+        data = self.stream.read(min(size, self.left))
+        if not data and size and self.left:
+            raise ValueError('payload ends %d bytes into %s of %d bytes' % (self.size - self.left, self.name,
+                                                                          self.size))
+        self.left -= len(data)
+        return data
+
+
+class RPMPayload:
+    """
+    Class to walk the cpio payload of an RPM as a stream; nothing is written to disk
+    """
+
+    def __init__(self, rpm_file, header):
+        self.rpm_file = rpm_file
+        self.header   = header
+        self.proc     = None
+
+
+    def __open(self, f):
+        """
+        Function to return a file-like object of the decompressed payload; compressors that
+        python can't handle itself are run as a filter
+        """
+        comp = self.header['payload_comp']
+
+        if comp == 'gzip':
+            return RPMStream(f, zlib.decompressobj(16 + zlib.MAX_WBITS))
+        if comp == 'bzip2':
+            return RPMStream(f, bz2.BZ2Decompressor())
+
+        if comp in ('xz', 'lzma'):
+            if lzma:
+                return RPMStream(f, lzma.LZMADecompressor())
+            command = ['xz', '-dc']
+        elif comp == 'zstd':
+            command = ['zstd', '-dc']
+        else:
+            raise ValueError('%s has an unknown payload compressor (%s)' % (self.rpm_file, comp))
+
+        self.proc = subprocess.Popen(command, stdin=f, stdout=subprocess.PIPE)
+        return self.proc.stdout
+
+
+    def __read(self, stream, size):
+        """
+        Function to read exactly size bytes of the payload; a short read means it is truncated
+        """
+        data = stream.read(size)
+        if len(data) != size:
+            raise ValueError('%s has a truncated payload' % self.rpm_file)
+        return data
+
+
+    def members(self):
+        """
+        Generator to return each member (RPMMember) of the payload in turn.  Raises ValueError
+        if the payload is corrupt or truncated
+        """
+        with open(self.rpm_file, 'rb') as f:
+            f.seek(self.header['payload_offset'])
+            stream = self.__open(f)
+            try:
+                while True:
+                    chdr = self.__read(stream, 110)
+                    if chdr[:6] not in ('070701', '070702'):
+                        raise ValueError('%s has an unsupported or corrupt payload' % self.rpm_file)
+
+                    (ino, mode, uid, gid, nlink, mtime, size, dmaj, dmin, rmaj, rmin, namesize, check) = \
+                        [int(chdr[x:x + 8], 16) for x in xrange(6, 110, 8)]
+
+                    name = self.__read(stream, namesize)[:-1]
+                    self.__read(stream, (4 - (110 + namesize) % 4) % 4)
+                    if name == 'TRAILER!!!':
+                        break
+
+                    member = RPMMember(stream, name, mode, size, ino, nlink)
+                    yield member
+
+                    # skip whatever the caller didn't read, and the padding; RPMMember.read()
+                    # raises ValueError if the payload ends first
+                    while member.left:
+                        member.read()
+                    self.__read(stream, (4 - size % 4) % 4)
+            finally:
+                if self.proc:
+                    self.proc.stdout.close()
+                    self.proc.wait()
+
+
+# ELF constants, from elf.h
+ET_EXEC          = 2
+ET_DYN           = 3
+PT_DYNAMIC       = 2
+PT_GNU_STACK     = 0x6474e551
+PT_GNU_RELRO     = 0x6474e552
+PF_X             = 0x1
+SHT_SYMTAB       = 2
+SHT_DYNSYM       = 11
+SHT_GNU_VERDEF   = 0x6ffffffd
+SHT_GNU_VERNEED  = 0x6ffffffe
+SHT_GNU_VERSYM   = 0x6fffffff
+STB_GLOBAL       = 1
+STB_WEAK         = 2
+STB_GNU_UNIQUE   = 10
+
+
+class ELFFile:
+    """
+    Class to read the program headers, dynamic section and symbol tables of an ELF file in a
+    single pass over a string or mmap, without calling out to readelf or nm
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+        if data[:4] != '\x7fELF' or data[4] not in ('\x01', '\x02') or data[5] not in ('\x01', '\x02'):
+            raise ValueError('not an ELF file')
+
+        self.is64 = data[4] == '\x02'
+        self.end  = '<' if data[5] == '\x01' else '>'
+
+        if self.is64:
+            (self.e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize, e_phentsize,
+             e_phnum, e_shentsize, e_shnum, e_shstrndx) = self.__unpack('HHIQQQIHHHHHH', 16)
+        else:
+            (self.e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize, e_phentsize,
+             e_phnum, e_shentsize, e_shnum, e_shstrndx) = self.__unpack('HHIIIIIHHHHHH', 16)
+
+        # program headers, as (type, flags, offset, size)
+        self.segments = []
+        for x in xrange(e_phnum):
+            offset = e_phoff + x * e_phentsize
+            if self.is64:
+                (p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz) = self.__unpack('IIQQQQ', offset)
+            else:
+                (p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags) = self.__unpack('IIIIIII', offset)
+            self.segments.append((p_type, p_flags, p_offset, p_filesz))
+
+        # section headers, as (type, offset, size, link, entsize)
+        self.sections = []
+        for x in xrange(e_shnum):
+            offset = e_shoff + x * e_shentsize
+            if self.is64:
+                (sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign,
+                 sh_entsize) = self.__unpack('IIQQQQIIQQ', offset)
+            else:
+                (sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign,
+                 sh_entsize) = self.__unpack('IIIIIIIIII', offset)
+            self.sections.append((sh_type, sh_offset, sh_size, sh_link, sh_entsize))
+
+        self.dynamic  = self.__read_dynamic()
+        self.versions = self.__read_versions()
+        self.dynsyms  = self.__read_symbols(SHT_DYNSYM)
+        self.symtab   = self.__read_symbols(SHT_SYMTAB)
+
+
+    @classmethod
+    def open(cls, path):
+        """
+        Function to return an ELFFile for the file at path, read through an mmap
+        """
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+    def __unpack(self, fmt, offset):
+        fmt = self.end + fmt
+        return struct.unpack(fmt, self.data[offset:offset + struct.calcsize(fmt)])
+
+
+    def __string(self, offset):
+        end = self.data.find('\0', offset)
+        if end < 0:
+            raise ValueError('unterminated string in ELF file')
+        return self.data[offset:end]
+
+
+    def __read_dynamic(self):
+        """
+        Function to return the dynamic section as a dictionary of tag: [values]
+        """
+        dynamic = {}
+        for (p_type, p_flags, p_offset, p_filesz) in self.segments:
+            if p_type != PT_DYNAMIC:
+                continue
+
+            (fmt, size) = ('qQ', 16) if self.is64 else ('iI', 8)
+            for offset in xrange(p_offset, p_offset + p_filesz - size + 1, size):
+                (d_tag, d_val) = self.__unpack(fmt, offset)
+                if d_tag == 0:      # DT_NULL
+                    break
+                dynamic.setdefault(d_tag, []).append(d_val)
+
+        return dynamic
+
+
+    def __read_versions(self):
+        """
+        Function to return the symbol version names from the verneed and verdef sections
+        as a dictionary of version index: name
+        """
+        versions = {}
+        for (sh_type, sh_offset, sh_size, sh_link, sh_entsize) in self.sections:
+            if sh_type not in (SHT_GNU_VERNEED, SHT_GNU_VERDEF) or sh_link >= len(self.sections):
+                continue
+
+            strtab = self.sections[sh_link][1]
+            offset = sh_offset
+            while True:
+                if sh_type == SHT_GNU_VERNEED:
+                    (vn_version, vn_cnt, vn_file, vn_aux, vn_next) = self.__unpack('HHIII', offset)
+                    aux = offset + vn_aux
+                    for x in xrange(vn_cnt):
+                        (vna_hash, vna_flags, vna_other, vna_name, vna_next) = self.__unpack('IHHII', aux)
+                        versions[vna_other & 0x7fff] = self.__string(strtab + vna_name)
+                        aux += vna_next
+                    nextoff = vn_next
+                else:
+                    (vd_version, vd_flags, vd_ndx, vd_cnt, vd_hash, vd_aux, vd_next) = self.__unpack('HHHHIII', offset)
+                    (vda_name, vda_next) = self.__unpack('II', offset + vd_aux)
+                    versions[vd_ndx & 0x7fff] = self.__string(strtab + vda_name)
+                    nextoff = vd_next
+                if not nextoff:
+                    break
+                offset += nextoff
+
+        return versions
+
+
+    def __read_symbols(self, symtype):
+        """
+        Function to return the symbols from the dynsym or symtab section as a list of
+        (name, binding, section index, version) tuples
+        """
+        symbols = []
+        versym  = None
+        for (sh_type, sh_offset, sh_size, sh_link, sh_entsize) in self.sections:
+            if sh_type == SHT_GNU_VERSYM:
+                versym = sh_offset
+
+        for (sh_type, sh_offset, sh_size, sh_link, sh_entsize) in self.sections:
+            if sh_type != symtype or sh_link >= len(self.sections):
+                continue
+
+            strtab = self.sections[sh_link][1]
+            size   = 24 if self.is64 else 16
+            for x in xrange(sh_size / size):
+                offset = sh_offset + x * size
+                if self.is64:
+                    (st_name, st_info, st_other, st_shndx) = self.__unpack('IBBH', offset)
+                else:
+                    (st_name, st_value, st_size, st_info, st_other, st_shndx) = self.__unpack('IIIBBH', offset)
+                if not st_name:
+                    continue
+
+                # versions are only kept for dynamic symbols; readelf shows name@version for
+                # references and hidden versions, and name@@version for the default version
+                version = ''
+                if symtype == SHT_DYNSYM and versym is not None:
+                    (vs,) = self.__unpack('H', versym + x * 2)
+                    if (vs & 0x7fff) in self.versions and (vs & 0x7fff) > 1:
+                        if st_shndx == 0 or vs & 0x8000:
+                            version = '@' + self.versions[vs & 0x7fff]
+                        else:
+                            version = '@@' + self.versions[vs & 0x7fff]
+
+                symbols.append((self.__string(strtab + st_name), st_info >> 4, st_shndx, version))
+
+        return symbols
+
+
+class HeaderCache:
+    """
+    Class to keep the header fields of packages we have read in a small sqlite database so
+    that unchanged packages never need to be opened again.  Entries are keyed on the absolute
+    path and are only used if the size and mtime of the file still match.  Once the cache
+    grows past max_size bytes the least recently used entries are dropped.  Nothing in here
+    is fatal; if the cache can't be used we just read the headers
+    """
+
+    def __init__(self, path, max_size):
+        self.path     = path
+        self.max_size = max_size
+        self.db       = None
+        self.pid      = None
+        self.puts     = 0
+
+
+    def __connect(self):
+        """
+        Function to open the cache; connections can't be shared with pool workers, so each
+        process opens its own
+        """
+        if self.db and self.pid == os.getpid():
+            return self.db
+
+        self.db  = None
+        self.pid = os.getpid()
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, '
+                       'mtime REAL, used INTEGER, fields BLOB)')
+            db.execute('CREATE INDEX IF NOT EXISTS headers_used ON headers (used)')
+            self.db = db
+        except (OSError, sqlite3.Error), e:
+            logging.warning('Unable to open the header cache %s, not using it!\n%s', self.path, e)
+        return self.db
+
+
+    def get(self, rpm_file):
+        """
+        Function to return the cached header fields of a package, or None if we don't have
+        them or the package has changed since they were cached
+        """
+        db = self.__connect()
+        if not db:
+            return None
+
+        try:
+            st  = os.stat(rpm_file)
+            row = db.execute('SELECT size, mtime, fields FROM headers WHERE path = ?',
+                             (os.path.abspath(rpm_file),)).fetchone()
+            if not row or row[0] != st.st_size or row[1] != st.st_mtime:
+                return None
+            db.execute('UPDATE headers SET used = ? WHERE path = ?', (int(time.time()), os.path.abspath(rpm_file)))
+            return cPickle.loads(zlib.decompress(str(row[2])))
+        except (OSError, sqlite3.Error, cPickle.UnpicklingError, zlib.error), e:
+            logging.debug('header cache lookup for %s failed: %s' % (rpm_file, e))
+            return None
+
+
+    def put(self, rpm_file, fields):
+        """
+        Function to add the header fields of a package to the cache
+        """
+        db = self.__connect()
+        if not db:
+            return
+
+        try:
+            st   = os.stat(rpm_file)
+            blob = sqlite3.Binary(zlib.compress(cPickle.dumps(fields, cPickle.HIGHEST_PROTOCOL)))
+            db.execute('INSERT OR REPLACE INTO headers (path, size, mtime, used, fields) VALUES (?, ?, ?, ?, ?)',
+                       (os.path.abspath(rpm_file), st.st_size, st.st_mtime, int(time.time()), blob))
+            self.puts += 1
+            if self.puts % 100 == 1:
+                self.trim()
+        except (OSError, sqlite3.Error), e:
+            logging.debug('header cache update for %s failed: %s' % (rpm_file, e))
+
+
+    def trim(self):
+        """
+        Function to drop the least recently used entries once the cache is over its size cap
+        """
+        db = self.__connect()
+        if not db:
+            return
+
+        (size, count) = db.execute('SELECT SUM(LENGTH(fields)), COUNT(*) FROM headers').fetchone()
+        if not size or size <= self.max_size:
+            return
+
+        # drop enough entries to get back to 90% of the cap, assuming they're of average size
+        drop = count - int(count * self.max_size * 0.9 / size)
+        logging.debug('header cache is %d bytes, dropping %d entries' % (size, drop))
+        db.execute('DELETE FROM headers WHERE path IN (SELECT path FROM headers ORDER BY used LIMIT ?)', (drop,))
+
+
+    def invalidate(self, rpm_file):
+        """
+        Function to drop a package from the cache, once it can't be read or has been removed
+        from the database
+        """
+        db = self.__connect()
+        if not db:
+            return
+
+        try:
+            db.execute('DELETE FROM headers WHERE path = ?', (os.path.abspath(rpm_file),))
+        except sqlite3.Error, e:
+            logging.debug('header cache removal of %s failed: %s' % (rpm_file, e))
+
+
+    def clear(self):
+        """
+        Function to empty the cache; returns the number of entries removed
+        """
+        db = self.__connect()
+        if not db:
+            return 0
+
+        removed = db.execute('DELETE FROM headers').rowcount
+        db.execute('VACUUM')
+        return removed
+
+
+class QueryCache:
+    """
+    Class to keep the output of queries in a small sqlite database so that the same query doesn't
+    have to be run against the database again.  Keys include the state of the tags the query covers
+    (see Tag.versions()), so entries stop being used as soon as a tag is updated or deleted.  Once
+    the cache grows past max_size bytes the least recently used entries are dropped.  Nothing in
+    here is fatal; if the cache can't be used we just run the query
+    """
+
+    def __init__(self, path, max_size):
+        self.path     = path
+        self.max_size = max_size
+        self.db       = None
+        self.puts     = 0
+
+
+    def __connect(self):
+        """
+        Function to open the cache
+        """
+        if self.db or not self.path:
+            return self.db
+
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, used INTEGER, output BLOB)')
+            db.execute('CREATE INDEX IF NOT EXISTS queries_used ON queries (used)')
+            self.db = db
+        except (OSError, sqlite3.Error), e:
+            logging.warning('Unable to open the query cache %s, not using it!\n%s', self.path, e)
+            self.path = None
+        return self.db
+
+
+    def digest(self, key):
+        """
+        Function to turn a key (any tuple of plain values) into the string we store entries under
+        """
+        return hashlib.sha1(repr(key)).hexdigest()
+
+
+    def get(self, key):
+        """
+        Function to return the cached output of a query, or None if we don't have it
+        """
+        db = self.__connect()
+        if not db:
+            return None
+
+        key = self.digest(key)
+        try:
+            row = db.execute('SELECT output FROM queries WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            db.execute('UPDATE queries SET used = ? WHERE key = ?', (int(time.time()), key))
+            return zlib.decompress(str(row[0]))
+        except (sqlite3.Error, zlib.error), e:
+            logging.debug('query cache lookup failed: %s' % e)
+            return None
+
+
+    def put(self, key, output):
+        """
+        Function to add the output of a query to the cache
+        """
+        db = self.__connect()
+        if not db:
+            return
+
+        try:
+            db.execute('INSERT OR REPLACE INTO queries (key, used, output) VALUES (?, ?, ?)',
+                       (self.digest(key), int(time.time()), sqlite3.Binary(zlib.compress(output))))
+            self.puts += 1
+            if self.puts % 100 == 1:
+                self.trim()
+        except sqlite3.Error, e:
+            logging.debug('query cache update failed: %s' % e)
+
+
+    def trim(self):
+        """
+        Function to drop the least recently used entries once the cache is over its size cap;
+        entries for tags that have since changed are never used again, so they age out here
+        """
+        db = self.__connect()
+        if not db:
+            return
+
+        (size, count) = db.execute('SELECT SUM(LENGTH(output)), COUNT(*) FROM queries').fetchone()
+        if not size or size <= self.max_size:
+            return
+
+        # drop enough entries to get back to 90% of the cap, assuming they're of average size
+        drop = count - int(count * self.max_size * 0.9 / size)
+        logging.debug('query cache is %d bytes, dropping %d entries' % (size, drop))
+        db.execute('DELETE FROM queries WHERE key IN (SELECT key FROM queries ORDER BY used LIMIT ?)', (drop,))
+
+
+    def clear(self):
+        """
+        Function to empty the cache; returns the number of entries removed
+        """
+        db = self.__connect()
+        if not db:
+            return 0
+
+        removed = db.execute('DELETE FROM queries').rowcount
+        db.execute('VACUUM')
+        return removed
+
+
+class OutputTee:
+    """
+    Class to stand in for sys.stdout, passing everything through while keeping a copy of up to
+    limit bytes of it
+    """
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit  = limit
+        self.size   = 0
+        self.parts  = []
+
+
+    def write(self, data):
+        self.stream.write(data)
+        if self.parts is not None:
+            self.size += len(data)
+            if self.size > self.limit:
+                self.parts = None
+            else:
+                self.parts.append(data)
+
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+    def getvalue(self):
+        """
+        Function to return what was written, or None if it was too much to keep
+        """
+        if self.parts is None:
+            return None
+        return ''.join(self.parts)
 
 
 class Common:
@@ -33,7 +832,7 @@ class Common:
     define some common functions for use
     """
 
-    def __init__(self, options, rq_type):
+    def __init__(self, options, rq_type, config=None):
         self.pstate  = 1
         self.options = options
         self.rq_type = rq_type
@@ -42,6 +841,55 @@ class Common:
         self.re_srpm    = re.compile(r'\.src\.rpm$')
         self.re_brpm    = re.compile(r'\.rpm$')
 
+        # the last header we read; a package is looked at several times while it is added
+        self.header_file = None
+        self.header      = None
+
+        # headers we've read before, kept across runs; only kept if header_cache is set, and
+        # header_cache_size (in MB) of 0 disables it as well
+        self.header_cache = None
+        if config is None:
+            config = {}
+        cache_path = config.get('header_cache', '').strip().strip('\'"')
+        cache_size = int(config.get('header_cache_size', 64))
+        if cache_path and cache_size > 0:
+            self.header_cache = HeaderCache(cache_path, cache_size * 1024 * 1024)
+
+        # output of earlier queries, see QueryCache; only kept if query_cache is set, and
+        # query_cache_size (in MB) of 0 disables it as well
+        self.query_cache = None
+        cache_path = config.get('query_cache', '').strip().strip('\'"')
+        cache_size = int(config.get('query_cache_size', 16))
+        if cache_path and cache_size > 0:
+            self.query_cache = QueryCache(cache_path, cache_size * 1024 * 1024)
+
+
+    def cached_output(self, key, func, *args):
+        """
+        Function to call func, which prints the results of a query, with the output coming from the
+        query cache if the same query has been run before; key has to identify the query and the
+        state of the tags it covers.  Debug output shows the rows themselves, so it always comes
+        from the database
+        """
+        if not self.query_cache or self.options.debug:
+            return func(*args)
+
+        output = self.query_cache.get(key)
+        if output is not None:
+            logging.debug('using cached output for %s' % repr(key))
+            sys.stdout.write(output)
+            return
+
+        # anything bigger than a tenth of the cache isn't worth keeping
+        tee        = OutputTee(sys.stdout, self.query_cache.max_size / 10)
+        sys.stdout = tee
+        try:
+            func(*args)
+        finally:
+            sys.stdout = tee.stream
+        if tee.getvalue() is not None:
+            self.query_cache.put(key, tee.getvalue())
+
 
     def show_progress(self, prefix=''):
         """
@@ -80,6 +928,36 @@ class Common:
         return(file_excludes)
 
 
+    def rpm_header(self, rpm_file):
+        """
+        Function to return the header fields of an RPM as a dictionary (see RPMHeader.fields()),
+        or None if the header cannot be read
+        """
+        logging.debug('in rpm_header(%s)' % rpm_file)
+
+        if rpm_file == self.header_file:
+            return self.header
+
+        header = None
+        if self.header_cache:
+            header = self.header_cache.get(rpm_file)
+
+        if not header:
+            try:
+                header = RPMHeader(rpm_file).fields()
+            except (IOError, ValueError, struct.error), e:
+                logging.error('Unable to read the header of %s!\n%s', rpm_file, e)
+                if self.header_cache:
+                    self.header_cache.invalidate(rpm_file)
+                return None
+            if self.header_cache:
+                self.header_cache.put(rpm_file, header)
+
+        self.header_file = rpm_file
+        self.header      = header
+        return header
+
+
     def rpm_list(self, rpm_file, raw=False):
         """
         Function to get the list of files in an RPM, excluding those files defined
@@ -87,25 +965,26 @@ class Common:
         """
         logging.debug('in rpm_list(%s)' % rpm_file)
 
-        rpm_list  = commands.getoutput("rpm -qlvp --nosignature " + self.clean_shell(rpm_file))
-
-        if rpm_list == '(contains no files)' or rpm_list == '':
-            return False
-
         if raw:
+            rpm_list = commands.getoutput("rpm -qlvp --nosignature " + self.clean_shell(rpm_file))
+            if rpm_list == '(contains no files)' or rpm_list == '':
+                return False
             return rpm_list
 
-        rpm_list  = rpm_list.splitlines()
+        header = self.rpm_header(rpm_file)
+        if not header or not header['files']:
+            return False
+
         rlist     = {}
         count     = 0
 
-        for entry in rpm_list:
+        for entry in header['files']:
             break_loop = False
-            logging.debug('processing: %s' % entry)  # DEBUG
+            logging.debug('processing: %s' % entry['file'])  # DEBUG
             for exclude in self.get_file_excludes():
                 # make sure we don't include any files in our exclude list
-                if re.search(exclude, entry):
-                    logging.debug('found unwanted entry: %s' % entry)
+                if re.search(exclude, entry['file']):
+                    logging.debug('found unwanted entry: %s' % entry['file'])
                     break_loop = True
 
             if break_loop:
@@ -113,27 +992,15 @@ class Common:
 
             is_suid = 0
             is_sgid = 0
-            fperms     = entry.split()
-
-            # this actually really stinks because we are allowed usernames longer
-            # than 8 characters, but rpm -qlv will only display the first 8 characters
-            # of the owner/group name -- not cool at all
-            if len(fperms[2]) > 8:
-                user  = fperms[2][:8]
-                group = fperms[2][8:]
-                fname = fperms[7]
-            else:
-                user  = fperms[2]
-                group = fperms[3]
-                fname = fperms[8]
-            if fperms[0][3].lower() == 's':
+            if entry['mode'] & 04000:
                 is_suid = 1
-            if fperms[0][6].lower() == 's':
+            if entry['mode'] & 02000:
                 is_sgid = 1
 
-            perms = self.get_file_mode(fperms[0])
+            perms = '%04o' % (entry['mode'] & 07777)
 
-            rlist[count] = {'file': fname, 'user': user, 'group': group, 'is_suid': is_suid, 'is_sgid': is_sgid, 'perms': perms}
+            rlist[count] = {'file': entry['file'], 'user': entry['user'], 'group': entry['group'],
+                            'is_suid': is_suid, 'is_sgid': is_sgid, 'perms': perms}
             count       += 1
 
         return rlist
@@ -214,6 +1081,56 @@ class Common:
         return num
 
 
+    def pool_add(self, rq, db, tid, file_list, update=0):
+        """
+        Function to add a list of packages, using a pool of worker processes (each with their own
+        database connection) if more than one job was asked for.  Failed packages are collected and
+        reported once everything has been processed; returns the number of packages that failed
+        """
+        logging.debug('in Common.pool_add(%s, %d, %d)' % (tid, len(file_list), update))
+
+        jobs   = self.options.jobs
+        total  = len(file_list)
+        done   = 0
+        errors = []
+        pool   = None
+
+        if jobs > 1:
+            # the workers are forked, so make sure they do not inherit (and share) our connection
+            if not db.is_closed():
+                db.close()
+
+            logging.info('Adding %d packages using %d worker processes' % (total, jobs))
+            pool    = multiprocessing.Pool(jobs, _pool_init, (rq,))
+            results = pool.imap_unordered(_pool_record_add, [(tid, x, update) for x in file_list])
+        else:
+            results = (_record_add(rq, tid, x, update) for x in file_list)
+
+        try:
+            for (rpm, error) in results:
+                done += 1
+                if error:
+                    errors.append((rpm, error))
+                if pool and self.options.progress:
+                    sys.stdout.write('[%d/%d] %s\n' % (done, total, os.path.basename(rpm)))
+            if pool:
+                pool.close()
+        except KeyboardInterrupt:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
+
+        if errors:
+            print '\nFailed to add %d of %d packages:' % (len(errors), total)
+            for (rpm, error) in sorted(errors):
+                print '  %s: %s' % (rpm, error)
+
+        return len(errors)
+
+
     def clean_shell(self, string):
         """
         Function to clean shell arguments
@@ -231,6 +1148,146 @@ class Common:
                )
 
 
+# the rq object (Binary or Source) used by pool workers; set in each worker by _pool_init()
+_pool_rq = None
+
+
+def _pool_init(rq):
+    """
+    Initialize a pool worker.  The worker opens its own database connection on first use, and
+    leaves progress reporting to the parent so the output of the workers does not interleave
+    """
+    global _pool_rq
+
+    _pool_rq                  = rq
+    _pool_rq.options.progress = False
+
+
+def _pool_record_add(job):
+    """
+    Add a single package from within a pool worker (see _record_add())
+    """
+    (tid, rpm, update) = job
+
+    return _record_add(_pool_rq, tid, rpm, update)
+
+
+def _record_add(rq, tid, rpm, update):
+    """
+    Add a single package.  Returns a tuple of the package and an error message, which is None if
+    the package was added successfully
+    """
+    try:
+        rq.record_add(tid, rpm, update)
+    except SystemExit:
+        return (rpm, 'processing was aborted')
+    except Exception, e:
+        # record_add() has already logged it
+        return (rpm, str(e))
+
+    return (rpm, None)
+
+
+def _version_segments(version):
+    """
+    Split a version or release string into the segments rpm compares: '~' and '^' separators,
+    and runs of digits or letters.  Anything else only separates segments
+    """
+    return re.findall(r'~|\^|[0-9]+|[A-Za-z]+', version or '')
+
+
+def rpmvercmp(a, b):
+    """
+    Compare two version or release strings the way rpm does.  Returns 1 if a is newer, -1 if
+    b is newer, or 0 if they are the same
+    """
+    if a == b:
+        return 0
+
+    one = _version_segments(a)
+    two = _version_segments(b)
+    for x in xrange(max(len(one), len(two))):
+        s1 = one[x] if x < len(one) else ''
+        s2 = two[x] if x < len(two) else ''
+
+        # a tilde sorts before anything, even the end of the version
+        if s1 == '~' or s2 == '~':
+            if s1 != '~':
+                return 1
+            if s2 != '~':
+                return -1
+            continue
+
+        # a caret sorts after the end of the version, but before anything else
+        if s1 == '^' or s2 == '^':
+            if not s1:
+                return -1
+            if not s2:
+                return 1
+            if s1 != '^':
+                return 1
+            if s2 != '^':
+                return -1
+            continue
+
+        if not s1 or not s2:
+            break
+
+        # numbers are newer than letters, and compare by value
+        if s1.isdigit() != s2.isdigit():
+            return s1.isdigit() and 1 or -1
+        if s1.isdigit():
+            s1 = s1.lstrip('0')
+            s2 = s2.lstrip('0')
+            if len(s1) != len(s2):
+                return len(s1) > len(s2) and 1 or -1
+        if s1 != s2:
+            return s1 > s2 and 1 or -1
+
+    # whichever has segments left is newer
+    return cmp(len(one), len(two))
+
+
+def evr_compare(evr1, evr2):
+    """
+    Compare two (epoch, version, release) tuples the way rpm does; a missing epoch is 0
+    """
+    result = cmp(int(evr1[0] or 0), int(evr2[0] or 0))
+    if result == 0:
+        result = rpmvercmp(evr1[1], evr2[1])
+    if result == 0:
+        result = rpmvercmp(evr1[2], evr2[2])
+    return result
+
+
+def evr_sortkey(epoch, version, release):
+    """
+    Return a string that sorts the same way evr_compare() orders packages, so it can be stored
+    and indexed.  Each segment is encoded so that a plain string comparison gives the rpm
+    ordering: tilde '0', end of string '1', caret '2', letters '3' + hex + '.', and numbers
+    '4' + their length (three digits) + their digits.  Raises ValueError if the key doesn't fit
+    the 255 characters of the sortkey columns, as a shortened one could tie with another
+    """
+    def encode(value):
+        key = ''
+        for segment in _version_segments(value):
+            if segment == '~':
+                key += '0'
+            elif segment == '^':
+                key += '2'
+            elif segment.isdigit():
+                segment = segment.lstrip('0')
+                key    += '4%03d%s' % (len(segment), segment)
+            else:
+                key += '3%s.' % segment.encode('hex')
+        return key + '1'
+
+    key = '%010d' % int(epoch or 0) + encode(version) + encode(release)
+    if len(key) > 255:
+        raise ValueError('%s:%s-%s is too long to be given a sort key' % (epoch or 0, version, release))
+    return key
+
+
 class Config:
     """
     Class to handle the configuration file
@@ -250,6 +1307,10 @@ class Config:
         self.config[index] = value
 
 
+    def get(self, index, default=None):
+        return self.config.get(index, default)
+
+
     def __read_config(self):
         """
         Function to read the configuration file
@@ -23,14 +23,24 @@ along with rq.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import re
+import stat
+import mmap
 import commands
 import logging
 import tempfile
-import shutil
 import datetime
 from glob import glob
-from app.models import RPM_Tag, RPM_Package, RPM_User, RPM_Group, RPM_Requires, \
-    RPM_Provides, RPM_File, RPM_Flags, RPM_Symbols
+from peewee import JOIN_LEFT_OUTER
+from app.models import RPM_Tag, RPM_Package, RPM_User, RPM_Group, RPM_Requires, RPM_RequireName, \
+    RPM_Provides, RPM_ProvideName, RPM_File, RPM_Flags, RPM_Symbols, RPM_SymbolName, RPM_Analysis, \
+    RPM_FileTrigram, RPM_Dirname, BulkInsert, file_trigrams, stream, tag_counts, regexp_literals, regexp_match, rpm_db
+from rq.basics import RPMPayload, ELFFile, PT_GNU_RELRO, PT_GNU_STACK, PF_X, ET_EXEC, ET_DYN, STB_GLOBAL, \
+    STB_WEAK, STB_GNU_UNIQUE, evr_sortkey
+
+# the options that change what a query prints; only these are part of its query cache key, so
+# options such as --progress or --jobs don't keep the same query from being found
+QUERY_OPTIONS = ('query', 'provides', 'requires', 'symbols', 'match', 'regexp', 'tag', 'count', 'quiet',
+                 'extrainfo', 'ownership', 'suid', 'sgid', 'user', 'group')
 
 
 class Binary:
@@ -53,6 +63,7 @@ class Binary:
         self.re_patchgz  = re.compile(r'\.(patch|diff|dif)(\.gz)$')
         self.re_patchbz  = re.compile(r'\.(patch|diff|dif)(\.bz2)$')
         self.re_srpmname = re.compile(r'(\w+)(-[0-9]).*')
+        self.re_reqskip  = re.compile(r'(rpmlib|GLIBC|GCC|rtld)')
 
         self.excluded_symbols = ['abort', '__assert_fail', 'bindtextdomain', '__bss_start', 'calloc',
                                  'chmod', 'close', 'close_stdout', '__data_start', 'dcgettext', 'dirname',
@@ -74,6 +85,12 @@ class Binary:
                                  'strnlen', 'strrchr', 'strstr', 'strtol', 'textdomain', 'time', 'umask',
                                  'unlink', 'Version', 'version_etc_copyright', 'waitpid', 'write', '__xstat']
 
+        # rows per multi-row insert
+        self.insert_chunk   = int(config.get('insert_chunk', 500))
+
+        # ELF files up to this size are analyzed in memory rather than from a temporary file
+        self.elf_memory_max = 16 * 1024 * 1024
+
         # caches
         self.symbol_cache   = {}
         self.provides_cache = {}
@@ -84,7 +101,7 @@ class Binary:
 
     def rpm_add_directory(self, tag, path, updatepath):
         """
-        Function to import a directory full of RPMs
+        Function to import a directory full of RPMs; returns the number of packages that failed
         """
         logging.debug('in Binary.rpm_add_directory(%s, %s, %s)' % (tag, path, updatepath))
 
@@ -118,13 +135,16 @@ class Binary:
             logging.critical('Unable to add tag "%s" to the database!' % tag)
             sys.exit(1)
 
+        to_add = []
         for rpm in file_list:
             if not os.path.isfile(rpm):
                 print 'File %s not found!\n' % rpm
             elif not self.re_brpm.search(rpm):
                 print 'File %s is not a binary rpm!\n' % rpm
             else:
-                self.record_add(tid, rpm)
+                to_add.append(rpm)
+
+        return self.rcommon.pool_add(self, rpm_db, tid, to_add)
 
 
     def record_add(self, tid, rpm, update=0):
@@ -141,24 +161,51 @@ class Binary:
 
         self.rcommon.file_rpm_check(rpm)
 
-        pid = self.package_add_record(tid, rpm, update)
-        if not pid:
-            return
-
-        rpm_list = self.rcommon.rpm_list(rpm)
-        if not rpm_list:
-            return
-
-        logging.debug('Add file records for pid: %s' % pid)
-        self.add_records(tid, pid, rpm_list)
-        self.add_requires(tid, pid, rpm)
-        self.add_provides(tid, pid, rpm)
-        self.add_binary_records(tid, pid, rpm)
+        # everything for one package goes in a single transaction so that a failure part way
+        # through doesn't leave a half-populated package behind for in_db() to find
+        try:
+            with rpm_db.atomic():
+                pid = self.package_add_record(tid, rpm, update)
+                if not pid:
+                    return
+
+                # the records added, for the counters of the tag
+                counts   = {'packages': 1, 'updates': int(update), 'bytes': os.path.getsize(rpm)}
+                rpm_list = self.rcommon.rpm_list(rpm)
+                if rpm_list:
+                    logging.debug('Add file records for pid: %s' % pid)
+                    file_ids = self.add_records(tid, pid, rpm_list)
+                    self.add_trigram_records(tid, pid, file_ids)
+                    counts['files']    = len(rpm_list)
+                    counts['requires'] = self.add_requires(tid, pid, rpm)
+                    counts['provides'] = self.add_provides(tid, pid, rpm)
+                    (counts['flags'], counts['symbols']) = self.add_binary_records(tid, pid, rpm, file_ids)
+                self.rtag.count_added(tid, counts)
+        except Exception, e:
+            # the cached ids may refer to rows that were just rolled back
+            self.clear_caches()
+            logging.error('Adding %s failed, all changes for it were rolled back!\n%s', rpm, e)
+            if self.options.progress:
+                sys.stdout.write(' failed\n')
+            raise
 
         if self.options.progress:
             sys.stdout.write('\n')
 
 
+    def clear_caches(self):
+        """
+        Function to empty the lookup caches
+        """
+        logging.debug('in Binary.clear_caches()')
+
+        self.symbol_cache   = {}
+        self.provides_cache = {}
+        self.requires_cache = {}
+        self.group_cache    = {}
+        self.user_cache     = {}
+
+
     def package_add_record(self, tid, rpm, update=0):
         """
         Function to add a package record
@@ -166,15 +213,16 @@ class Binary:
         logging.debug('in Binary.package_add_record(%s, %s, %d)' % (tid, rpm, update))
 
         fname   = os.path.basename(rpm)
-        rpmtags = commands.getoutput("rpm -qp --nosignature --qf '%{NAME}|%{VERSION}|%{RELEASE}|%{BUILDTIME}|%{ARCH}|%{SOURCERPM}' " + self.rcommon.clean_shell(rpm))
-        tlist   = rpmtags.split('|')
-        logging.debug("tlist is %s " % tlist)
-        package = tlist[0].strip()
-        version = tlist[1].strip()
-        release = tlist[2].strip()
-        pdate   = tlist[3].strip()
-        arch    = tlist[4].strip()
-        srpm    = self.re_srpmname.sub(r'\1', tlist[5].strip())
+        header  = self.rcommon.rpm_header(rpm)
+        if not header:
+            raise ValueError('unable to read the package header')
+
+        package = header['name']
+        version = header['version']
+        release = header['release']
+        pdate   = header['buildtime']
+        arch    = header['arch']
+        srpm    = self.re_srpmname.sub(r'\1', header['sourcerpm'])
 
         tag = RPM_Tag.get_tag(tid)
 
@@ -186,32 +234,45 @@ class Binary:
         # TODO: sure makes it easier to sort alphabetically and I'm too lazy for the JOINs right now
 
         self.rcommon.show_progress(fname)
-        try:
-            p = RPM_Package.create(
-                tid      = tid,
-                package  = package,
-                version  = version,
-                release  = release,
-                date     = pdate,
-                arch     = arch,
-                srpm     = srpm,
-                fullname = fname,
-                update   = update
-            )
-            return p.id
-        except Exception, e:
-            logging.error('Adding file %s failed!\n%s', rpm, e)
-            return 0
+        p = RPM_Package.create(
+            tid      = tid,
+            package  = package,
+            version  = version,
+            release  = release,
+            date     = pdate,
+            arch     = arch,
+            srpm     = srpm,
+            fullname = fname,
+            update   = update,
+            sortkey  = evr_sortkey(header['epoch'], version, release),
+            size     = os.path.getsize(rpm)
+        )
+        return p.id
 
 
     def query(self, qtype):
         """
-        Function to run the query for binary RPMs
+        Function to run the query for binary RPMs, or to show its output from the query cache
+        if the tags it covers haven't changed since it was last run
 
         Valid types are: files, provides, requires, symbols, packages
         """
         logging.debug('in Binary.query(%s)' % qtype)
 
+        if not self.rcommon.query_cache:
+            return self.run_query(qtype)
+
+        options = [(name, getattr(self.options, name, None)) for name in QUERY_OPTIONS]
+        key     = ('binary', 'query', qtype, options, self.rtag.versions(self.options.tag))
+        self.rcommon.cached_output(key, self.run_query, qtype)
+
+
+    def run_query(self, qtype):
+        """
+        Function to run the query for binary RPMs against the database
+        """
+        logging.debug('in Binary.run_query(%s)' % qtype)
+
         # TODO: seems to always be case-insensitive; need to change args!!
         t = self.rtag.lookup(self.options.tag)
         if self.options.tag and not t:
@@ -236,6 +297,8 @@ class Binary:
 
         if self.options.regexp:
             match_type = 'regexp'
+        elif qtype in ('files', 'symbols') and self.options.match != 'substring':
+            match_type = self.options.match
         else:
             match_type = 'substring'
 
@@ -244,90 +307,152 @@ class Binary:
 
         result = None
         if qtype == 'files':
-            if self.options.regexp:
+            # exact matches on the file name, or the whole path, are index lookups
+            if match_type == 'basename':
+                result = RPM_File.select().where(RPM_File.basename == like_q)
+                if self.options.tag:
+                    result = result.where(RPM_File.tid == tid)
+                result = result.order_by(RPM_File.file.asc())
+            elif match_type == 'path':
+                (dname, bname) = os.path.split(like_q)
+                result = RPM_File.select().where((RPM_File.basename == bname) & (RPM_File.did << RPM_Dirname.find(dname)))
+                if self.options.tag:
+                    result = result.where(RPM_File.tid == tid)
+                result = result.order_by(RPM_File.file.asc())
+            elif self.options.regexp:
                 if self.options.tag:
-                    result = RPM_File.select().where((RPM_File.file.regexp(like_q)) & (RPM_File.tid == tid)).order_by(RPM_File.file.asc())
+                    result = RPM_File.select().where(regexp_match(RPM_File.file, like_q) & (RPM_File.tid == tid)).order_by(RPM_File.file.asc())
                 else:
-                    result = RPM_File.select().where(RPM_File.file.regexp(like_q)).order_by(RPM_File.file.asc())
+                    result = RPM_File.select().where(regexp_match(RPM_File.file, like_q)).order_by(RPM_File.file.asc())
+                # the literals the expression needs can be looked up in the trigram index
+                candidates = RPM_FileTrigram.candidates(regexp_literals(like_q)[1], tid)
+                if candidates is not None:
+                    result = result.where(RPM_File.id << candidates)
             else:
                 if self.options.tag:
                     result = RPM_File.select().where((RPM_File.file.contains(like_q)) & (RPM_File.tid == tid)).order_by(RPM_File.file.asc())
                 else:
                     result = RPM_File.select().where(RPM_File.file.contains(like_q)).order_by(RPM_File.file.asc())
+                # narrow things down to the files that have all of the trigrams first
+                candidates = RPM_FileTrigram.candidates(like_q, tid)
+                if candidates is not None:
+                    result = result.where(RPM_File.id << candidates)
+            # narrow things down by ownership and setuid/setgid status; these use the (tid, is_suid)
+            # and (tid, is_sgid) indexes
+            if self.options.suid:
+                result = result.where(RPM_File.is_suid == 1)
+            if self.options.sgid:
+                result = result.where(RPM_File.is_sgid == 1)
+            if self.options.user:
+                result = result.where(RPM_File.uid << RPM_User.select(RPM_User.id).where(RPM_User.user == self.options.user))
+            if self.options.group:
+                result = result.where(RPM_File.gid << RPM_Group.select(RPM_Group.id).where(RPM_Group.group == self.options.group))
 
         elif qtype == 'symbols':
-            if self.options.regexp:
-                if self.options.tag:
-                    result = RPM_Symbols.select().where((RPM_Symbols.symbols.regexp(like_q)) & (RPM_Symbols.tid == tid)).order_by(RPM_Symbols.symbols.asc())
-                else:
-                    result = RPM_Symbols.select().where(RPM_Symbols.symbols.regexp(like_q)).order_by(RPM_Symbols.symbols.asc())
+            # match against the symbol names first, then pull in the files that use them
+            if match_type == 'exact':
+                names = RPM_SymbolName.find(like_q)
+            elif match_type == 'prefix':
+                names = RPM_SymbolName.find_prefix(like_q)
+            elif self.options.regexp:
+                names = RPM_SymbolName.find_regexp(like_q)
             else:
-                if self.options.tag:
-                    result = RPM_Symbols.select().where((RPM_Symbols.symbols.contains(like_q)) & (RPM_Symbols.tid == tid)).order_by(RPM_Symbols.symbols.asc())
-                else:
-                    result = RPM_Symbols.select().where(RPM_Symbols.symbols.contains(like_q)).order_by(RPM_Symbols.symbols.asc())
+                names = RPM_SymbolName.select(RPM_SymbolName.id).where(RPM_SymbolName.name.contains(like_q))
+            result = RPM_Symbols.select(RPM_Symbols, RPM_SymbolName.name.alias('symbols')).join(RPM_SymbolName)
+            if self.options.tag:
+                result = result.where((RPM_Symbols.sid << names) & (RPM_Symbols.tid == tid))
+            else:
+                result = result.where(RPM_Symbols.sid << names)
+            result = result.order_by(RPM_SymbolName.name.asc()).naive()
 
         elif qtype == 'packages':
             if self.options.regexp:
-                if self.options.tag:
-                    result = RPM_Package.select().where((RPM_Package.package.regexp(like_q)) & (RPM_Package.tid == tid)).order_by(RPM_Package.package.asc())
-                else:
-                    result = RPM_Package.select().where(RPM_Package.package.regexp(like_q)).order_by(RPM_Package.package.asc())
+                match = regexp_match(RPM_Package.package, like_q)
             else:
-                if self.options.tag:
-                    result = RPM_Package.select().where((RPM_Package.package.contains(like_q)) & (RPM_Package.tid == tid)).order_by(RPM_Package.package.asc())
-                else:
-                    result = RPM_Package.select().where(RPM_Package.package.contains(like_q)).order_by(RPM_Package.package.asc())
+                match = RPM_Package.package.contains(like_q)
+            if self.options.tag:
+                match = match & (RPM_Package.tid == tid)
+            result = RPM_Package.latest(match).order_by(RPM_Package.package.asc())
 
-        elif qtype == 'provides':
-            if self.options.regexp:
-                if self.options.tag:
-                    result = RPM_Provides.select().where((RPM_Provides.name.regexp(like_q)) & (RPM_Provides.tid == tid)).order_by(RPM_Provides.name.asc())
-                else:
-                    result = RPM_Provides.select().where(RPM_Provides.name.regexp(like_q)).order_by(RPM_Provides.name.asc())
+        elif qtype == 'provides' or qtype == 'requires':
+            # match against the distinct names first, then pull in the packages that use them
+            if qtype == 'provides':
+                (model, names) = (RPM_Provides, RPM_ProvideName)
             else:
-                if self.options.tag:
-                    result = RPM_Provides.select().where((RPM_Provides.name.contains(like_q)) & (RPM_Provides.tid == tid)).order_by(RPM_Provides.name.asc())
-                else:
-                    result = RPM_Provides.select().where(RPM_Provides.name.contains(like_q)).order_by(RPM_Provides.name.asc())
-
-        elif qtype == 'requires':
+                (model, names) = (RPM_Requires, RPM_RequireName)
             if self.options.regexp:
-                if self.options.tag:
-                    result = RPM_Requires.select().where((RPM_Requires.name.regexp(like_q)) & (RPM_Requires.tid == tid)).order_by(RPM_Requires.name.asc())
-                else:
-                    result = RPM_Requires.select().where(RPM_Requires.name.regexp(like_q)).order_by(RPM_Requires.name.asc())
+                nids = names.select(names.id).where(regexp_match(names.name, like_q))
             else:
-                if self.options.tag:
-                    result = RPM_Requires.select().where((RPM_Requires.name.contains(like_q)) & (RPM_Requires.tid == tid)).order_by(RPM_Requires.name.asc())
-                else:
-                    result = RPM_Requires.select().where(RPM_Requires.name.contains(like_q)).order_by(RPM_Requires.name.asc())
-
-        # DEBUG: print result
-        if result:
-            if self.options.count:
+                nids = names.select(names.id).where(names.name.contains(like_q))
+            result = model.select(model, names.name.alias('name')).join(names)
+            if self.options.tag:
+                result = result.where((model.nid << nids) & (model.tid == tid))
+            else:
+                result = result.where(model.nid << nids)
+            result = result.order_by(names.name.asc()).naive()
+
+        # only ask the database for the number of matches (per tag), it does not need to send us the rows
+        if result is not None and self.options.count:
+            counts   = tag_counts(result)
+            found    = sum(x[1] for x in counts)
+            packages = sum(x[2] for x in counts)
+            if found:
                 if self.options.quiet:
-                    print len(result)
+                    print found
                 else:
                     if self.options.tag:
-                        print '%d match(es) in database for tag (%s) and %s (%s)' % (len(result), self.options.tag, match_type, like_q)
+                        print '%d match(es) in %d package(s) in database for tag (%s) and %s (%s)' % (found, packages, self.options.tag, match_type, like_q)
                     else:
-                        print '%d match(es) in database for %s (%s)' % (len(result), match_type, like_q)
+                        print '%d match(es) in %d package(s) in database for %s (%s)' % (found, packages, match_type, like_q)
+                        tags = RPM_Tag.get_names()
+                        for (ctid, matches, pkgs) in counts:
+                            print '  %-30s%d match(es) in %d package(s)' % (tags.get(ctid), matches, pkgs)
                 return
+            result = None
+
+        # pull in everything the output needs with the same query rather than looking it up
+        # for each row
+        if result is not None and qtype != 'packages':
+            model  = result.model_class
+            fields = [model, RPM_Package.package, RPM_Package.version, RPM_Package.release, RPM_Package.date,
+                      RPM_Package.srpm, RPM_Package.update.alias('pupdate')]
+            result = result.switch(model).join(RPM_Package, on=(model.pid == RPM_Package.id))
+            if qtype == 'files':
+                fields += [RPM_User.user, RPM_Group.group]
+                result  = result.switch(RPM_File).join(RPM_User, JOIN_LEFT_OUTER, on=(RPM_File.uid == RPM_User.id))
+                result  = result.switch(RPM_File).join(RPM_Group, JOIN_LEFT_OUTER, on=(RPM_File.gid == RPM_Group.id))
+                if self.options.extrainfo:
+                    fields += [RPM_Flags.relro, RPM_Flags.ssp, RPM_Flags.pie, RPM_Flags.fortify, RPM_Flags.nx]
+                    result  = result.switch(RPM_File).join(RPM_Flags, JOIN_LEFT_OUTER, on=(RPM_Flags.fid == RPM_File.id))
+            elif qtype == 'symbols':
+                fields += [RPM_SymbolName.name.alias('symbols'), RPM_File.file]
+                result  = result.switch(RPM_Symbols).join(RPM_File, on=(RPM_Symbols.fid == RPM_File.id))
+            else:
+                fields += [names.name.alias('name')]
+            result = result.select(*fields).naive()
 
+        # DEBUG: print result
+        found = 0
+        if result is not None:
+            tags = RPM_Tag.get_names()
             ltag = ''
             lsrc = ''
-            for row in result:
+            # rows are printed as they arrive rather than fetching them all first
+            for row in stream(result):
                 # DEBUG: print vars(row)
                 utype = ''
+                if qtype == 'packages':
+                    r_update = row.update
+                else:
+                    r_update = row.pupdate
+                found += 1
                 # for readability
-                package = RPM_Package.get(RPM_Package.id == row.pid)
-                r_tag   = RPM_Tag.get_tag(row.tid)
-                r_rpm   = package.package
-                r_ver   = package.version
-                r_rel   = package.release
-                r_date  = package.date
-                r_srpm  = package.srpm
+                r_tag   = tags.get(row.tid_id)
+                r_rpm   = row.package
+                r_ver   = row.version
+                r_rel   = row.release
+                r_date  = row.date
+                r_srpm  = row.srpm
 
                 # defaults, so nothing is undeclared
                 r_is_suid = ''
@@ -337,7 +462,6 @@ class Binary:
                 r_group   = ''
                 r_perms   = ''
                 r_symbol  = ''
-                r_fileid  = ''
                 r_files   = ''
 
                 if qtype == 'provides':
@@ -351,18 +475,17 @@ class Binary:
                     r_type = row.file
 
                 if qtype == 'files':
-                    r_user    = RPM_User.get_name(row.uid)
-                    r_group   = RPM_Group.get_name(row.gid)
+                    r_user    = row.user
+                    r_group   = row.group
                     r_is_suid = row.is_suid
                     r_is_sgid = row.is_sgid
                     r_perms   = row.perms
-                    r_fileid  = row.id
 
                 if qtype == 'symbols':
-                    r_files  = RPM_File.get_name(row.fid)
+                    r_files  = row.file
                     r_symbol = row.symbols
 
-                if row.update == 1:
+                if r_update == 1:
                     utype = '[update] '
 
                 if not ltag == r_tag:
@@ -396,299 +519,308 @@ class Binary:
                     else:
                         flags = None
                         if self.options.extrainfo:
-                            if qtype == 'files':
-                                flags = RPM_Flags.get_named(r_fileid)
+                            if qtype == 'files' and row.relro is not None:
+                                flags = RPM_Flags.describe(row)
                             rpm_date = datetime.datetime.fromtimestamp(float(r_date))
                             if flags:
                                 print '  %-10s%s' % ("Date :", rpm_date.strftime('%a %b %d %H:%M:%S %Y'))
                                 print '  %-10s%-10s%-12s%-10s%-12s%-10s%s' % ("Flags:", "RELRO  :", flags.relro, "SSP:", flags.ssp, "PIE:", flags.pie)
                                 print '  %-10s%-10s%-12s%-10s%s' % ("", "FORTIFY:", flags.fortify, "NX :", flags.nx)
 
-        else:
+        if not found:
             if self.options.tag:
                 print 'No matches in database for tag (%s) and %s (%s)' % (self.options.tag, match_type, like_q)
             else:
                 print 'No matches in database for %s (%s)' % (match_type, like_q)
+        elif not self.options.quiet:
+            print '\n%d match(es) in database for %s (%s)' % (found, match_type, like_q)
 
 
-    def cache_get_user(self, name):
+    def get_user_records(self, names):
         """
-        Function to look up the u_record and add it to the cache for users
+        Function to lookup, add, and cache user names; returns their ids keyed by name
         """
-        uid = RPM_User.get_id(name)
-        if uid:
-            # add to the cache
-            self.user_cache[name] = uid
-            return uid
-        else:
-            return False
+        missing = [name for name in names if name not in self.user_cache]
+        if missing:
+            self.user_cache.update(RPM_User.get_ids(missing, self.insert_chunk))
+
+        return dict((name, self.user_cache[name]) for name in names)
 
 
-    def get_user_record(self, name):
+    def get_group_records(self, names):
         """
-        Function to lookup, add, and cache user info
+        Function to lookup, add, and cache group names; returns their ids keyed by name
         """
+        missing = [name for name in names if name not in self.group_cache]
+        if missing:
+            self.group_cache.update(RPM_Group.get_ids(missing, self.insert_chunk))
 
-        # first check the cache
-        if name in self.user_cache:
-            return self.user_cache[name]
-
-        # not cached, check the database
-        uid = self.cache_get_user(name)
-        if uid:
-            return uid
-
-        # not cached, so not in the db, add it
-        try:
-            u = RPM_User.create(user = name)
-        except Exception, e:
-            logging.error('Failed to add user %s to the database!\n%s', name, e)
-            sys.exit(1)
-
-        if u:
-            # add to the cache
-            self.user_cache[name] = u.id
-            return u.id
+        return dict((name, self.group_cache[name]) for name in names)
 
 
-    def cache_get_group(self, name):
+    def get_requires_records(self, names):
         """
-        Function to look up the g_record and add it to the cache for groups
+        Function to lookup, add, and cache requires names; returns their ids keyed by name
         """
-        gid = RPM_Group.get_id(name)
-        if gid:
-            # add to the cache
-            self.group_cache[name] = gid
-            return gid
-        else:
-            return False
+        missing = [name for name in names if name not in self.requires_cache]
+        if missing:
+            self.requires_cache.update(RPM_RequireName.get_ids(missing, self.insert_chunk))
+
+        return dict((name, self.requires_cache[name]) for name in names)
 
 
-    def get_group_record(self, name):
+    def add_requires(self, tid, pid, fname):
         """
-        Function to lookup, add, and cache group info
+        Function to add requires to the database; returns the number added
         """
+        logging.debug('in Binary.add_requires(%s, %s, %s)' % (tid, pid, fname))
 
-        # first check the cache
-        if name in self.group_cache:
-            return self.group_cache[name]
+        header = self.rcommon.rpm_header(fname)
+        if not header:
+            return 0
 
-        # not cached, check the database
-        gid = self.cache_get_group(name)
-        if gid:
-            return gid
+        flist = []
+        for dep in header['requires']:
+            dep = dep.strip()
+            # skip the rpmlib and versioned glibc/gcc requirements, and adjacent duplicates
+            if not dep or self.re_reqskip.search(dep) or (flist and flist[-1] == dep):
+                continue
+            self.rcommon.show_progress()
+            if self.options.verbose:
+                print 'Dependency: %s' % dep
+            flist.append(dep)
 
-        # not cached, so not in the db, add it
+        rids = self.get_requires_records(flist)
+        rows = BulkInsert(RPM_Requires, self.insert_chunk)
         try:
-            g = RPM_Group.create(group = name)
+            for dep in flist:
+                rows.add(
+                    pid = pid,
+                    tid = tid,
+                    nid = rids[dep]
+                )
+            logging.debug('Filed %d Requires', rows.flush())
         except Exception, e:
-            logging.error('Failed to add group %s to the database!\n%s', name, e)
-            sys.exit(1)
+            logging.error('Failed to add requires %s to the database!\n%s', fname, e)
+            raise
+        return rows.count
 
-        if g:
-            # add to the cache
-            self.group_cache[name] = g.id
-            return g.id
 
-
-    def cache_get_requires(self, name):
+    def get_provides_records(self, names):
         """
-        Function to look up the rq_record and add it to the cache for requires
+        Function to lookup, add, and cache provides names; returns their ids keyed by name
         """
-        rid = RPM_Requires.get_id(name)
-        if rid:
-            # add to the cache
-            self.requires_cache[name] = rid
-            return rid
-        else:
-            return False
+        missing = [name for name in names if name not in self.provides_cache]
+        if missing:
+            self.provides_cache.update(RPM_ProvideName.get_ids(missing, self.insert_chunk))
+
+        return dict((name, self.provides_cache[name]) for name in names)
 
 
-    def get_requires_record(self, name):
+    def add_provides(self, tid, pid, fname):
         """
-        Function to lookup, add, and cache requires info
+        Function to add provides to the database; returns the number added
         """
+        logging.debug('in Binary.add_provides(%s, %s, %s)' % (tid, pid, fname))
 
-        # first check the cache
-        if name in self.requires_cache:
-            return self.requires_cache[name]
+        header = self.rcommon.rpm_header(fname)
+        if not header:
+            return 0
 
-        # not cached, check the database
-        rid = self.cache_get_requires(name)
-        if rid:
-            return rid
+        flist = []
+        for prov in header['provides']:
+            prov = prov.strip()
+            if not prov:
+                continue
+            self.rcommon.show_progress()
+            if self.options.verbose:
+                print 'Provides: %s' % prov
+            flist.append(prov)
 
-        return None
+        prids = self.get_provides_records(flist)
+        rows  = BulkInsert(RPM_Provides, self.insert_chunk)
+        try:
+            for prov in flist:
+                rows.add(
+                    pid = pid,
+                    tid = tid,
+                    nid = prids[prov]
+                )
+            logging.debug('Filed %d Provides', rows.flush())
+        except Exception, e:
+            logging.error('Failed to add provides %s to the database!\n%s', fname, e)
+            raise
+        return rows.count
 
 
-    def add_requires(self, tid, pid, fname):
+    def add_records(self, tid, pid, file_list):
         """
-        Function to add requires to the database
+        Function to add file records; returns the new file ids keyed by file name
         """
-        logging.debug('in Binary.add_requires(%s, %s, %s)' % (tid, pid, fname))
+        logging.debug('in Binary.add_records(%s, %s, %s)' % (tid, pid, file_list))
 
-        flist = commands.getoutput("rpm -qp --nosignature --requires " + self.rcommon.clean_shell(fname) + " | egrep -v '(rpmlib|GLIBC|GCC|rtld)' | uniq")
-        flist = flist.splitlines()
-        for dep in flist:
-            if dep:
+        files = BulkInsert(RPM_File, self.insert_chunk)
+        with rpm_db.atomic():
+            dids = RPM_Dirname.get_ids([os.path.split(file_list[x]['file'].strip())[0] for x in file_list.keys()], self.insert_chunk)
+            uids = self.get_user_records(set(file_list[x]['user'] for x in file_list.keys()))
+            gids = self.get_group_records(set(file_list[x]['group'] for x in file_list.keys()))
+            for x in file_list.keys():
+                fname = file_list[x]['file'].strip()
+                uid   = uids[file_list[x]['user']]
+                gid   = gids[file_list[x]['group']]
+                (dname, bname) = os.path.split(fname)
                 self.rcommon.show_progress()
                 if self.options.verbose:
-                    print 'Dependency: %s' % dep
-                rid = self.get_requires_record(dep.strip())
-                if rid:
-                    return rid
-                try:
-                    r = RPM_Requires.create(
-                        pid  = pid,
-                        tid  = tid,
-                        name = dep.strip()
-                    )
-                    return r.id
-                except Exception, e:
-                    logging.error('Failed to add requires %s to the database!\n%s', fname, e)
-
+                    print 'File: %s' % fname
+
+                files.add(
+                    tid      = tid,
+                    pid      = pid,
+                    uid      = uid,
+                    gid      = gid,
+                    file     = fname,
+                    basename = bname,
+                    did      = dids[dname],
+                    is_suid  = file_list[x]['is_suid'],
+                    is_sgid  = file_list[x]['is_sgid'],
+                    perms    = file_list[x]['perms']
+                )
+            logging.debug('Filed %d Files', files.flush())
 
-    def cache_get_provides(self, name):
-        """
-        Function to look up the pv_record and add it to the cache for provides
-        """
-        prid = RPM_Provides.get_id(name)
-        if prid:
-            # add to the cache
-            self.provides_cache[name] = prid
-            return prid
-        else:
-            return False
+        return RPM_File.get_ids(pid)
 
 
-    def get_provides_record(self, name):
+    def add_trigram_records(self, tid, pid, file_ids):
         """
-        Function to lookup, add, and cache provides info
+        Function to add the file name trigrams used to speed up file queries
         """
+        logging.debug('in Binary.add_trigram_records(%s, %s)' % (tid, pid))
 
-        # first check the cache
-        if name in self.provides_cache:
-            return self.provides_cache[name]
-
-        # not cached, check the database
-        prid = self.cache_get_provides(name)
-        if prid:
-            return prid
+        grams = BulkInsert(RPM_FileTrigram, self.insert_chunk)
+        for (fname, fid) in file_ids.items():
+            for gram in file_trigrams(fname):
+                grams.add(tid=tid, pid=pid, fid=fid, gram=gram)
+        logging.debug('Filed %d Trigrams', grams.flush())
 
-        return None
 
-
-    def add_provides(self, tid, pid, fname):
+    def add_binary_records(self, tid, pid, rpm, file_ids):
         """
-        Function to add provides to the database
+        Function to add binary symbols and flags to the database; returns the number of flag and
+        symbol records added
         """
-        logging.debug('in Binary.add_provides(%s, %s, %s)' % (tid, pid, fname))
+        logging.debug('in Binary.add_binary_records(%s, %s, %s)' % (tid, pid, rpm))
+
+        header = self.rcommon.rpm_header(rpm)
+        if not header:
+            return (0, 0)
+
+        # executable files, the same as 'find -perm /u+x -type f', with their digests
+        digests = {}
+        for f in header['files']:
+            if stat.S_ISREG(f['mode']) and f['mode'] & stat.S_IXUSR:
+                digests['/' + f['file'].lstrip('/')] = f['digest']
+        if not digests:
+            return (0, 0)
+
+        # the analysis of every file we've seen before, in any tag, is cached by its digest
+        cached  = RPM_Analysis.get_digests([d for d in digests.values() if d])
+        results = {}
+        for (nfile, digest) in digests.items():
+            if digest in cached:
+                results[nfile] = cached[digest]
+        logging.debug('%d of %d executables found in the analysis cache' % (len(results), len(digests)))
+
+        # only read the payload if there is something in it we haven't seen yet
+        analyzed = []
+        if len(results) < len(digests):
+            # hardlinked files only carry their data on the last link, so remember the names
+            links = {}
+            for member in RPMPayload(rpm, header).members():
+                if not stat.S_ISREG(member.mode) or not member.mode & stat.S_IXUSR:
+                    continue
+
+                if member.nlink > 1:
+                    names = links.setdefault(member.ino, [])
+                else:
+                    names = []
+                # need to change ./usr/sbin/foo to /usr/sbin/foo
+                names.append('/' + member.name.lstrip('.').lstrip('/'))
+                if member.size == 0:
+                    if member.nlink < 2:
+                        analyzed.append((names, None, None))
+                    continue
+
+                if all(n in results for n in names):
+                    continue
+
+                magic = member.read(4)
+                if magic != '\x7fELF':
+                    analyzed.append((names, None, None))
+                    continue
+
+                # ELF binaries; small ones are read into memory, larger ones are spooled out to
+                # a temporary file and mapped.  A truncated payload raises ValueError out of
+                # member.read(), which is left to fail the package in record_add()
+                logging.debug('checking file: %s' % member.name)
+                spool = None
+                if member.size <= self.elf_memory_max:
+                    data = magic + member.read(member.size)
+                else:
+                    spool = tempfile.TemporaryFile(prefix='rq-')
+                    spool.write(magic)
+                    while member.left:
+                        spool.write(member.read())
+                    spool.flush()
+                    data = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
 
-        flist = commands.getoutput("rpm -qp --nosignature --provides " + self.rcommon.clean_shell(fname))
-        flist = flist.splitlines()
-        for prov in flist:
-            if prov:
-                self.rcommon.show_progress()
-                if self.options.verbose:
-                    print 'Provides: %s' % prov
-                prid = self.get_provides_record(prov.strip())
-                if prid:
-                    return prid
                 try:
-                    pr = RPM_Provides.create(
-                         pid  = pid,
-                         tid  = tid,
-                         name = prov.strip()
-                    )
-                    return pr.id
+                    elf = ELFFile(data)
+                    analyzed.append((names, self.get_binary_flags(elf), self.get_binary_symbols(elf)))
                 except Exception, e:
-                    logging.error('Failed to add provides %s to the database!\n%s', fname, e)
-
-
-    def add_records(self, tid, pid, file_list):
-        """
-        Function to add file records
-        """
-        logging.debug('in Binary.add_records(%s, %s, %s)' % (tid, pid, file_list))
-
-        for x in file_list.keys():
-            fname = file_list[x]['file'].strip()
-            uid   = self.get_user_record(file_list[x]['user'])
-            gid   = self.get_group_record(file_list[x]['group'])
-            self.rcommon.show_progress()
-            if self.options.verbose:
-                print 'File: %s' % fname
-
-            try:
-                f = RPM_File.create(
-                    tid     = tid,
-                    pid     = pid,
-                    uid     = uid,
-                    gid     = gid,
-                    file    = fname,
-                    is_suid = file_list[x]['is_suid'],
-                    is_sgid = file_list[x]['is_sgid'],
-                    perms   = file_list[x]['perms']
-                )
-                logging.debug('Filed File with id %d', f.id)
-            except Exception, e:
-                logging.error('Adding file %s failed!\n%s', fname, e)
-
-
-    def add_binary_records(self, tid, pid, rpm):
-        """
-        Function to add binary symbols and flags to the database
-        """
-        logging.debug('in Binary.add_binary_records(%s, %s, %s)' % (tid, pid, rpm))
-
-        cpio_dir = tempfile.mkdtemp()
-        try:
-            current_dir = os.getcwd()
-            os.chdir(cpio_dir)
-            # explode rpm
-            command      = 'rpm2cpio "%s" | cpio -d -i 2>/dev/null' % rpm
-            (rc, output) = commands.getstatusoutput(command)
-
-            command      = 'find . -perm /u+x -type f'
-            (rc, output) = commands.getstatusoutput(command)
-
-            rdir = output.split()
-            logging.debug('dir is %s' % rdir)
-            for fname in rdir:
-                if os.path.isfile(fname):
-                    logging.debug('checking file: %s' % fname)
-                    # executable files
-                    if re.search('ELF', commands.getoutput('file ' + self.rcommon.clean_shell(fname))):
-                        # ELF binaries
-                        flags   = self.get_binary_flags(fname)
-                        symbols = self.get_binary_symbols(fname)
-                        # need to change ./usr/sbin/foo to /usr/sbin/foo and look up the file record
-                        nfile   = fname[1:]
-                        fid     = RPM_File.find_id(nfile, tid, pid)
-                        self.add_flag_records(tid, fid, pid, flags)
-                        self.add_symbol_records(tid, fid, pid, symbols)
-            os.chdir(current_dir)
-        finally:
-            logging.debug('Removing temporary directory: %s...' % cpio_dir)
-            try:
-                shutil.rmtree(cpio_dir)
-            except:
-                # if we can't remove the directory, recursively chmod and try again
-                os.system('chmod -R u+rwx ' + cpio_dir)
-                shutil.rmtree(cpio_dir)
-
-
-    def get_binary_symbols(self, bfile):
-        """
-        Function to get symbols from a binary file
+                    logging.error('Unable to read ELF file %s in %s!\n%s', member.name, rpm, e)
+                    continue
+                finally:
+                    if spool:
+                        spool.close()
+
+        # database errors are left to propagate so that record_add() can roll the package back
+        for (names, flags, symbols) in analyzed:
+            digest = digests.get(names[-1])
+            if digest:
+                if digest not in cached:
+                    cached[digest] = RPM_Analysis.add_digest(digest, flags, symbols)
+                analysis = cached[digest]
+            else:
+                # no digest in the header to cache this under
+                analysis = RPM_Analysis.new_digest(flags, symbols)
+            for name in names:
+                results[name] = analysis
+
+        nflags   = 0
+        nsymbols = 0
+        for (nfile, analysis) in results.items():
+            if not analysis.elf:
+                continue
+            fid = file_ids.get(nfile)
+            if not fid:
+                logging.debug('no file record for %s, skipping' % nfile)
+                continue
+            self.add_flag_records(tid, fid, pid, analysis.get_flags())
+            nflags   += 1
+            nsymbols += self.add_symbol_records(tid, fid, pid, analysis.get_symbols())
+        return (nflags, nsymbols)
+
+
+    def get_binary_symbols(self, elf):
+        """
+        Function to get the exported and imported dynamic symbols from a binary file (the
+        same symbols 'nm -D -g' shows)
         """
         symbols = []
 
         self.rcommon.show_progress()
 
-        nm_output = commands.getoutput('nm -D -g ' + self.rcommon.clean_shell(bfile))
-        nm_output = nm_output.split()
-        for symbol in nm_output:
+        for symbol in sorted(set([x[0] for x in elf.dynsyms if x[1] in (STB_GLOBAL, STB_WEAK, STB_GNU_UNIQUE)])):
             if re.search('^[A-Za-z_]{2}.*', symbol):
                 if symbol not in self.excluded_symbols:
                     # dump the __cxa* symbols
@@ -698,7 +830,7 @@ class Binary:
         return symbols
 
 
-    def get_binary_flags(self, bfile):
+    def get_binary_flags(self, elf):
         """
         Function to get binary flags from a file
         """
@@ -707,39 +839,38 @@ class Binary:
 
         self.rcommon.show_progress()
 
-        readelf_l = commands.getoutput('readelf -l ' + self.rcommon.clean_shell(bfile))
-        readelf_d = commands.getoutput('readelf -d ' + self.rcommon.clean_shell(bfile))
-        readelf_s = commands.getoutput('readelf -s ' + self.rcommon.clean_shell(bfile))
-        readelf_h = commands.getoutput('readelf -h ' + self.rcommon.clean_shell(bfile))
+        segments = [x[0] for x in elf.segments]
+        names    = ['%s%s' % (x[0], x[3]) for x in elf.dynsyms + elf.symtab]
 
-        if re.search('GNU_RELRO', readelf_l):
-            if re.search('BIND_NOW', readelf_d):
+        if PT_GNU_RELRO in segments:
+            # DT_BIND_NOW, or DF_BIND_NOW in DT_FLAGS
+            if 24 in elf.dynamic or [x for x in elf.dynamic.get(30, []) if x & 0x8]:
                 # full RELRO
                 flags['relro'] = 1
             else:
                 # partial RELRO
                 flags['relro'] = 2
 
-        if re.search('__stack_chk_fail', readelf_s):
+        if [x for x in names if '__stack_chk_fail' in x]:
             # found
             flags['ssp'] = 1
 
-        if re.search('GNU_STACK.*RWE', readelf_l):
+        if [x for x in elf.segments if x[0] == PT_GNU_STACK and x[1] & PF_X]:
             # disabled
             flags['nx'] = 0
 
-        if re.search('Type:( )+EXEC', readelf_h):
+        if elf.e_type == ET_EXEC:
             # none
             flags['pie'] = 0
-        elif re.search('Type:( )+DYN', readelf_h):
-            if re.search('\(DEBUG\)', readelf_d):
-                # enabled
+        elif elf.e_type == ET_DYN:
+            if 21 in elf.dynamic:
+                # DT_DEBUG; enabled
                 flags['pie'] = 1
             else:
                 # DSO
                 flags['pie'] = 2
 
-        if re.search('_chk@GLIBC', readelf_s):
+        if [x for x in names if '_chk@GLIBC' in x]:
             # found
             flags['fortify_source'] = 1
 
@@ -768,25 +899,41 @@ class Binary:
             logging.debug('Filed Flag with id %d', f.id)
         except Exception, e:
             logging.error('Adding flags for fid %d failed!\n%s', fid, e)
+            raise
+
+
+    def get_symbol_records(self, names):
+        """
+        Function to lookup, add, and cache symbol names; returns their ids keyed by name
+        """
+        missing = [name for name in names if name not in self.symbol_cache]
+        if missing:
+            self.symbol_cache.update(RPM_SymbolName.get_ids(missing, self.insert_chunk))
+
+        return dict((name, self.symbol_cache[name]) for name in names)
 
 
     def add_symbol_records(self, tid, fid, pid, symbols):
         """
-        Function to add symbol records to the database
+        Function to add symbol records to the database; returns the number added
         """
         logging.debug('in Binary.add_symbol_records(%s, %s, %s, %s)' % (tid, fid, pid, symbols))
 
-        for symbol in symbols:
-            try:
-                s = RPM_Symbols.create(
-                    pid     = pid,
-                    tid     = tid,
-                    fid     = fid,
-                    symbols = symbol
+        sids = self.get_symbol_records(symbols)
+        rows = BulkInsert(RPM_Symbols, self.insert_chunk)
+        try:
+            for symbol in symbols:
+                rows.add(
+                    pid = pid,
+                    tid = tid,
+                    fid = fid,
+                    sid = sids[symbol]
                 )
-                logging.debug('Filed Symbol with id %d', s.id)
-            except Exception, e:
-                logging.error('Adding symbol for fid %d failed!\n%s', fid, e)
+            logging.debug('Filed %d Symbols', rows.flush())
+        except Exception, e:
+            logging.error('Adding symbols for fid %d failed!\n%s', fid, e)
+            raise
+        return rows.count
 
 
     def list_updates(self, tag):
@@ -807,10 +954,24 @@ class Binary:
 
     def show_sxid(self, type, tag):
         """
-        Function to list all suid or sgid files per tag
+        Function to list all suid or sgid files per tag, from the query cache if the tag hasn't
+        changed since they were last listed
         """
         logging.debug('in Binary.show_sxid(%s, %s)' % (type, tag))
 
+        if not self.rcommon.query_cache:
+            return self.list_sxid(type, tag)
+
+        key = ('binary', 'sxid', type, tag, self.rtag.versions(tag))
+        self.rcommon.cached_output(key, self.list_sxid, type, tag)
+
+
+    def list_sxid(self, type, tag):
+        """
+        Function to list all suid or sgid files per tag from the database
+        """
+        logging.debug('in Binary.list_sxid(%s, %s)' % (type, tag))
+
         print 'Searching for %s files in tag %s\n' % (type.upper(), tag)
 
         tid = RPM_Tag.get_id(tag)
@@ -29,7 +29,14 @@ import tempfile
 import shutil
 import datetime
 from glob import glob
-from app.models import SRPM_Ctag, SRPM_Tag, SRPM_BuildRequires, SRPM_Source, SRPM_Package, SRPM_File, SRPM_AlreadySeen
+from app.models import SRPM_Ctag, SRPM_Tag, SRPM_BuildRequires, SRPM_Source, SRPM_Package, SRPM_File, SRPM_AlreadySeen, \
+    SRPM_FileTrigram, SRPM_Dirname, BulkInsert, file_trigrams, stream, tag_counts, regexp_literals, regexp_match, srpm_db
+from rq.basics import evr_sortkey
+
+# the options that change what a query prints; only these are part of its query cache key, so
+# options such as --progress or --jobs don't keep the same query from being found
+QUERY_OPTIONS = ('query', 'buildreqs', 'ctags', 'match', 'regexp', 'tag', 'count', 'quiet', 'extrainfo',
+                 'sourceonly')
 
 class Source:
     """
@@ -54,10 +61,14 @@ class Source:
                            'subroutine': 1,
                            'class'     : 2,
                            'method'    : 3}
+        self.ctag_rmap  = dict((v, k) for k, v in self.ctag_map.iteritems())
 
         # caches
         self.breq_cache = {}
 
+        # rows per multi-row insert
+        self.insert_chunk = int(config.get('insert_chunk', 500))
+
 
     def patch_list(self, patchfile):
         """
@@ -161,13 +172,28 @@ class Source:
 
 
     def query(self, qtype):
+        """
+        Function to run the query for source RPMs, or to show its output from the query cache
+        if the tags it covers haven't changed since it was last run
+        """
+        logging.debug('in Source.query(%s)' % qtype)
+
+        if not self.rcommon.query_cache:
+            return self.run_query(qtype)
+
+        options = [(name, getattr(self.options, name, None)) for name in QUERY_OPTIONS]
+        key     = ('source', 'query', qtype, options, self.rtag.versions(self.options.tag))
+        self.rcommon.cached_output(key, self.run_query, qtype)
+
+
+    def run_query(self, qtype):
         # TODO: we need to add options to only search updates, only search releases, or omit either/or
         # or we need to decide to filter out release packages and only show updates if both exist (maybe
         # default to showing only updates with a --include-release option or something)
         """
-        Function to run the query for source RPMs
+        Function to run the query for source RPMs against the database
         """
-        logging.debug('in Source.query(%s)' % qtype)
+        logging.debug('in Source.run_query(%s)' % qtype)
 
         t = self.rtag.lookup(self.options.tag)
         if self.options.tag and not t:
@@ -192,6 +218,8 @@ class Source:
 
         if self.options.regexp:
             match_type = 'regexp'
+        elif qtype == 'files' and self.options.match != 'substring':
+            match_type = self.options.match
         else:
             match_type = 'substring'
 
@@ -202,9 +230,9 @@ class Source:
         if qtype == 'ctags':
             if self.options.regexp:
                 if self.options.tag:
-                    result = SRPM_Ctag.select().where((SRPM_Ctag.name.regexp(like_q)) & (SRPM_Ctag.tid == tid)).order_by(SRPM_Ctag.file.asc())
+                    result = SRPM_Ctag.select().where(regexp_match(SRPM_Ctag.name, like_q) & (SRPM_Ctag.tid == tid)).order_by(SRPM_Ctag.file.asc())
                 else:
-                    result = SRPM_Ctag.select().where(SRPM_Ctag.name.regexp(like_q)).order_by(SRPM_Ctag.file.asc())
+                    result = SRPM_Ctag.select().where(regexp_match(SRPM_Ctag.name, like_q)).order_by(SRPM_Ctag.file.asc())
             else:
                 if self.options.tag:
                     result = SRPM_Ctag.select().where((SRPM_Ctag.name.contains(like_q)) & (SRPM_Ctag.tid == tid)).order_by(SRPM_Ctag.file.asc())
@@ -214,9 +242,9 @@ class Source:
         elif qtype == 'buildreqs':
             if self.options.regexp:
                 if self.options.tag:
-                    result = SRPM_BuildRequires.select().where((SRPM_BuildRequires.name.regexp(like_q)) & (SRPM_BuildRequires.tid == tid)).order_by(SRPM_BuildRequires.name.asc())
+                    result = SRPM_BuildRequires.select().where(regexp_match(SRPM_BuildRequires.name, like_q) & (SRPM_BuildRequires.tid == tid)).order_by(SRPM_BuildRequires.name.asc())
                 else:
-                    result = SRPM_BuildRequires.select().where(SRPM_BuildRequires.name.regexp(like_q)).order_by(SRPM_BuildRequires.name.asc())
+                    result = SRPM_BuildRequires.select().where(regexp_match(SRPM_BuildRequires.name, like_q)).order_by(SRPM_BuildRequires.name.asc())
             else:
                 if self.options.tag:
                     result = SRPM_BuildRequires.select().where((SRPM_BuildRequires.name.contains(like_q)) & (SRPM_BuildRequires.tid == tid)).order_by(SRPM_BuildRequires.name.asc())
@@ -224,16 +252,36 @@ class Source:
                     result = SRPM_BuildRequires.select().where(SRPM_BuildRequires.name.contains(like_q)).order_by(SRPM_BuildRequires.name.asc())
 
         elif qtype == 'files':
-            if self.options.regexp:
+            # exact matches on the file name, or the whole path, are index lookups
+            if match_type == 'basename':
+                result = SRPM_File.select().where(SRPM_File.basename == like_q)
+                if self.options.tag:
+                    result = result.where(SRPM_File.tid == tid)
+                result = result.order_by(SRPM_File.file.asc())
+            elif match_type == 'path':
+                (dname, bname) = os.path.split(like_q)
+                result = SRPM_File.select().where((SRPM_File.basename == bname) & (SRPM_File.did << SRPM_Dirname.find(dname)))
                 if self.options.tag:
-                    result = SRPM_File.select().where((SRPM_File.file.regexp(like_q)) & (SRPM_File.tid == tid)).order_by(SRPM_File.file.asc())
+                    result = result.where(SRPM_File.tid == tid)
+                result = result.order_by(SRPM_File.file.asc())
+            elif self.options.regexp:
+                if self.options.tag:
+                    result = SRPM_File.select().where(regexp_match(SRPM_File.file, like_q) & (SRPM_File.tid == tid)).order_by(SRPM_File.file.asc())
                 else:
-                    result = SRPM_File.select().where(SRPM_File.file.regexp(like_q)).order_by(SRPM_File.file.asc())
+                    result = SRPM_File.select().where(regexp_match(SRPM_File.file, like_q)).order_by(SRPM_File.file.asc())
+                # the literals the expression needs can be looked up in the trigram index
+                candidates = SRPM_FileTrigram.candidates(regexp_literals(like_q)[1], tid)
+                if candidates is not None:
+                    result = result.where(SRPM_File.id << candidates)
             else:
                 if self.options.tag:
                     result = SRPM_File.select().where((SRPM_File.file.contains(like_q)) & (SRPM_File.tid == tid)).order_by(SRPM_File.file.asc())
                 else:
                     result = SRPM_File.select().where(SRPM_File.file.contains(like_q)).order_by(SRPM_File.file.asc())
+                # narrow things down to the files that have all of the trigrams first
+                candidates = SRPM_FileTrigram.candidates(like_q, tid)
+                if candidates is not None:
+                    result = result.where(SRPM_File.id << candidates)
 
 
         #TODO: need to make joins work somehow and reduce the above; need to be able to look for sources only
@@ -259,28 +307,51 @@ class Source:
         #
         # we could do this with different command-line options to search either files or patches, but then we have
         # a lot of silly options, so we can make the program smart enough to figure this out eventually
-        if result:
-            if self.options.count:
+        # only ask the database for the number of matches (per tag), it does not need to send us the rows
+        if result is not None and self.options.count:
+            counts   = tag_counts(result)
+            found    = sum(x[1] for x in counts)
+            packages = sum(x[2] for x in counts)
+            if found:
                 if self.options.quiet:
-                    print len(result)
+                    print found
                 else:
                     if self.options.tag:
-                        print '%d match(es) in database for tag (%s) and %s ("%s")' % (len(result), self.options.tag, match_type, like_q)
+                        print '%d match(es) in %d package(s) in database for tag (%s) and %s ("%s")' % (found, packages, self.options.tag, match_type, like_q)
                     else:
-                        print '%d match(es) in database for %s ("%s")' % (len(result), match_type, like_q)
+                        print '%d match(es) in %d package(s) in database for %s ("%s")' % (found, packages, match_type, like_q)
+                        tags = SRPM_Tag.get_names()
+                        for (ctid, matches, pkgs) in counts:
+                            print '  %-30s%d match(es) in %d package(s)' % (tags.get(ctid), matches, pkgs)
                 return
-
+            result = None
+
+        # fetch the package and source columns alongside each match rather than looking them up per row
+        if result is not None:
+            model  = result.model_class
+            fields = [model, SRPM_Package.package, SRPM_Package.version, SRPM_Package.release, SRPM_Package.date,
+                      SRPM_Package.update.alias('pupdate')]
+            result = result.switch(model).join(SRPM_Package, on=(model.pid == SRPM_Package.id))
+            if qtype != 'buildreqs':
+                fields += [SRPM_Source.stype, SRPM_Source.file.alias('sfile')]
+                result  = result.switch(model).join(SRPM_Source, on=(model.sid == SRPM_Source.id))
+            result = result.select(*fields).naive()
+
+        found = 0
+        if result is not None:
+            tags = SRPM_Tag.get_names()
             ltag = ''
             last = ''
-            for row in result:
+            # rows are printed as they arrive rather than fetching them all first
+            for row in stream(result):
+                found += 1
                 utype = ''
                 # for readability
-                package = SRPM_Package.get(SRPM_Package.id == row.pid)
-                r_tag   = SRPM_Tag.get_tag(row.tid)
-                r_rpm   = package.package
-                r_ver   = package.version
-                r_rel   = package.release
-                r_date  = package.date
+                r_tag   = tags.get(row.tid_id)
+                r_rpm   = row.package
+                r_ver   = row.version
+                r_rel   = row.release
+                r_date  = row.date
 
                 # defaults, so nothing is undeclared
                 r_ctype  = ''
@@ -292,17 +363,16 @@ class Source:
                     r_type = 'S'
                     r_breq = row.name
                 else:
-                    source  = SRPM_Source.get(SRPM_Source.id == row.sid)
-                    r_type  = source.stype
+                    r_type  = row.stype
                     r_file  = row.file
-                    r_sfile = source.file
+                    r_sfile = row.sfile
 
                 if qtype == 'ctags':
-                    r_ctype  = [k for k, v in self.ctag_map.iteritems() if v == row.ctype][0]
+                    r_ctype  = self.ctag_rmap.get(row.ctype, '')
                     r_cline  = row.line
                     r_cextra = row.extra
 
-                if row.update == 1:
+                if row.pupdate == 1:
                     utype = '[update] '
 
                 if not ltag == r_tag:
@@ -339,11 +409,13 @@ class Source:
                 if qtype == 'ctags':
                     last = r_file
 
-        else:
+        if not found:
             if self.options.tag:
                 print 'No matches in database for tag (%s) and %s ("%s")' % (self.options.tag, match_type, like_q)
             else:
                 print 'No matches in database for %s ("%s")' % (match_type, like_q)
+        elif not self.options.quiet:
+            print '\n%d match(es) in database for %s ("%s")' % (found, match_type, like_q)
 
 
     def examine(self, srpm):
@@ -393,10 +465,24 @@ class Source:
 
     def showinfo(self):
         """
-        Display all known information on a srpm
+        Display all known information on a srpm, from the query cache if the tags haven't changed
+        since it was last shown
         """
         logging.debug('in Source.showinfo()')
 
+        if not self.rcommon.query_cache:
+            return self.show_srpm_info()
+
+        key = ('source', 'showinfo', self.options.showinfo, self.options.tag, self.rtag.versions(self.options.tag))
+        self.rcommon.cached_output(key, self.show_srpm_info)
+
+
+    def show_srpm_info(self):
+        """
+        Display all known information on a srpm from the database
+        """
+        logging.debug('in Source.show_srpm_info()')
+
         t = self.rtag.lookup(self.options.tag)
         if self.options.tag and not t:
             print 'Tag %s is not a known tag!\n' % self.options.tag
@@ -407,42 +493,51 @@ class Source:
         srpm = self.options.showinfo
         print 'Displaying all known information on srpm "%s"\n' % srpm
 
+        result = SRPM_Package.select(SRPM_Package, SRPM_Tag.tag.alias('tagname'), SRPM_Tag.path).join(SRPM_Tag, on=(SRPM_Package.tid == SRPM_Tag.id))
         if self.options.tag:
-            result = SRPM_Package.select().where((SRPM_Package.package == srpm) & (SRPM_Package.tid == tid)).order_by(SRPM_Package.tid.asc())
+            result = result.where((SRPM_Package.package == srpm) & (SRPM_Package.tid == tid))
         else:
-            result = SRPM_Package.select().where(SRPM_Package.package == srpm).order_by(SRPM_Package.tid.asc())
+            result = result.where(SRPM_Package.package == srpm)
+        result = list(result.order_by(SRPM_Package.tid.asc()).naive())
 
         if not result:
             print 'No matches found for package %s' % srpm
             sys.exit(0)
 
+        # fetch the sources and buildrequires of every matching package at once
+        pids     = [row.id for row in result]
+        sources  = {}
+        breqs    = {}
+        for pid, sfile in SRPM_Source.select(SRPM_Source.pid, SRPM_Source.file).where(SRPM_Source.pid << pids).order_by(SRPM_Source.stype.desc()).tuples():
+            sources.setdefault(pid, []).append(sfile)
+        for pid, name in SRPM_BuildRequires.select(SRPM_BuildRequires.pid, SRPM_BuildRequires.name).where(SRPM_BuildRequires.pid << pids).order_by(SRPM_BuildRequires.name.asc()).tuples():
+            breqs.setdefault(pid, []).append(name)
+
         for row in result:
-            tag = SRPM_Tag.get(SRPM_Tag.id == row.tid)
             print 'Results for package %s-%s-%s' % (row.package, row.version, row.release)
-            print '  Tag: %-20s Source path: %s' % (tag.tag, tag.path)
+            print '  Tag: %-20s Source path: %s' % (row.tagname, row.path)
 
-            results = SRPM_Source.select().where(SRPM_Source.pid == row.id).order_by(SRPM_Source.stype.desc())
-            if results:
+            if row.id in sources:
                 print ''
                 print '  Source RPM contains the following source files:'
-                for xrow in results:
-                    print '  %s' % xrow.file
+                for xrow in sources[row.id]:
+                    print '  %s' % xrow
 
-            results = SRPM_BuildRequires.select().where(SRPM_BuildRequires.pid == row.id).order_by(SRPM_BuildRequires.name.asc())
-            if results:
+            if row.id in breqs:
                 print ''
                 print '  Source RPM has the following BuildRequires:'
-                for xrow in results:
-                    print '  %s' % xrow.name
+                for xrow in breqs[row.id]:
+                    print '  %s' % xrow
             print ''
 
 
     def add_records(self, tid, pid, file_list):
         """
-        Function to add source records
+        Function to add source records; returns the number added
         """
         logging.debug('in Source.add_records(%s, %s, %s)' % (tid, pid, file_list))
 
+        added = 0
         for x in file_list.keys():
             # remove any possible paths from source files; may be due to rpm5
             sfile = file_list[x]['file'].split('/')[-1]
@@ -469,16 +564,21 @@ class Source:
                     file  = sfile.strip()
                 )
                 logging.debug('Filed Source with id %d', s.id)
+                added += 1
             except Exception, e:
-                logging.error('Adding source file %s failed!\n%s', file, e)
+                logging.error('Adding source file %s failed!\n%s', sfile, e)
+                raise
+        return added
 
 
     def add_file_records(self, tid, pid, file_list):
         """
-        Function to add all source file records
+        Function to add all source file records; returns the number added
         """
         logging.debug('in Source.add_file_records(%s, %s, %s)' % (tid, pid, file_list))
 
+        records = BulkInsert(SRPM_File, self.insert_chunk)
+
         for x in file_list.keys():
             good_src = False
             # file_list may contain paths, so strip them; may be due to rpm5
@@ -505,6 +605,7 @@ class Source:
                     logging.critical('adding files from %s failed...' % sfile)
                     sys.exit(1)
 
+                wanted = []
                 for dfile in files:
                     break_loop = False
                     if dfile.endswith('/'):     # skip directories
@@ -518,31 +619,48 @@ class Source:
                         if break_loop:
                             pass
                         else:
-                            self.rcommon.show_progress()
-                            if self.options.verbose:
-                                print 'File: %s' % dfile
-                            try:
-                                f = SRPM_File.create(
-                                    tid  = tid,
-                                    pid  = pid,
-                                    sid  = sid,
-                                    file = dfile
-                                )
-                                logging.debug('Filed File with id %d', f.id)
-                            except Exception, e:
-                                logging.error('Adding file %s failed!\n%s', dfile, e)
+                            wanted.append(dfile)
+
+                dids = SRPM_Dirname.get_ids([os.path.split(dfile)[0] for dfile in wanted], self.insert_chunk)
+                for dfile in wanted:
+                    (dname, bname) = os.path.split(dfile)
+                    self.rcommon.show_progress()
+                    if self.options.verbose:
+                        print 'File: %s' % dfile
+                    records.add(
+                        tid      = tid,
+                        pid      = pid,
+                        sid      = sid,
+                        file     = dfile,
+                        basename = bname,
+                        did      = dids[dname]
+                    )
 
             else:
                 logging.debug('unwilling to process: %s' % sfile)
 
+        added = records.flush()
+        logging.debug('Filed %d Files', added)
+
+        # file name trigrams, used to speed up file queries; the same name can come from more
+        # than one source, so go by the rows rather than the names
+        grams = BulkInsert(SRPM_FileTrigram, self.insert_chunk)
+        for (fid, dfile) in SRPM_File.select(SRPM_File.id, SRPM_File.file).where(SRPM_File.pid == pid).tuples():
+            for gram in file_trigrams(dfile):
+                grams.add(tid=tid, pid=pid, fid=fid, gram=gram)
+        logging.debug('Filed %d Trigrams', grams.flush())
+        return added
+
 
     def add_ctag_records(self, tid, pid, cpio_dir):
         """
         Function to run ctags against an unpacked source directory
-        and insert records into the database
+        and insert records into the database; returns the number added
         """
         logging.debug('in Source.add_ctag_records(%s, %s, %s)' % (tid, pid, cpio_dir))
 
+        added = 0
+
         # this is likely a double chdir, but let's make sure we're in the right place
         # so we don't have to strip out the path from the ctags output
         os.chdir(cpio_dir)
@@ -610,8 +728,10 @@ class Source:
                                 extra = extra
                             )
                             logging.debug('Filed Ctag with id %d', c.id)
+                            added += 1
                         except Exception, e:
                             logging.error('Adding ctag %s for file %s failed!\n%s', name, fname, e)
+                            raise
 
                 os.chdir(cpio_dir)
 
@@ -626,10 +746,12 @@ class Source:
                     os.system('chmod -R u+rwx ' + tmpdir)
                     shutil.rmtree(tmpdir)
 
+        return added
+
 
     def add_buildreq_records(self, tid, pid, cpio_dir):
         """
-        Get the build requirements for this package from the spec file
+        Get the build requirements for this package from the spec file; returns the number added
         """
         logging.debug('in Source.add_buildreq_records(%s, %s, %s)' % (tid, pid, cpio_dir))
 
@@ -725,9 +847,12 @@ class Source:
                 logging.debug('Filed BuildRequires with id %d', b.id)
             except Exception, e:
                 logging.error('Unable to add buildrequires %s to database!\n%s', require, e)
+                raise
 
+        added = len(r)
         # make sure its empty
         del r[:]
+        return added
 
 
     def cache_get_buildreq(self, name):
@@ -762,7 +887,7 @@ class Source:
 
     def rpm_add_directory(self, tag, path, updatepath):
         """
-        Function to import a directory full of source RPMs
+        Function to import a directory full of source RPMs; returns the number of packages that failed
         """
         logging.debug('in Source.rpm_add_directory(%s, %s, %s)' % (tag, path, updatepath))
 
@@ -796,16 +921,20 @@ class Source:
             logging.critical('Unable to add tag "%s" to the database!' % tag)
             sys.exit(1)
 
+        to_add = []
         for fname in file_list:
             if not os.path.isfile(fname):
                 print 'File %s not found!\n' % fname
             elif not self.re_srpm.search(fname):
                 print 'File %s is not a source rpm!\n' % fname
             else:
-                self.record_add(tag_id, fname)
+                to_add.append(fname)
+
+        failed = self.rcommon.pool_add(self, srpm_db, tag_id, to_add)
 
         # make sure its empty
         del file_list[:]
+        return failed
 
 
     def record_add(self, tag_id, fname, update=0):
@@ -822,29 +951,41 @@ class Source:
 
         self.rcommon.file_rpm_check(fname)
 
-        record = self.package_add_record(tag_id, fname, update)
-        if not record:
-            return
-
-        file_list = self.rcommon.rpm_list(fname)
-        if not file_list:
-            return
-
-        logging.debug('Add source records for package record: %s' % record)
-        self.add_records(tag_id, record, file_list)
-        cpio_dir = tempfile.mkdtemp()
-
+        # everything for one package goes in a single transaction so that a failure part way
+        # through doesn't leave a half-populated package behind for in_db() to find
+        current_dir = os.getcwd()
         try:
-            current_dir = os.getcwd()
-            os.chdir(cpio_dir)
-            self.get_all_files(fname)
-            self.add_file_records(tag_id, record, file_list)
-            self.add_ctag_records(tag_id, record, cpio_dir)
-            self.add_buildreq_records(tag_id, record, cpio_dir)
-            os.chdir(current_dir)
-        finally:
-            logging.debug('Removing temporary directory: %s...' % cpio_dir)
-            shutil.rmtree(cpio_dir)
+            with srpm_db.atomic():
+                record = self.package_add_record(tag_id, fname, update)
+                if not record:
+                    return
+
+                # the records added, for the counters of the tag
+                counts    = {'packages': 1, 'updates': int(update), 'bytes': os.path.getsize(fname)}
+                file_list = self.rcommon.rpm_list(fname)
+                if file_list:
+                    logging.debug('Add source records for package record: %s' % record)
+                    counts['sources'] = self.add_records(tag_id, record, file_list)
+                    cpio_dir = tempfile.mkdtemp()
+
+                    try:
+                        os.chdir(cpio_dir)
+                        self.get_all_files(fname)
+                        counts['files']     = self.add_file_records(tag_id, record, file_list)
+                        counts['ctags']     = self.add_ctag_records(tag_id, record, cpio_dir)
+                        counts['buildreqs'] = self.add_buildreq_records(tag_id, record, cpio_dir)
+                    finally:
+                        os.chdir(current_dir)
+                        logging.debug('Removing temporary directory: %s...' % cpio_dir)
+                        shutil.rmtree(cpio_dir)
+                self.rtag.count_added(tag_id, counts)
+        except Exception, e:
+            # the cached ids may refer to rows that were just rolled back
+            self.breq_cache = {}
+            logging.error('Adding %s failed, all changes for it were rolled back!\n%s', fname, e)
+            if self.options.progress:
+                sys.stdout.write(' failed\n')
+            raise
 
         if self.options.progress:
             sys.stdout.write('\n')
@@ -857,13 +998,14 @@ class Source:
         logging.debug('in Source.package_add_record(%s, %s, %d)' % (tid, fname, update))
 
         name    = os.path.basename(fname)
-        rpmtags = commands.getoutput("rpm -qp --nosignature --qf '%{NAME}|%{VERSION}|%{RELEASE}|%{BUILDTIME}' " + self.rcommon.clean_shell(fname))
-        tlist   = rpmtags.split('|')
-        logging.debug("tlist is %s " % tlist)
-        package = tlist[0].strip()
-        version = tlist[1].strip()
-        release = tlist[2].strip()
-        pdate   = tlist[3].strip()
+        header  = self.rcommon.rpm_header(fname)
+        if not header:
+            raise ValueError('unable to read the package header')
+
+        package = header['name']
+        version = header['version']
+        release = header['release']
+        pdate   = header['buildtime']
 
         tag   = SRPM_Tag.get_tag(tid)
 
@@ -875,20 +1017,18 @@ class Source:
         # TODO: sure makes it easier to sort alphabetically and I'm too lazy for the JOINs right now
 
         self.rcommon.show_progress(name)
-        try:
-            p = SRPM_Package.create(
-                tid      = tid,
-                package  = package,
-                version  = version,
-                release  = release,
-                date     = pdate,
-                fullname = fname,
-                update   = update
-            )
-            return p.id
-        except Exception, e:
-            logging.error('Adding file %s failed!\n%s', fname, e)
-            return 0
+        p = SRPM_Package.create(
+            tid      = tid,
+            package  = package,
+            version  = version,
+            release  = release,
+            date     = pdate,
+            fullname = fname,
+            update   = update,
+            sortkey  = evr_sortkey(header['epoch'], version, release),
+            size     = os.path.getsize(fname)
+        )
+        return p.id
 
 
     def list_updates(self, tag):
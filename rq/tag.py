@@ -24,11 +24,13 @@ import sys
 import datetime
 import logging
 import os
-import commands
 from glob import glob
+from peewee import fn, MySQLDatabase
 from app.models import RPM_Tag, RPM_Package, RPM_Requires, RPM_Provides, RPM_File, RPM_Flags, RPM_Symbols, \
-    RPM_AlreadySeen, SRPM_Package, SRPM_Tag, SRPM_BuildRequires, SRPM_Ctag, SRPM_Source, SRPM_File, SRPM_AlreadySeen, \
-    rpm_db, srpm_db
+    RPM_AlreadySeen, RPM_FileTrigram, RPM_TagCounts, SRPM_Package, SRPM_Tag, SRPM_BuildRequires, SRPM_Ctag, \
+    SRPM_Source, SRPM_File, SRPM_AlreadySeen, SRPM_FileTrigram, SRPM_TagCounts, RPM_Schema, SRPM_Schema, \
+    SCHEMA_VERSION, schema_version, rpm_db, srpm_db
+from rq.basics import evr_sortkey, evr_compare
 
 
 class Tag:
@@ -44,6 +46,9 @@ class Tag:
         self.rcommon = rcommon
         self.options = options
 
+        # number of packages removed per transaction when purging
+        self.purge_chunk = int(config.get('purge_chunk', 100))
+
     def list(self):
         """
         Function to show database tags.
@@ -58,10 +63,11 @@ class Tag:
             results = SRPM_Tag.get_list()
 
         if results:
+            counts = self.get_counts()
             for row in results:
                 updated = ''
-                c_pkgs  = row.package_count
-                c_upd   = row.update_count
+                c_pkgs  = counts[row.id].packages
+                c_upd   = counts[row.id].updates
                 if row.update_date:
                     updated = ' / Updated: %s' % row.update_date
                 print 'Tag: %-22sPackages: %-15sUpdates: %s\n  Added: %-18s%s\n  Path       : %s\n  Update Path: %s\n' % (
@@ -96,6 +102,22 @@ class Tag:
             return SRPM_Tag.info(tag)
 
 
+    def versions(self, tag=None):
+        """
+        Function to return the state of a tag, or of all tags, for the query cache (see
+        Common.cached_output()); this changes whenever packages are added, updated or removed
+
+        :param tag: the tag name to lookup
+        :return: list
+        """
+        logging.debug('in Tag.versions(%s)' % tag)
+
+        if self.type == 'binary':
+            return RPM_Tag.get_versions(tag)
+        else:
+            return SRPM_Tag.get_versions(tag)
+
+
     def add_record(self, tag, path_to_tag, updatepath):
         """
         Add a new tag record to the database.  Returns the ID of the newly created tag, otherwise returns 0
@@ -133,6 +155,7 @@ class Tag:
                     update_path = updatepath.strip(),
                     tdate       = cur_date
                 )
+                RPM_TagCounts.create(tid=t.id)
             else:
                 t = SRPM_Tag.create(
                     tag         = tag.strip(),
@@ -140,6 +163,7 @@ class Tag:
                     update_path = updatepath.strip(),
                     tdate       = cur_date
                 )
+                SRPM_TagCounts.create(tid=t.id)
             return t.id
         except Exception, e:
             logging.error('Adding tag %s failed!\n%s', tag, e)
@@ -167,7 +191,7 @@ class Tag:
                 t = RPM_Tag.get(RPM_Tag.tag == tag)
             else:
                 t = SRPM_Tag.get(SRPM_Tag.tag == tag)
-            result = t.package_count
+            result = self.get_counts()[t.id].packages
 
             if result:
                 if result == 1:
@@ -184,21 +208,145 @@ class Tag:
                     self.optimize_db()
 
                 # now delete the tag entry itself
-                if self.type == 'binary':
-                    RPM_Flags.delete_tags(tid['id'])
-                    RPM_Symbols.delete_tags(tid['id'])
-                else:
-                    print 'deleting sources'
-                    SRPM_Ctag.delete_tags(tid['id'])
-                    SRPM_File.delete_tags(tid['id'])
-
-                t.delete_instance(recursive=True)
+                self.purge_tag(tid['id'])
 
                 sys.stdout.write(' done\n')
             else:
                 sys.stdout.write('No matching package tags to remove.\n')
 
 
+    def purge_models(self):
+        """
+        Returns the package, alreadyseen and tag models and the database for this type, and the
+        models holding per-package rows in the order they must be deleted in
+        """
+        if self.type == 'binary':
+            return (RPM_Package, RPM_AlreadySeen, RPM_Tag, rpm_db,
+                    [RPM_Symbols, RPM_Flags, RPM_FileTrigram, RPM_File, RPM_Requires, RPM_Provides])
+        else:
+            return (SRPM_Package, SRPM_AlreadySeen, SRPM_Tag, srpm_db,
+                    [SRPM_Ctag, SRPM_FileTrigram, SRPM_File, SRPM_Source, SRPM_BuildRequires])
+
+
+    def count_models(self):
+        """
+        Returns the per-tag counters model for this type, and the models whose records it counts
+        keyed by the name of their counter
+        """
+        if self.type == 'binary':
+            return (RPM_TagCounts, [('files', RPM_File), ('requires', RPM_Requires), ('provides', RPM_Provides),
+                                    ('flags', RPM_Flags), ('symbols', RPM_Symbols)])
+        else:
+            return (SRPM_TagCounts, [('files', SRPM_File), ('sources', SRPM_Source), ('ctags', SRPM_Ctag),
+                                     ('buildreqs', SRPM_BuildRequires)])
+
+
+    def count_added(self, tid, counts):
+        """
+        Function to add the records of a package to the counters of its tag.  Every import
+        updates the same counters row, so callers should make this the last statement of the
+        package transaction to hold its lock for as short a time as possible
+
+        :param tid: the tag id the package is in
+        :param counts: dict of the number of records added, keyed by the name of their counter
+        """
+        logging.debug('in Tag.count_added(%s, %s)' % (tid, counts))
+
+        (counts_model, tables) = self.count_models()
+        counts_model.add(tid, counts)
+
+
+    def get_counts(self):
+        """
+        Function to return the counters of every tag, keyed by tag id.  Tags from before counters
+        were kept have theirs worked out from the records first
+
+        :return: dict
+        """
+        logging.debug('in Tag.get_counts()')
+
+        (package, seen, tag, db, children) = self.purge_models()
+        (counts, tables) = self.count_models()
+
+        rows    = dict((row.tid_id, row) for row in counts.select())
+        missing = [tid for (tid,) in tag.select(tag.id).tuples() if tid not in rows]
+        if missing:
+            stats = self.tag_stats()
+            with db.atomic():
+                for tid in missing:
+                    logging.info('Counting the records of tag %s' % tid)
+                    rows[tid] = counts.create(tid=tid, **dict((name, stats[name].get(tid, 0)) for name in stats))
+        return rows
+
+
+    def purge_packages(self, tid, pids):
+        """
+        Delete packages and everything that belongs to them, purge_chunk packages at a time with
+        each chunk in its own transaction so we don't hold locks for the whole run
+
+        :param tid: the tag id the packages are in
+        :param pids: list of package ids to remove
+        :return: int (number of packages removed)
+        """
+        logging.debug('in Tag.purge_packages(%s, %s)' % (tid, pids))
+
+        (package, seen, tag, db, children) = self.purge_models()
+        (counts, tables) = self.count_models()
+        counted = dict((model, name) for (name, model) in tables)
+        cache   = self.rcommon.header_cache
+        if cache:
+            t = tag.get(tag.id == tid)
+
+        removed = 0
+        for x in xrange(0, len(pids), self.purge_chunk):
+            chunk = pids[x:x + self.purge_chunk]
+            if cache:
+                # the cached headers of packages that are gone are of no more use
+                for (fullname, update) in package.select(package.fullname, package.update).where(package.id << chunk).tuples():
+                    cache.invalidate(os.path.join(t.update_path if update else t.path, fullname))
+            with db.atomic():
+                (packages, updates, size) = package.select(fn.COUNT(package.id), fn.SUM(package.update),
+                                                           fn.SUM(package.size)).where(package.id << chunk).tuples().get()
+                changes = {'packages': -packages, 'updates': -int(updates or 0), 'bytes': -int(size or 0)}
+                for model in children:
+                    count = model.delete().where(model.pid << chunk).execute()
+                    logging.debug('Removed %d rows from %s' % (count, model._meta.db_table))
+                    if model in counted:
+                        changes[counted[model]] = -count
+                removed += package.delete().where(package.id << chunk).execute()
+                # last, so the shared counters row is locked only briefly
+                counts.add(tid, changes)
+            self.rcommon.show_progress()
+
+        return removed
+
+
+    def purge_tag(self, tid):
+        """
+        Delete a tag and everything that belongs to it
+
+        :param tid: the tag id to remove
+        :return: int (number of packages removed)
+        """
+        logging.debug('in Tag.purge_tag(%s)' % tid)
+
+        (package, seen, tag, db, children) = self.purge_models()
+
+        pids    = [pid for (pid,) in package.select(package.id).where(package.tid == tid).tuples()]
+        removed = self.purge_packages(tid, pids)
+
+        (counts, tables) = self.count_models()
+        with db.atomic():
+            # anything left over from an interrupted import
+            for model in children:
+                model.delete().where(model.tid == tid).execute()
+            seen.delete().where(seen.tid == tid).execute()
+            counts.delete().where(counts.tid == tid).execute()
+            tag.delete().where(tag.id == tid).execute()
+
+        return removed
+
+
     def optimize_db(self):
         """
         Optimize the database
@@ -227,21 +375,43 @@ class Tag:
         sys.stdout.write(' done\n')
 
 
+    def check_schema(self):
+        """
+        Make sure the database was created by this version; older databases lack (or have empty)
+        columns that the queries rely on, so their answers would be silently incomplete
+        :return: True if the database can be used, False otherwise
+        """
+        logging.debug('in Tag.check_schema()')
+
+        if self.type == 'binary':
+            version = schema_version(RPM_Schema)
+        else:
+            version = schema_version(SRPM_Schema)
+
+        if version < SCHEMA_VERSION:
+            logging.critical('The database was created by an older version (schema %d, expected %d)!' % (version, SCHEMA_VERSION))
+            logging.critical('Drop its tables, recreate them with create_database.py and import the tags again.')
+            return False
+        return True
+
+
     def update_entries(self, rq, tag, listonly=False):
         """
         Update entries for a given tag (for rqs)
         :param rq:
         :param tag:
         :param listonly:
-        :return:
+        :return: int (number of packages that failed to be added)
         """
         logging.debug('in Tag.update_entries(%s, %s)' % (tag, listonly))
 
         to_remove = []
         to_add    = []
         have_seen = []
+        headers   = {}
         updates   = 0
         newpkgs   = 0
+        failed    = 0
         the_tag   = None
 
         if self.type == 'binary':
@@ -268,37 +438,49 @@ class Tag:
             path    = u_path
             updates = 1
 
+        # load everything we know about this tag up front so that the comparison against
+        # the directory listing below doesn't need to go back to the database per file
+        if self.type == 'binary':
+            packages = RPM_Package.select(RPM_Package.id, RPM_Package.package, RPM_Package.arch,
+                                          RPM_Package.fullname).where(RPM_Package.tid == tid)
+            seen     = RPM_AlreadySeen.select(RPM_AlreadySeen.fullname).where(RPM_AlreadySeen.tid == tid)
+        else:
+            packages = SRPM_Package.select(SRPM_Package.id, SRPM_Package.package,
+                                           SRPM_Package.fullname).where(SRPM_Package.tid == tid)
+            seen     = SRPM_AlreadySeen.select(SRPM_AlreadySeen.fullname).where(SRPM_AlreadySeen.tid == tid)
+
+        in_db   = {}
+        by_name = {}
+        for package in packages:
+            in_db[package.fullname] = package.id
+            if self.type == 'binary':
+                # when looking at binaries, we need to include the arch for uniqueness otherwise
+                # we get the first hit, which might be i386 when we're looking at a new i686 pkg
+                by_name.setdefault((package.package, package.arch), []).append(package)
+            else:
+                by_name.setdefault(package.package, []).append(package)
+        seen = set(row.fullname for row in seen)
+
         if updates == 0 and path:
             if not os.path.isdir(path):
                 logging.critical('Tag path %s does not exist!' % path)
                 sys.exit(1)
             # this handles entries where we don't have a dedicated updates directory
             print 'Checking for removed files in %s tag entries from %s...' % (tag, path)
-            # get the existing entries
-            if self.type == 'binary':
-                result = RPM_Package.select(RPM_Package.tid == tid)
-            else:
-                result = SRPM_Package.select(SRPM_Package.tid == tid)
-            for row in result:
-                fullname = '%s/%s' % (path, row.fullname)
-                if not os.path.isfile(fullname):
-                    logging.info('  %s missing: %s' % (pkg_type, row.fullname))
-                    to_remove.append(row.id)
-
             src_list = glob(path + "/*.rpm")
             src_list.sort()
+            on_disk  = set(os.path.basename(src_rpm) for src_rpm in src_list)
+
+            for fullname in sorted(in_db):
+                if fullname not in on_disk:
+                    logging.info('  %s missing: %s' % (pkg_type, fullname))
+                    to_remove.append(in_db[fullname])
 
             print 'Checking for added files in %s tag entries from %s...' % (tag, path)
             for src_rpm in src_list:
-                sfname = os.path.basename(src_rpm)
-                if self.type == 'binary':
-                    if not RPM_Package.exists(tid, sfname):
-                        logging.info('Scheduling %s to be added to database' % src_rpm)
-                        to_add.append(src_rpm)
-                else:
-                    if not SRPM_Package.exists(tid, sfname):
-                        logging.info('Scheduling %s to be added to database' % src_rpm)
-                        to_add.append(src_rpm)
+                if os.path.basename(src_rpm) not in in_db:
+                    logging.info('Scheduling %s to be added to database' % src_rpm)
+                    to_add.append(src_rpm)
 
         if updates == 1 and u_path:
             # this is an entry with an updates path
@@ -313,77 +495,56 @@ class Tag:
             for src_rpm in src_list:
                 sfname = os.path.basename(src_rpm)
 
+                # files we have in the database, or have already seen and removed, are not new
+                if sfname in in_db:
+                    continue
+                if sfname in seen:
+                    logging.debug('We have already seen %s' % sfname)
+                    continue
+
+                """
+                # see file, look in packages and alreadyseen, if:
+                #  not in packages, not in alreadyseen: new
+                #  in packages, not in alreadyseen: release package
+                #  in packages, in alreadyseen: should never happen
+                #  not in packages, in alreadyseen: old package
+                # if new, add it, delete old one from packages, add to alreadyseen
+                """
+
+                # this file is not in our db, so we need to see if this is an updated package
+                header = self.rcommon.rpm_header(src_rpm)
+                if not header:
+                    continue
+                headers[src_rpm] = header
                 if self.type == 'binary':
-                    exists = RPM_Package.exists(tid, sfname)
+                    result = by_name.get((header['name'], header['arch']), [])
                 else:
-                    exists = SRPM_Package.exists(tid, sfname)
-
-                if not exists:
-                    # this means we do not have this package currently in the database
-                    # so check if we have already seen and removed it
-                    if self.type == 'binary':
-                        alreadyseen = RPM_AlreadySeen.exists(tid, sfname)
-                    else:
-                        alreadyseen = SRPM_AlreadySeen.exists(tid, sfname)
-
-                    if not alreadyseen:
-                        # this is a new file that does not exist in the database, but it's
-                        # in the updates directory and we have not seen it before
-
-                        """
-                        # see file, look in packages and alreadyseen, if:
-                        #  not in packages, not in alreadyseen: new
-                        #  in packages, not in alreadyseen: release package
-                        #  in packages, in alreadyseen: should never happen
-                        #  not in packages, in alreadyseen: old package
-                        # if new, add it, delete old one from packages, add to alreadyseen
-                        """
-
-                        # this file is not in our db, so we need to see if this is an updated package
-                        rpmtags = commands.getoutput("rpm -qp --nosignature --qf '%{NAME}|%{ARCH}' " + self.rcommon.clean_shell(src_rpm))
-                        tlist   = rpmtags.split('|')
-                        logging.debug("tlist is %s " % tlist)
-                        r_pkg  = tlist[0].strip()
-                        r_arch = tlist[1].strip()
-                        if self.type == 'source':
-                            result = SRPM_Package.select().where(
-                                        (SRPM_Package.tid == tid) &
-                                        (SRPM_Package.package == r_pkg))
-                        elif self.type == 'binary':
-                            # when looking at binaries, we need to include the arch for uniqueness otherwise
-                            # we get the first hit, which might be i386 when we're looking at a new i686 pkg
-                            result = RPM_Package.select().where(
-                                        (RPM_Package.tid == tid) &
-                                        (RPM_Package.package == r_pkg) &
-                                        (RPM_Package.arch == r_arch))
-
-                        if result:
-                            # we have a package record of the same name in the database
-                            # this means we need to mark the old package as seen, remove
-                            # the old package, and add this new package
-                            for package in result:
-                                if package.id:
-                                    logging.info('Found an already-in-updates record for %s (ID: %d, %s)' % (sfname, package.id, package.fullname))
-                                    to_add.append(src_rpm)
-                                    if package.id not in to_remove:
-                                        to_remove.append(package.id)
-                                    logging.debug('Scheduling %s to be added to already-seen list' % package.fullname)
-                                    have_seen.append(package.fullname)
-                        else:
-                            # we do NOT have a matching package record of the same name
-                            # that makes this a new package to add, and there is nothing
-                            # to remove
-                            logging.debug('New package found: %s' % src_rpm)
-                            self.rcommon.show_progress()
-                            newpkgs = newpkgs + 1
-                            to_add.append(src_rpm)
-                    else:
-                        logging.debug('We have already seen %s' % sfname)
+                    result = by_name.get(header['name'], [])
+
+                if result:
+                    # we have a package record of the same name in the database
+                    # this means we need to mark the old package as seen, remove
+                    # the old package, and add this new package
+                    for package in result:
+                        logging.info('Found an already-in-updates record for %s (ID: %d, %s)' % (sfname, package.id, package.fullname))
+                        to_add.append(src_rpm)
+                        if package.id not in to_remove:
+                            to_remove.append(package.id)
+                        logging.debug('Scheduling %s to be added to already-seen list' % package.fullname)
+                        have_seen.append(package.fullname)
+                else:
+                    # we do NOT have a matching package record of the same name
+                    # that makes this a new package to add, and there is nothing
+                    # to remove
+                    logging.debug('New package found: %s' % src_rpm)
+                    self.rcommon.show_progress()
+                    newpkgs = newpkgs + 1
+                    to_add.append(src_rpm)
 
         # here we need to weed out any extras; in the case of first updating
         # an updates directory with multiple similar packages (e.g multiple
         # seamonkey packages) we only want the latest version
-        (to_add, have_seen) = self.trim_update_list(to_add, have_seen)
+        (to_add, have_seen) = self.trim_update_list(to_add, have_seen, headers)
 
         if to_remove:
             if listonly:
@@ -408,13 +569,7 @@ class Tag:
             # if self.type == 'source':
             #     tables = ('packages', 'sources', 'files', 'ctags', 'buildreqs')
 
-            for rnum in to_remove:
-                r_count = r_count + 1
-                if self.type == 'binary':
-                    p = RPM_Package.get(RPM_Package.id == rnum)
-                else:
-                    p = SRPM_Package.get(SRPM_Package.id == rnum)
-                p.delete_instance(recursive=True)
+            r_count = self.purge_packages(tid, to_remove)
 
             sys.stdout.write(' done\n')
 
@@ -429,44 +584,32 @@ class Tag:
                 print 'Would add the following tagged entries for tag: %s\n' % tag
             else:
                 print 'Adding tagged entries for tag: %s:' % tag
-            for a_rpm in to_add:
-                if listonly:
+            if listonly:
+                for a_rpm in to_add:
                     print '%s' % a_rpm
-                else:
-                    logging.info('Adding: %s' % a_rpm)
-                    rq.record_add(tid, a_rpm, 1)  # the 1 is to indicate this is an update
+            elif self.type == 'binary':
+                failed = self.rcommon.pool_add(rq, rpm_db, tid, to_add, 1)  # the 1 is to indicate this is an update
+            else:
+                failed = self.rcommon.pool_add(rq, srpm_db, tid, to_add, 1)
 
         if have_seen and not listonly:
-            # make have_seen unique
+            # only add what isn't already in the alreadyseen table, and only once
             hs = []
-            for tmp in have_seen:
-                if tmp not in hs:
-                    hs.append(tmp)
-                else:
-                    logging.debug('Discarding duplicate entry: %s' % tmp)
+            for hseen in have_seen:
+                if hseen in seen:
+                    logging.debug('Discarding duplicate entry: %s' % hseen)
+                    continue
+                seen.add(hseen)
+                hs.append({'fullname': hseen, 'tid': tid})
 
-            h_count = 0
-            for hseen in hs:
-                if self.type == 'binary':
-                    aseen = RPM_AlreadySeen.exists(tid, sfname)
-                else:
-                    aseen = SRPM_AlreadySeen.exists(tid, sfname)
-                if not aseen:
-                    # only add this to the database if we've not seen it
-                    # TODO: this should be unnecessary, but seems like we might get dupes otherwise right now
-                    h_count = h_count + 1
-                    if self.type == 'binary':
-                        h = RPM_AlreadySeen.create(
-                            fullname = hseen,
-                            tid      = tid
-                        )
-                    else:
-                        h = SRPM_AlreadySeen.create(
-                            fullname = hseen,
-                            tid      = tid
-                        )
-                    logging.debug('Added %s to alreadyseen table (id: %d)', hseen, h.id)
-            logging.debug('Added %d records to alreadyseen table', h_count)
+            if self.type == 'binary':
+                (model, db) = (RPM_AlreadySeen, rpm_db)
+            else:
+                (model, db) = (SRPM_AlreadySeen, srpm_db)
+            with db.atomic():
+                for x in xrange(0, len(hs), 500):
+                    model.insert_many(hs[x:x + 500]).execute()
+            logging.debug('Added %d records to alreadyseen table', len(hs))
 
         if not to_add and not to_remove:
             print 'No changes detected.'
@@ -478,62 +621,68 @@ class Tag:
             else:
                 q = SRPM_Tag.update(update_date=cur_date).where(SRPM_Tag.id == tid)
             q.execute()
+        return failed
 
 
-    def trim_update_list(self, packagelist, seenlist):
+    def trim_update_list(self, packagelist, seenlist, headers=None):
         """
         Function to examine a list of packages scheduled for addition to the
         database and make sure they are unique by only taking the package with
-        the highest N-V-R, otherwise we may end up adding multiple copies of the
+        the highest E-V-R, otherwise we may end up adding multiple copies of the
         same package name, just with different versions
         :param packagelist:
         :param seenlist:
+        :param headers: dict of headers we have already read, keyed by package
         :return:
         """
         logging.debug("in Tag.trim_update_list(%s, %s)" % (packagelist, seenlist))
 
+        if headers is None:
+            headers = {}
+
         templist = {}
         newlist  = []
         new_seen = []
 
         for pkg in packagelist:
-            sfname  = os.path.basename(pkg)
-            rpmtags = commands.getoutput("rpm -qp --nosignature --qf '%{NAME}|%{VERSION}|%{RELEASE}|%{BUILDTIME}|%{ARCH}' " + self.rcommon.clean_shell(pkg))
-            tlist   = rpmtags.split('|')
-            logging.debug("tlist is %s " % tlist)
-            package = tlist[0].strip()
-            version = tlist[1].strip()
-            release = tlist[2].strip()
+            sfname = os.path.basename(pkg)
+            if pkg not in headers:
+                headers[pkg] = self.rcommon.rpm_header(pkg)
+            header = headers[pkg]
+            if not header:
+                continue
 
             if self.type == 'source':
-                arch    = 'src'
+                arch = 'src'
             else:
-                arch    = tlist[4].strip()
-            uname   = '%s-%s' % (package, arch)
+                arch = header['arch']
+            uname = '%s-%s' % (header['name'], arch)
+            evr   = (header['epoch'], header['version'], header['release'])
+            try:
+                sortkey = evr_sortkey(*evr)
+            except ValueError:
+                sortkey = None
 
             # first, add everything we see to the already-seen list; later we'll remove
             # what gets stuffed into our updates list
             seenlist.append(sfname)
             logging.debug('Adding %s to the already-seen list' % sfname)
-            try:
-                if not templist[uname]:
-                    templist[uname] = [version, release, pkg, sfname]
-                    logging.debug('Adding %s(%s, %s, %s, %s, %s) to templist' % (package, version, release, pkg, sfname, arch))
-                else:
-                    bigger = self.nvr_compare(templist[uname], version, release)
-                    if bigger == 1:
-                        # this one has a higher nvr
-                        templist[uname] = [version, release, pkg, sfname]
-                        logging.debug('Adding replacement %s(%s, %s, %s, %s, %s) to templist' % (package, version, release, pkg, sfname, arch))
-            except:
-                templist[uname] = [version, release, pkg, sfname]
-                logging.debug('Adding %s(%s, %s, %s, %s) to templist' % (package, version, release, pkg, sfname))
+            if uname not in templist:
+                newer = True
+            elif sortkey and templist[uname][0] and sortkey != templist[uname][0]:
+                newer = sortkey > templist[uname][0]
+            else:
+                # the sort keys tie, or one couldn't be made, so ask rpm's comparison
+                newer = evr_compare(evr, templist[uname][3]) > 0
+            if newer:
+                templist[uname] = [sortkey, pkg, sfname, evr]
+                logging.debug('Adding %s(%s, %s, %s, %s, %s) to templist' % (header['name'], header['version'], header['release'], pkg, sfname, arch))
 
         # reconstruct the old list to return, less what we don't want
         ns = []
         for pkg in templist:
-            newlist.append(templist[pkg][2])
-            ns.append(templist[pkg][3])
+            newlist.append(templist[pkg][1])
+            ns.append(templist[pkg][2])
 
         # reconstruct the new_seen list so it does not contain what is in newlist
         for pkg in seenlist:
@@ -549,81 +698,34 @@ class Tag:
         return(newlist, new_seen)
 
 
-    def nvr_compare(self, oldpkg, version, release):
+    def tag_stats(self, tid=None):
         """
-        TODO: we can get this from python-rpm and do it better
-        Function to compare version and release of two different RPM packages to see which is bigger
-        :param oldpkg:
-        :param version:
-        :param release:
-        :return:
+        Function to count the records of every tag in each table, with one grouped query per table.
+        Returns a dictionary of the counts per tag id, keyed by the name of the records counted
+
+        :param tid: the tag id to limit the counts to, if any
+        :return: dict
         """
-        def ncomp(old, new, type):
-            logging.debug('comparing %s old:%s and new:%s' % (type, old, new))
-            o = old.split('.')
-            n = new.split('.')
-
-            # need to make the array lengths the same, but we don't want to use 0's here
-            # otherwise 9.1.0 may not be higher than 9.1, which it should be, so use empty
-            # values instead to prevent the try statement below failing because o has more
-            # elements than n which makes python mad
-            len_o = len(o)
-            len_n = len(n)
-            if len_o > len_n:
-                num = len_o - len_n
-                x = 0
-                while x < num:
-                    n.append('')
-                    x = x + 1
-            elif len_n > len_o:
-                num = len_n - len_o
-                x = 0
-                while x < num:
-                    o.append('')
-                    x = x + 1
-
-            c = 0
-            b = 0
-            while c < len(o):
-                try:
-                    # first try comparing numerically, as by strings 3 > 15
-                    # which we don't want -- this is pretty simplistic though
-                    # as if we get 3a vs 15b we're hooped
-                    if int(n[c]) < int(o[c]):
-                        # immediately fail if smaller
-                        return(2)
-                    elif int(n[c]) > int(o[c]):
-                        b = 1
-                        c = c + 1
-                        break
-                except:
-                    # if that fails, compare as strings and hope for the best
-                    if n[c] < o[c]:
-                        # immediately fail if smaller
-                        return(2)
-                    if n[c] > o[c]:
-                        b = 1
-                        c = c + 1
-                        break
-                c = c + 1
-
-            return(b)
-
-        ver_is_bigger = ncomp(oldpkg[0], version, "version")
-
-        if ver_is_bigger == 1:
-            return(1)
-        elif ver_is_bigger == 2:
-            # version is smaller, immediately fail
-            return(0)
-        else:
-            # version is the same so check on release
-            rel_is_bigger = ncomp(oldpkg[1], release, "release")
-            if rel_is_bigger == 1:
-                return(1)
+        logging.debug('in Tag.tag_stats(%s)' % tid)
+
+        (package, seen, tag, db, children) = self.purge_models()
+        (counts, tables) = self.count_models()
+
+        query = package.select(package.tid, fn.COUNT(package.id), fn.SUM(package.update), fn.SUM(package.size))
+        if tid:
+            query = query.where(package.tid == tid)
+        stats = {'packages': {}, 'updates': {}, 'bytes': {}}
+        for (ptid, packages, updates, size) in query.group_by(package.tid).tuples():
+            stats['packages'][ptid] = packages
+            stats['updates'][ptid]  = int(updates or 0)
+            stats['bytes'][ptid]    = int(size or 0)
 
-        # if we get here, neither the release nor the version are bigger
-        return(0)
+        for (name, model) in tables:
+            query = model.select(model.tid, fn.COUNT(model.id))
+            if tid:
+                query = query.where(model.tid == tid)
+            stats[name] = dict(query.group_by(model.tid).tuples())
+        return stats
 
 
     def showdbstats(self, tag=None):
@@ -633,9 +735,6 @@ class Tag:
         :param tag: optional tag name to isolate and report on
         :return:
         """
-        """
-        Function to show database info
-        """
         logging.debug("in Tag.showdbstats(%s)" % tag)
 
         tid = None
@@ -647,57 +746,34 @@ class Tag:
                 print 'No such tag: "%s" does not exist in the database!\n' % tag
                 sys.exit(1)
 
+        if self.type == 'binary':
+            (dbase, tags) = (rpm_db, RPM_Tag.get_names())
+        else:
+            (dbase, tags) = (srpm_db, SRPM_Tag.get_names())
+
+        rows   = self.get_counts()
         if tid:
-            if self.type == 'binary':
-                c_tags  = RPM_Tag.select().where(RPM_Tag.id == tid).count()
-                c_pkgs  = RPM_Package.select().where(RPM_Package.tid == tid).count()
-                c_files = RPM_File.select().where(RPM_File.tid == tid).count()
-                c_reqs  = RPM_Requires.select().where(RPM_Requires.tid == tid).count()
-                c_provs = RPM_Provides.select().where(RPM_Provides.tid == tid).count()
-                c_flags = RPM_Flags.select().where(RPM_Flags.tid == tid).count()
-                c_symbs = RPM_Symbols.select().where(RPM_Symbols.tid == tid).count()
-            else:
-                c_tags  = SRPM_Tag.select().where(SRPM_Tag.id == tid).count()
-                c_pkgs  = SRPM_Package.select().where(SRPM_Package.tid == tid).count()
-                c_files = SRPM_File.select().where(SRPM_File.tid == tid).count()
-                c_src   = SRPM_Source.select().where(SRPM_Tag.id == tid).count()
-                c_ctags = SRPM_Ctag.select().where(SRPM_Tag.id == tid).count()
-                c_breqs = SRPM_BuildRequires.select().where(SRPM_Tag.id == tid).count()
+            rows = {tid: rows[tid]}
+        stats  = dict((name, dict((t_id, getattr(row, name)) for (t_id, row) in rows.items()))
+                      for name in ['packages'] + [n for (n, m) in self.count_models()[1]])
+        totals = dict((name, sum(counts.values())) for (name, counts) in stats.items())
+        if tid:
+            c_tags = 1
         else:
-            if self.type == 'binary':
-                c_tags  = RPM_Tag.select().count()
-                c_pkgs  = RPM_Package.select().count()
-                c_files = RPM_File.select().count()
-                c_reqs  = RPM_Requires.select().count()
-                c_provs = RPM_Provides.select().count()
-                c_flags = RPM_Flags.select().count()
-                c_symbs = RPM_Symbols.select().count()
-            else:
-                c_tags  = SRPM_Tag.select().count()
-                c_pkgs  = SRPM_Package.select().count()
-                c_files = SRPM_File.select().count()
-                c_src   = SRPM_Source.select().count()
-                c_ctags = SRPM_Ctag.select().count()
-                c_breqs = SRPM_BuildRequires.select().count()
+            c_tags = len(tags)
 
         # get the size of the database as well
         size   = 0.00
         btype  = ''
-        # TODO: use srpm_db if type == source
-        if self.type == 'binary':
-            db   = rpm_db.database
-            user = rpm_db.connect_kwargs['user']
-            host = rpm_db.connect_kwargs['host']
-        else:
-            db   = srpm_db.database
-            user = srpm_db.connect_kwargs['user']
-            host = srpm_db.connect_kwargs['host']
-        query = 'SELECT table_schema "name",  sum( data_length + index_length ) "size" FROM information_schema.TABLES \
-                 WHERE table_schema = "%s" GROUP BY table_schema' % db
-        tbsize = rpm_db.execute_sql(query)
-        for x in tbsize._rows:
-            if x[0] == db:
-                size = int(x[1])
+        db     = dbase.database
+        user   = dbase.connect_kwargs.get('user', '')
+        host   = dbase.connect_kwargs.get('host', '')
+        if isinstance(dbase, MySQLDatabase):
+            query = 'SELECT table_schema "name",  sum( data_length + index_length ) "size" FROM information_schema.TABLES \
+                     WHERE table_schema = %s GROUP BY table_schema'
+            for x in dbase.execute_sql(query, (db,)).fetchall():
+                if x[0] == db:
+                    size = int(x[1])
         count = 0
 
         while size > 1024:
@@ -712,16 +788,25 @@ class Tag:
                 break
 
         print 'Database statistics:\n'
-        if tag != 'all':
+        if tag:
             print 'Printing statistics for tag: %s\n' % tag
         print '   Database  => User: %s, Host: %s, Database: %s' % (user, host, db)
         print '   Data size => %2.2f %s\n' % (size, btype)
-        print '   Tag records  : %-16d Package records : %-15d' % (c_tags, c_pkgs)
+        print '   Tag records  : %-16d Package records : %-15d' % (c_tags, totals['packages'])
         if self.type == 'binary':
-            print '   File records : %-15d  Requires records: %-15d' % (c_files, c_reqs)
-            print '   Flag records : %-15d  Provides records: %-15d' % (c_flags, c_provs)
-            print '                                   Symbol records  : %-15d\n' % c_symbs
+            print '   File records : %-15d  Requires records: %-15d' % (totals['files'], totals['requires'])
+            print '   Flag records : %-15d  Provides records: %-15d' % (totals['flags'], totals['provides'])
+            print '                                   Symbol records  : %-15d\n' % totals['symbols']
+            columns = ('packages', 'files', 'requires', 'provides', 'flags', 'symbols')
         else:
-            print '   File records : %-15d  Source records  : %-15d' % (c_files, c_src)
-            print '   Ctags records: %-15d  Requires records: %-15d '% (c_ctags, c_breqs)
+            print '   File records : %-15d  Source records  : %-15d' % (totals['files'], totals['sources'])
+            print '   Ctags records: %-15d  Requires records: %-15d \n' % (totals['ctags'], totals['buildreqs'])
+            columns = ('packages', 'files', 'sources', 'ctags', 'buildreqs')
+
+        # the same counts for each tag, straight from the counters table
+        if not tid and tags:
+            print '   %-22s%s' % ('Tag', ''.join(['%12s' % c.title() for c in columns]))
+            for (t_id, t_name) in sorted(tags.items(), key=lambda x: x[1]):
+                print '   %-22s%s' % (t_name, ''.join(['%12d' % stats[c].get(t_id, 0) for c in columns]))
+            print ''
         sys.exit(0)
@@ -0,0 +1,199 @@
+"""
+Helpers shared by the rq unit tests.
+
+The tests import rq and app.models directly rather than through the flask application, so
+the database URIs and data directory that the app package would normally provide are set
+up here, before anything else is imported.  By default both databases are sqlite files in a
+temporary directory.  Set RQ_TEST_RPM_URI and RQ_TEST_SRPM_URI to run against MySQL instead
+(the tables in those databases are dropped and recreated); the tests that run more than one
+worker process at a time need MySQL, as sqlite only allows one writer.
+
+Run the tests from the top of the tree with:
+
+    python -m unittest discover -s test
+"""
+
+import os
+import sys
+import imp
+import gzip
+import shutil
+import struct
+import atexit
+import hashlib
+import optparse
+import tempfile
+from cStringIO import StringIO
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TMPDIR  = tempfile.mkdtemp(prefix='rq-test-')
+atexit.register(shutil.rmtree, TMPDIR, True)
+
+if BASEDIR not in sys.path:
+    sys.path.insert(0, BASEDIR)
+
+if 'app' not in sys.modules:
+    app          = imp.new_module('app')
+    app.__path__ = [os.path.join(BASEDIR, 'app')]
+    app.RPM_URI  = os.environ.get('RQ_TEST_RPM_URI', 'sqlite:///%s/rpm.db' % TMPDIR)
+    app.SRPM_URI = os.environ.get('RQ_TEST_SRPM_URI', 'sqlite:///%s/srpm.db' % TMPDIR)
+    app.DATADIR  = TMPDIR
+    sys.modules['app'] = app
+
+from app import models
+
+
+def is_mysql():
+    """
+    Function to return True if the tests are running against MySQL
+    """
+    return isinstance(models.rpm_db, models.MySQLDatabase)
+
+
+def reset_databases():
+    """
+    Function to drop and recreate every table so a test starts from empty databases
+    """
+    models.rpm_db.drop_tables(all_models(models.RPMModel), safe=True)
+    models.srpm_db.drop_tables(all_models(models.SRPMModel), safe=True)
+    models.create_tables()
+
+
+def all_models(base):
+    """
+    Function to return every concrete model below base
+    """
+    found = []
+    for model in base.__subclasses__():
+        if model.__name__ not in ('RPMNameModel', 'SRPMNameModel'):
+            found.append(model)
+        found.extend(all_models(model))
+    return found
+
+
+def options(**kwargs):
+    """
+    Function to return the command line options rqp and rqs would pass in, with their defaults
+    """
+    values = {'jobs': 1, 'progress': False, 'verbose': False, 'debug': False, 'quiet': False, 'tag': None,
+              'count': False, 'regexp': False, 'extrainfo': False, 'ownership': False, 'suid': False,
+              'sgid': False, 'user': None, 'group': None, 'match': 'substring', 'query': None,
+              'symbols': None, 'provides': None, 'requires': None, 'show_current': False,
+              'suppresstag': False}
+    values.update(kwargs)
+    return optparse.Values(values)
+
+
+def _header(entries):
+    """
+    Function to build an rpm header structure from a list of (tag, type, value)
+    """
+    index = ''
+    store = ''
+    for (tag, htype, value) in sorted(entries):
+        while len(store) % {3: 2, 4: 4, 5: 8}.get(htype, 1):
+            store += '\0'
+        offset = len(store)
+        if htype == 6:
+            store += value + '\0'
+            count  = 1
+        elif htype == 8:
+            store += ''.join([v + '\0' for v in value])
+            count  = len(value)
+        elif htype == 3:
+            store += struct.pack('>%dH' % len(value), *value)
+            count  = len(value)
+        else:
+            store += struct.pack('>%dI' % len(value), *value)
+            count  = len(value)
+        index += struct.pack('>iiii', tag, htype, offset, count)
+    return '\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('>II', len(entries), len(store)) + index + store
+
+
+def _cpio(members):
+    """
+    Function to build a newc cpio archive from a list of (name, mode, data)
+    """
+    out = ''
+    for (ino, (name, mode, data)) in enumerate(members + [('TRAILER!!!', 0, '')]):
+        name += '\0'
+        out  += '070701' + ''.join(['%08x' % x for x in (ino + 1, mode, 0, 0, 1, 0, len(data), 0, 0, 0, 0,
+                                                        len(name), 0)]) + name
+        out  += '\0' * ((4 - len(out) % 4) % 4) + data
+        out  += '\0' * ((4 - len(out) % 4) % 4)
+    return out
+
+
+def build_rpm(path, name, version='1.0', release='1', arch='x86_64', files=(), requires=(), provides=(),
+              epoch=None):
+    """
+    Function to write a minimal (but valid) binary rpm with a gzip payload to path.  files is a
+    list of (name, mode, user, group, data) and requires/provides are lists of names
+    :return: path
+    """
+    lead = '\xed\xab\xee\xdb\x03\x00' + struct.pack('>hh', 0, 1) + name[:65].ljust(66, '\0') + \
+           struct.pack('>hh', 1, 5) + '\0' * 16
+    sig  = _header([(1000, 4, [0])])
+    sig += '\0' * ((8 - len(sig) % 8) % 8)
+
+    dirs    = []
+    indexes = []
+    bases   = []
+    for f in files:
+        (dname, bname) = os.path.split(f[0])
+        dname += '/'
+        if dname not in dirs:
+            dirs.append(dname)
+        indexes.append(dirs.index(dname))
+        bases.append(bname)
+
+    entries = [(1000, 6, name), (1001, 6, version), (1002, 6, release), (1006, 4, [1234567890]),
+               (1022, 6, arch), (1044, 6, '%s-%s-%s.src.rpm' % (name, version, release)),
+               (1124, 6, 'cpio'), (1125, 6, 'gzip')]
+    if epoch is not None:
+        entries.append((1003, 4, [epoch]))
+    if files:
+        entries += [(1116, 4, indexes), (1117, 8, bases), (1118, 8, dirs),
+                    (1030, 3, [f[1] for f in files]), (1039, 8, [f[2] for f in files]),
+                    (1040, 8, [f[3] for f in files]), (1028, 4, [len(f[4]) for f in files]),
+                    (1035, 8, [hashlib.sha256(f[4]).hexdigest() if f[1] & 0100000 else '' for f in files])]
+    if requires:
+        entries += [(1049, 8, list(requires)), (1048, 4, [0] * len(requires)), (1050, 8, [''] * len(requires))]
+    if provides:
+        entries += [(1047, 8, list(provides)), (1112, 4, [0] * len(provides)), (1113, 8, [''] * len(provides))]
+
+    payload = StringIO()
+    archive = gzip.GzipFile(fileobj=payload, mode='wb')
+    archive.write(_cpio([('.' + f[0], f[1], f[4]) for f in files]))
+    archive.close()
+
+    with open(path, 'wb') as f:
+        f.write(lead + sig + _header(entries) + payload.getvalue())
+    return path
+
+
+def build_packages(path, count=6, release='1'):
+    """
+    Function to write count binary packages to path that share users, groups, directories,
+    dependencies and an ELF binary (so the analysis and name dictionaries are shared as well)
+    :return: list of the package file names
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    elf = os.path.realpath('/bin/true')
+    with open(elf, 'rb') as f:
+        binary = f.read()
+
+    packages = []
+    for x in xrange(count):
+        name  = 'pkg%d' % x
+        files = [('/usr/bin/%s' % name, 0100755, 'root', 'root', binary),
+                 ('/usr/libexec/%s/helper' % name, 0104750, 'root', 'wheel', binary),
+                 ('/usr/share/doc/%s/NEWS' % name, 0100644, 'root', 'root', '%s\n' % name),
+                 ('/var/lib/%s/state' % name, 0100640, 'daemon%d' % (x % 2), 'daemon', '')]
+        packages.append(build_rpm(os.path.join(path, '%s-1.0-%s.x86_64.rpm' % (name, release)), name,
+                                  release=release, files=files,
+                                  requires=['libc.so.6()(64bit)', 'common', 'pkg%d' % ((x + 1) % count)],
+                                  provides=[name, 'virtual-%d' % (x % 3)]))
+    return packages
@@ -0,0 +1,156 @@
+"""
+Tests for the package and ELF readers and the version ordering in rq.basics
+"""
+
+import os
+import sys
+import signal
+import itertools
+import subprocess
+import unittest
+
+import support
+from rq.basics import RPMHeader, RPMPayload, ELFFile, evr_sortkey, evr_compare, rpmvercmp
+
+
+class TestRpmvercmp(unittest.TestCase):
+    """
+    rpmvercmp() against the results of rpm's own comparison
+    """
+
+    results = [('1.0', '1.0', 0), ('1.0', '2.0', -1), ('2.0', '1.0', 1), ('2.0', '2.0.1', -1), ('2.0.1a', '2.0.1', 1),
+               ('5.5p1', '5.5p2', -1), ('5.5p1', '5.5p10', -1), ('10xyz', '10.1xyz', -1), ('xyz10', 'xyz10.1', -1),
+               ('xyz.4', '8', -1), ('5.5p2', '5.6p1', -1), ('6.0.rc1', '6.0', 1), ('10b2', '10a1', 1),
+               ('1.0aa', '1.0a', 1), ('10.0001', '10.1', 0), ('10.0001', '10.0039', -1), ('4.999.9', '5.0', -1),
+               ('2.0', '2_0', 0), ('a+', 'a_', 0), ('+_', '_+', 0), ('1.0~rc1', '1.0', -1),
+               ('1.0~rc1', '1.0~rc2', -1), ('1.0~rc1~git123', '1.0~rc1', -1), ('1.0^', '1.0', 1),
+               ('1.0^git1', '1.0^git2', -1), ('1.0^git1~pre', '1.0^git1', -1), ('1.0^20160101', '1.0.1', -1),
+               ('1.0~rc1^git1', '1.0~rc1', 1)]
+
+    def test_results(self):
+        for (a, b, expected) in self.results:
+            self.assertEqual(rpmvercmp(a, b), expected, '%r vs %r' % (a, b))
+            self.assertEqual(rpmvercmp(b, a), -expected, '%r vs %r' % (b, a))
+
+
+class TestEVRSortkey(unittest.TestCase):
+    """
+    evr_sortkey() has to put packages in the same order as rpm would
+    """
+
+    versions = ['1.0', '1.0.0', '1.00', '1.01', '1.1', '1.10', '1.9', '1.0a', '1.0b', '1.0~rc1', '1.0~rc2',
+                '1.0~~', '1.0^', '1.0^git1', '1.0^git2', '1.0~rc1^git1', '1_0', '1.0.1', 'a', 'b', 'a1', '1a',
+                '2', '10', '010', '', '~', '^', '1.0+1', '2.0.0.0', 'alpha', 'beta', 'ALPHA', '5.5p1', '5.5p10']
+
+    def test_versions(self):
+        for (a, b) in itertools.product(self.versions, repeat=2):
+            expected = rpmvercmp(a, b)
+            got      = cmp(evr_sortkey(0, a, '1'), evr_sortkey(0, b, '1'))
+            self.assertEqual(got, expected, '%r vs %r: sortkey gives %d, rpm gives %d' % (a, b, got, expected))
+
+    def test_evr(self):
+        evrs = [(None, '1.0', '1'), (0, '1.0', '1'), (1, '0.1', '1'), (0, '1.0', '1.el7'), (0, '1.0', '1.el7_1'),
+                (0, '1.0', '2'), (0, '1.0', '10'), (2, '0', '0'), (0, '1.0~beta', '1'), (0, '1.0', '1~rc1')]
+        for (a, b) in itertools.product(evrs, repeat=2):
+            self.assertEqual(cmp(evr_sortkey(*a), evr_sortkey(*b)), evr_compare(a, b), '%r vs %r' % (a, b))
+
+    def test_long(self):
+        # long segments and releases still sort like rpm, up to what the column holds
+        evrs = [(0, '1', '9' * 99), (0, '1', '1' + '0' * 99), (0, '1', '1' + '0' * 150), (0, '1', '2' + '0' * 99),
+                (0, '1', 'a' * 100), (0, '1', 'a' * 101), (0, '1', 'b' * 100)]
+        for (a, b) in itertools.product(evrs, repeat=2):
+            self.assertEqual(cmp(evr_sortkey(*a), evr_sortkey(*b)), evr_compare(a, b), '%r vs %r' % (a, b))
+
+        # and anything longer is refused rather than cut short
+        self.assertRaises(ValueError, evr_sortkey, 0, '1', '1' + '0' * 300)
+        self.assertRaises(ValueError, evr_sortkey, 0, '1', 'a' * 150)
+
+
+class TestRPMPayload(unittest.TestCase):
+    """
+    Reading the cpio payload of a package, including broken ones
+    """
+
+    files = [('/usr/bin/hello', 0100755, 'root', 'root', '#!/bin/sh\necho hello\n' * 50),
+             ('/usr/share/doc/hello/README', 0100644, 'root', 'root', 'hello\n'),
+             ('/usr/share/doc/hello', 040755, 'root', 'root', '')]
+
+    def setUp(self):
+        self.rpm    = support.build_rpm(os.path.join(support.TMPDIR, 'hello-1.0-1.x86_64.rpm'), 'hello',
+                                        files=self.files)
+        self.header = RPMHeader(self.rpm).fields()
+        # a regression here shows up as a hang, so don't let it
+        signal.signal(signal.SIGALRM, self.timeout)
+        signal.alarm(30)
+
+    def tearDown(self):
+        signal.alarm(0)
+
+    def timeout(self, signum, frame):
+        raise AssertionError('reading the payload did not finish')
+
+    def test_members(self):
+        members = [(m.name, m.mode, m.read(1 << 20)) for m in RPMPayload(self.rpm, self.header).members()]
+        self.assertEqual(members, [('.' + f[0], f[1], f[4]) for f in self.files])
+
+    def test_unread_members(self):
+        # members the caller skips are read past without disturbing the next one
+        names = [m.name for m in RPMPayload(self.rpm, self.header).members()]
+        self.assertEqual(names, ['.' + f[0] for f in self.files])
+
+    def test_truncated(self):
+        with open(self.rpm, 'rb') as f:
+            data = f.read()
+
+        truncated = os.path.join(support.TMPDIR, 'truncated.rpm')
+        offset    = self.header['payload_offset']
+        # the gzip stream ends with an 8 byte trailer that the payload itself doesn't need
+        for size in range(offset, len(data) - 8, 7):
+            with open(truncated, 'wb') as f:
+                f.write(data[:size])
+            with self.assertRaises(ValueError):
+                for member in RPMPayload(truncated, self.header).members():
+                    member.read(10)
+
+
+class TestELFFile(unittest.TestCase):
+    """
+    Reading an ELF binary, checked against readelf
+    """
+
+    def setUp(self):
+        self.path = os.path.realpath(sys.executable)
+        with open(self.path, 'rb') as f:
+            if f.read(4) != '\x7fELF':
+                self.skipTest('%s is not an ELF binary' % self.path)
+
+    def readelf(self, *args):
+        try:
+            return subprocess.check_output(['readelf', '-W'] + list(args) + [self.path])
+        except OSError:
+            self.skipTest('readelf is not available')
+
+    def test_header(self):
+        elf = ELFFile.open(self.path)
+        out = self.readelf('-h')
+        self.assertEqual(elf.is64, 'ELF64' in out)
+        self.assertEqual(elf.e_type == 3, 'DYN' in out)
+        self.assertEqual(len(elf.segments), int(out.split('Number of program headers:')[1].split()[0]))
+
+    def test_dynamic_symbols(self):
+        elf   = ELFFile.open(self.path)
+        names = set()
+        for line in self.readelf('--dyn-syms').splitlines():
+            fields = line.split()
+            if len(fields) >= 8 and fields[0].rstrip(':').isdigit():
+                names.add(fields[7].split('@')[0])
+        names.discard('')
+        self.assertTrue(names)
+        self.assertEqual(set(s[0] for s in elf.dynsyms), names)
+
+    def test_not_elf(self):
+        self.assertRaises(ValueError, ELFFile, '#!/bin/sh\n' * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,321 @@
+"""
+Tests for importing packages, serially and with a pool of workers
+"""
+
+import os
+import sys
+import shutil
+import logging
+import sqlite3
+import tarfile
+import unittest
+from cStringIO import StringIO
+
+import support
+from app import models
+from app.models import RPM_Tag, RPM_Package, RPM_File, RPM_User, RPM_Group, RPM_Dirname, RPM_SymbolName, \
+    RPM_RequireName, RPM_ProvideName, RPM_Analysis
+from rq.basics import Common
+from rq.binary import Binary
+from rq.source import Source
+from rq.tag import Tag
+
+
+def counters(row):
+    """
+    Returns the counters of an RPM_TagCounts row as a dictionary
+    """
+    return dict((name, getattr(row, name)) for name in row._meta.fields if name not in ('id', 'tid'))
+
+
+def row_counts():
+    """
+    Returns the number of rows in each table of the binary database
+    """
+    return dict((model.__name__, model.select().count()) for model in support.all_models(models.RPMModel))
+
+
+class ImportTestCase(unittest.TestCase):
+    """
+    Sets up empty databases and a directory of packages to import
+    """
+
+    def setUp(self):
+        support.reset_databases()
+        self.path    = os.path.join(support.TMPDIR, self.id())
+        self.main    = os.path.join(self.path, 'main')
+        self.updates = os.path.join(self.path, 'updates')
+        support.build_packages(self.main)
+        os.makedirs(self.updates)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def rq(self, jobs=1, config=None):
+        """
+        Returns the (Tag, Binary) pair rqp would use
+        """
+        options = support.options(jobs=jobs)
+        common  = Common(options, 'binary', config or {})
+        rtag    = Tag('binary', {}, common, options)
+        return (rtag, Binary({}, options, rtag, common))
+
+    def quietly(self, func, *args):
+        """
+        Calls func with its output thrown away
+        """
+        stdout     = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            return func(*args)
+        finally:
+            sys.stdout = stdout
+
+    def add_tag(self, tag, jobs=1):
+        """
+        Imports the packages as tag; returns the tag id
+        """
+        (rtag, rqp) = self.rq(jobs)
+        self.assertEqual(self.quietly(rqp.rpm_add_directory, tag, self.main, self.updates), 0)
+        return rtag.lookup(tag)['id']
+
+
+class TestImport(ImportTestCase):
+
+    def test_serial(self):
+        tid = self.add_tag('serial')
+        self.assertEqual(RPM_Package.select().count(), 6)
+        self.assertEqual(RPM_File.select().count(), 24)
+
+        # the counters match what is actually in the database
+        (rtag, rqp) = self.rq()
+        stats       = rtag.tag_stats(tid)
+        expected    = dict((name, stats[name].get(tid, 0)) for name in stats)
+        self.assertEqual(counters(rtag.get_counts()[tid]), expected)
+        self.assertEqual(expected['packages'], 6)
+        self.assertEqual(expected['files'], 24)
+        self.assertEqual(RPM_Tag.get(RPM_Tag.id == tid).package_count, 6)
+        self.assertEqual(RPM_Tag.get(RPM_Tag.id == tid).update_count, 0)
+
+    def test_show_current(self):
+        self.add_tag('serial')
+        support.build_packages(self.updates, 3, '2')
+        (rtag, rqp) = self.rq()
+        self.assertEqual(self.quietly(rtag.update_entries, rqp, 'serial'), 0)
+
+        rows = [(p.package, p.release) for p in RPM_Package.latest(RPM_Package.package.contains('pkg'))]
+        self.assertEqual(sorted(rows), [('pkg0', '2'), ('pkg1', '2'), ('pkg2', '2'), ('pkg3', '1'), ('pkg4', '1'),
+                                        ('pkg5', '1')])
+
+    def test_update_counters(self):
+        tid = self.add_tag('serial')
+        support.build_packages(self.updates, 3, '2')
+        (rtag, rqp) = self.rq()
+        rtag.purge_chunk = 2
+        self.assertEqual(self.quietly(rtag.update_entries, rqp, 'serial'), 0)
+
+        # newer updates replace the ones imported above
+        for rpm in os.listdir(self.updates):
+            os.remove(os.path.join(self.updates, rpm))
+        support.build_packages(self.updates, 3, '3')
+        self.assertEqual(self.quietly(rtag.update_entries, rqp, 'serial'), 0)
+        self.assertEqual(RPM_Package.select().where(RPM_Package.release == '2').count(), 0)
+
+        # the counters follow the rows added and removed
+        stats    = rtag.tag_stats(tid)
+        expected = dict((name, stats[name].get(tid, 0)) for name in stats)
+        self.assertEqual(counters(rtag.get_counts()[tid]), expected)
+        self.assertEqual(expected['updates'], 3)
+        self.assertEqual(RPM_Tag.get(RPM_Tag.id == tid).update_count, 3)
+
+    def test_trim_update_list(self):
+        # a release too long for a sort key is still ordered the way rpm would
+        (rtag, rqp) = self.rq()
+        short = support.build_rpm(os.path.join(self.updates, 'big-1.0-2.x86_64.rpm'), 'big', release='2')
+        long  = support.build_rpm(os.path.join(self.updates, 'big-1.0-1x.x86_64.rpm'), 'big', release='1' + '0' * 300)
+        for packages in ([short, long], [long, short]):
+            self.assertEqual(rtag.trim_update_list(packages, [])[0], [long])
+
+    def test_old_schema(self):
+        (rtag, rqp) = self.rq()
+        self.assertTrue(rtag.check_schema())
+
+        # a database that already had packages in it when the schema table was added
+        self.add_tag('serial')
+        models.RPM_Schema.drop_table()
+        models.create_tables()
+        self.assertEqual(models.schema_version(models.RPM_Schema), 0)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.assertFalse(rtag.check_schema())
+
+    def test_jobs(self):
+        if not support.is_mysql():
+            self.skipTest('more than one worker needs MySQL (set RQ_TEST_RPM_URI)')
+
+        serial   = self.add_tag('serial')
+        parallel = self.add_tag('parallel', 2)
+
+        (rtag, rqp) = self.rq()
+        counts      = rtag.get_counts()
+        self.assertEqual(counters(counts[parallel]), counters(counts[serial]))
+
+        stats = rtag.tag_stats()
+        for name in stats:
+            self.assertEqual(stats[name].get(parallel, 0), stats[name].get(serial, 0), name)
+
+        # names are shared between the tags, and never stored twice
+        for (model, field) in ((RPM_User, RPM_User.user), (RPM_Group, RPM_Group.group),
+                               (RPM_Dirname, RPM_Dirname.digest), (RPM_SymbolName, RPM_SymbolName.digest),
+                               (RPM_RequireName, RPM_RequireName.digest), (RPM_ProvideName, RPM_ProvideName.digest),
+                               (RPM_Analysis, RPM_Analysis.digest)):
+            self.assertEqual(model.select().count(), model.select(field).distinct().count(), model.__name__)
+
+    def test_jobs_rows(self):
+        if not support.is_mysql():
+            self.skipTest('more than one worker needs MySQL (set RQ_TEST_RPM_URI)')
+
+        # a parallel import of the same packages into an empty database leaves the same rows
+        self.add_tag('main')
+        serial = row_counts()
+        support.reset_databases()
+        self.add_tag('main', 2)
+        self.assertEqual(row_counts(), serial)
+        self.assertEqual(serial['RPM_User'], 3)
+        self.assertEqual(serial['RPM_Group'], 3)
+
+
+class TestHeaderCache(ImportTestCase):
+
+    def test_off_by_default(self):
+        (rtag, rqp) = self.rq()
+        self.assertIsNone(rqp.rcommon.header_cache)
+        self.add_tag('main')
+        self.assertFalse([f for f in os.listdir(support.TMPDIR) if 'headers' in f])
+
+    def test_cached(self):
+        config      = {'header_cache': os.path.join(self.path, 'headers.db')}
+        (rtag, rqp) = self.rq(config=config)
+        self.assertEqual(self.quietly(rqp.rpm_add_directory, 'main', self.main, self.updates), 0)
+
+        # the next run doesn't need to open the packages to read their headers
+        (rtag, rqp) = self.rq(config=config)
+        for rpm in os.listdir(self.main):
+            self.assertEqual(rqp.rcommon.header_cache.get(os.path.join(self.main, rpm))['name'], rpm.split('-')[0])
+        self.assertEqual(rqp.rcommon.header_cache.clear(), 6)
+
+    def test_invalidated(self):
+        config      = {'header_cache': os.path.join(self.path, 'headers.db')}
+        (rtag, rqp) = self.rq(config=config)
+        self.assertEqual(self.quietly(rqp.rpm_add_directory, 'main', self.main, self.updates), 0)
+
+        def cached():
+            return sqlite3.connect(config['header_cache']).execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+        self.assertEqual(cached(), 6)
+
+        # a package that can no longer be read is dropped
+        broken = os.path.join(self.main, sorted(os.listdir(self.main))[0])
+        with open(broken, 'wb') as f:
+            f.write('not an rpm')
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.assertIsNone(rqp.rcommon.rpm_header(broken))
+        self.assertEqual(cached(), 5)
+
+        # and so are the packages of a deleted tag
+        self.quietly(rtag.delete_entries, 'main')
+        self.assertEqual(cached(), 0)
+
+
+class TestQueryCache(ImportTestCase):
+
+    def query(self, rqp, **kwargs):
+        """
+        Runs a file query with the options given; returns its output and whether the database was asked
+        """
+        calls = []
+        run   = rqp.run_query
+        rqp.run_query = lambda qtype: calls.append(qtype) or run(qtype)
+        for (name, value) in kwargs.items():
+            setattr(rqp.options, name, value)
+        output = StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            rqp.query('files')
+        finally:
+            sys.stdout = stdout
+            rqp.run_query = run
+        return (output.getvalue(), bool(calls))
+
+    def test_off_by_default(self):
+        self.add_tag('main')
+        (rtag, rqp) = self.rq(config={})
+        self.assertIsNone(rqp.rcommon.query_cache)
+        self.assertTrue(self.query(rqp, query='helper')[1])
+        self.assertTrue(self.query(rqp, query='helper')[1])
+        self.assertFalse([f for f in os.listdir(support.TMPDIR) if 'queries' in f])
+
+    def test_cached(self):
+        self.add_tag('main')
+        config      = {'query_cache': os.path.join(self.path, 'queries.db')}
+        (rtag, rqp) = self.rq(config=config)
+
+        (first, ran) = self.query(rqp, query='helper')
+        self.assertTrue(ran)
+        self.assertIn('/usr/libexec/pkg3/helper', first)
+
+        # options that don't change the output still find it, in this process or the next
+        self.assertEqual(self.query(rqp, progress=True, jobs=4), (first, False))
+        (rtag, rqp) = self.rq(config=config)
+        self.assertEqual(self.query(rqp, query='helper'), (first, False))
+
+        # until the cache is emptied (--clear-query-cache)
+        self.assertEqual(rqp.rcommon.query_cache.clear(), 1)
+        self.assertEqual(self.query(rqp, query='helper'), (first, True))
+
+        # ones that do change it don't
+        (output, ran) = self.query(rqp, suid=True)
+        self.assertTrue(ran)
+
+        # and neither does an updated tag
+        support.build_packages(self.updates, 1, '2')
+        self.quietly(rtag.update_entries, rqp, 'main')
+        (output, ran) = self.query(rqp, suid=False)
+        self.assertTrue(ran)
+        self.assertNotEqual(output, first)
+
+
+class TestSourceFiles(ImportTestCase):
+
+    def test_add_file_records(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.path)
+        with tarfile.open('proj-1.0.tar.gz', 'w:gz') as tar:
+            for name in ('proj/a.c', 'proj/src/b.c', 'proj/Makefile'):
+                with open('member', 'w') as f:
+                    f.write(name)
+                tar.add('member', name)
+        with open('fix.patch', 'w') as f:
+            f.write('--- proj/a.c.orig\n+++ proj/a.c\n@@ -1 +1 @@\n-a\n+b\n')
+
+        options = support.options()
+        common  = Common(options, 'source', {})
+        rqs     = Source({}, options, Tag('source', {}, common, options), common)
+        tag     = models.SRPM_Tag.create(tag='main', path=self.path, update_path='', tdate='')
+        package = models.SRPM_Package.create(tid=tag, package='proj', version='1.0', release='1', date='',
+                                             fullname='proj-1.0-1.src.rpm')
+        for sfile in ('proj-1.0.tar.gz', 'fix.patch'):
+            models.SRPM_Source.create(tid=tag, pid=package, stype='source', file=sfile)
+        files = {0: {'file': 'proj-1.0.tar.gz'}, 1: {'file': 'fix.patch'}}
+
+        # the patched file is a row of its own, with its own trigrams
+        self.assertEqual(rqs.add_file_records(tag.id, package.id, files), 3)
+        rows = models.SRPM_File.select(models.SRPM_File.id, models.SRPM_File.file).tuples()
+        self.assertEqual(sorted(f for (i, f) in rows), ['proj/a.c', 'proj/a.c', 'proj/src/b.c'])
+        grams = models.SRPM_FileTrigram.select(models.SRPM_FileTrigram.fid).distinct().tuples()
+        self.assertEqual(sorted(i for (i,) in grams), sorted(i for (i, f) in rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+"""
+Tests for the query helpers in app.models
+"""
+
+import re
+import unittest
+import multiprocessing
+
+import support
+from app.models import rpm_db, regexp_literals, file_trigrams, RPM_SymbolName, RPM_Analysis, RPM_User, RPM_Group, \
+    RPM_FileTrigram
+
+
+class TestRegexpLiterals(unittest.TestCase):
+    """
+    regexp_literals() may only return strings that every match has to contain
+    """
+
+    def test_literals(self):
+        self.assertEqual(regexp_literals('foo.*bar'), ('', ['foo', 'bar']))
+        self.assertEqual(regexp_literals('^/usr/lib'), ('/usr/lib', ['/usr/lib']))
+        self.assertEqual(regexp_literals('^/usr/(s?bin)/.*conf$'), ('/usr/', ['/usr/', 'bin', 'conf']))
+        self.assertEqual(regexp_literals('lib(ssl|crypto)\\.so'), ('', ['lib', '.so']))
+        self.assertEqual(regexp_literals('(abc)+x'), ('', ['abc']))
+        self.assertEqual(regexp_literals('a?bc'), ('', ['bc']))
+        self.assertEqual(regexp_literals('x*yz[ab]cd'), ('', ['yz', 'cd']))
+
+    def test_nothing_required(self):
+        # alternatives, optional parts and single characters don't require anything usable
+        for pattern in ('foo|bar', '^foo|bar', '(abc)?', 'a.b.c', '[abc]+', ''):
+            self.assertEqual(regexp_literals(pattern), ('', []), pattern)
+
+    def test_given_up(self):
+        # anything the database may read differently than python does
+        for pattern in ('[[:alpha:]]foo', '[[.hyphen.]]foo', '\\dfoo', 'foo\\b', '(?i)foo', '(?:ab)cd', '('):
+            self.assertEqual(regexp_literals(pattern), ('', []), pattern)
+
+    def test_matches_contain_literals(self):
+        names    = ['/usr/lib64/libssl.so.10', '/usr/lib/libcrypto.so', '/usr/sbin/sshd', '/usr/bin/ssh',
+                    '/etc/ssh/sshd_config', '/usr/share/doc/openssl/README', '/usr/lib/debug/libssl.so.debug']
+        patterns = ['lib(ssl|crypto)\\.so', '^/usr/(s?bin)/.*d$', 'ssh.?_conf', '(doc|debug)/.*', '^/etc/.+conf']
+        for pattern in patterns:
+            (prefix, literals) = regexp_literals(pattern)
+            for name in names:
+                if re.search(pattern, name):
+                    self.assertTrue(name.startswith(prefix), (pattern, name))
+                    for literal in literals:
+                        self.assertIn(literal, name, (pattern, name))
+
+
+class TestTrigramCandidates(unittest.TestCase):
+    """
+    The trigram index may leave files in that don't match, but never leave out one that does
+    """
+
+    names = ['/usr/lib64/libssl.so.10', '/usr/lib/libcrypto.so', '/usr/sbin/sshd', '/usr/bin/ssh',
+             '/etc/ssh/sshd_config', '/usr/share/doc/openssl/README', '/usr/lib/debug/libssl.so.debug',
+             '/usr/lib64/libSSL.so.1.1', '/usr/bin/openssl', '/usr/share/man/man1/openssl.1.gz']
+
+    def setUp(self):
+        support.reset_databases()
+        with rpm_db.atomic():
+            for (fid, name) in enumerate(self.names):
+                for gram in file_trigrams(name):
+                    RPM_FileTrigram.create(tid=1 + fid % 2, pid=1, fid=fid, gram=gram)
+
+    def candidates(self, name, tid=None):
+        return set(row.fid for row in RPM_FileTrigram.candidates(name, tid))
+
+    def test_candidates(self):
+        for search in ('libssl.so', '/usr/lib', 'sshd', 'SSL', 'openssl.1', '/usr/bin/ssh', 'man1/'):
+            found    = self.candidates(search)
+            expected = set(fid for (fid, name) in enumerate(self.names) if search.lower() in name.lower())
+            self.assertTrue(found >= expected, search)
+            self.assertEqual(self.candidates(search, 2), set(fid for fid in found if fid % 2), search)
+
+    def test_rarest(self):
+        # only the rarest trigrams are intersected; 'usr' and '/us' are in most of the names
+        (sql, params) = RPM_FileTrigram.candidates('/usr/lib/debug').sql()
+        self.assertEqual(len(params), 4)
+        self.assertNotIn(file_trigrams('usr').pop(), params)
+        self.assertEqual(self.candidates('/usr/lib/debug'), set([6]))
+
+    def test_no_trigrams(self):
+        self.assertIsNone(RPM_FileTrigram.candidates('so'))
+
+
+def _symbol_ids(names, ready, go, results):
+    """
+    Looks names up from within a transaction that has already read from the database, the way
+    they are looked up while a package is added
+    """
+    with rpm_db.atomic():
+        RPM_SymbolName.select().count()
+        ready.set()
+        go.wait()
+        results.put(RPM_SymbolName.get_ids(names))
+
+
+def _add_digest(digest, ready, go, results):
+    """
+    Stores the analysis of a file the way it is stored while a package is added
+    """
+    with rpm_db.atomic():
+        RPM_Analysis.get_digests([digest])
+        ready.set()
+        go.wait()
+        analysis = RPM_Analysis.add_digest(digest, {'relro': 1, 'ssp': 1, 'pie': 1, 'fortify_source': 0, 'nx': 1},
+                                           ['main'])
+        results.put((analysis.id, analysis.get_symbols()))
+
+
+class TestNameIds(unittest.TestCase):
+    """
+    Looking up and adding names in the dictionary tables, and the analysis of files
+    """
+
+    def setUp(self):
+        support.reset_databases()
+
+    def test_get_ids(self):
+        first = RPM_SymbolName.get_ids(['malloc', 'free', 'malloc'])
+        self.assertEqual(sorted(first), ['free', 'malloc'])
+        again = RPM_SymbolName.get_ids(['free', 'calloc', 'malloc'])
+        self.assertEqual(again['free'], first['free'])
+        self.assertEqual(again['malloc'], first['malloc'])
+        self.assertEqual(RPM_SymbolName.select().count(), 3)
+
+    def test_find_prefix(self):
+        long  = 'x' * 130
+        names = ['malloc', 'Malloc_hook', 'malloc_trim', 'free', long + 'A', long + 'a', long + 'ab']
+        ids   = RPM_SymbolName.get_ids(names)
+
+        def found(prefix):
+            return sorted(RPM_SymbolName.get(RPM_SymbolName.id == row.id).name
+                          for row in RPM_SymbolName.find_prefix(prefix))
+
+        self.assertEqual(len(ids), len(names))
+        self.assertEqual(found('malloc'), ['malloc', 'malloc_trim'])
+        self.assertEqual(found('M'), ['Malloc_hook'])
+        self.assertEqual(found('malloc_'), ['malloc_trim'])
+        self.assertEqual(found(long + 'a'), [long + 'a', long + 'ab'])
+        self.assertEqual(found(long + 'A'), [long + 'A'])
+        self.assertEqual(found('z'), [])
+
+    def test_find_regexp(self):
+        names = ['ssl_foo', 'SSL_new', 'Ssl_bar', 'xssl_', 'libssl', 'ssl', 'crypto_ssl_init']
+        RPM_SymbolName.get_ids(names)
+
+        def found(query):
+            return sorted(RPM_SymbolName.get(RPM_SymbolName.id == row.id).name for row in query)
+
+        # narrowing things down never loses a match, whatever the case of the names
+        for pattern in ('^ssl_', '^SSL', '^ssl_[a-z]+$', 'ssl_', '^crypto_(ssl|tls)', 'SSL$'):
+            self.assertEqual(found(RPM_SymbolName.find_regexp(pattern)),
+                             found(RPM_SymbolName.select().where(RPM_SymbolName.name.regexp(pattern))), pattern)
+        self.assertEqual(found(RPM_SymbolName.find_regexp('^ssl_')), ['SSL_new', 'Ssl_bar', 'ssl_foo'])
+
+    def test_users_and_groups(self):
+        # names only differing in case are different users, whatever the collation of the table
+        users = RPM_User.get_ids(['root', 'Root', 'daemon'])
+        self.assertEqual(len(set(users.values())), 3)
+        self.assertEqual(RPM_User.get_ids(['Root', 'root']), {'root': users['root'], 'Root': users['Root']})
+        self.assertEqual(RPM_User.select().count(), 3)
+
+        groups = RPM_Group.get_ids(['wheel', 'WHEEL'])
+        self.assertEqual(len(set(groups.values())), 2)
+        self.assertEqual(RPM_Group.get_ids(['wheel']), {'wheel': groups['wheel']})
+
+    def worker(self, names, go=None, target=_symbol_ids):
+        ready   = multiprocessing.Event()
+        go      = go or multiprocessing.Event()
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=target, args=(names, ready, go, results))
+        process.start()
+        ready.wait(30)
+        return (process, go, results)
+
+    def test_two_workers(self):
+        if not support.is_mysql():
+            self.skipTest('more than one worker needs MySQL (set RQ_TEST_RPM_URI)')
+
+        one = ['sym%d' % x for x in xrange(0, 300)]
+        two = ['sym%d' % x for x in xrange(200, 500)]
+        # the workers need connections of their own
+        rpm_db.close()
+
+        # the first worker's transaction starts before the second one adds the names they share,
+        # and only looks them up once the second one is done
+        (first, go, first_results) = self.worker(one)
+        (second, done, second_results) = self.worker(two)
+        done.set()
+        second_ids = second_results.get(timeout=60)
+        second.join(60)
+        go.set()
+        first_ids = first_results.get(timeout=60)
+        first.join(60)
+        self.assertEqual(first.exitcode, 0)
+        self.assertEqual(second.exitcode, 0)
+
+        self.assertEqual(sorted(first_ids), sorted(one))
+        self.assertEqual(sorted(second_ids), sorted(two))
+        for name in set(one) & set(two):
+            self.assertEqual(first_ids[name], second_ids[name], name)
+        self.assertEqual(RPM_SymbolName.select().count(), 500)
+
+    def test_two_workers_at_once(self):
+        if not support.is_mysql():
+            self.skipTest('more than one worker needs MySQL (set RQ_TEST_RPM_URI)')
+
+        names = ['sym%d' % x for x in xrange(0, 2000)]
+        rpm_db.close()
+
+        go      = multiprocessing.Event()
+        workers = [self.worker(names[x:] + names[:x], go) for x in (0, 1000)]
+        go.set()
+        results = [w[2].get(timeout=60) for w in workers]
+        for w in workers:
+            w[0].join(60)
+            self.assertEqual(w[0].exitcode, 0)
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(RPM_SymbolName.select().count(), 2000)
+
+    def test_two_workers_same_digest(self):
+        if not support.is_mysql():
+            self.skipTest('more than one worker needs MySQL (set RQ_TEST_RPM_URI)')
+
+        rpm_db.close()
+        # as with the names, the first worker's transaction starts before the second one stores
+        # the analysis, and only stores its own once the second one is done
+        (first, go, first_results) = self.worker('0' * 64, target=_add_digest)
+        (second, done, second_results) = self.worker('0' * 64, target=_add_digest)
+        done.set()
+        second_analysis = second_results.get(timeout=60)
+        second.join(60)
+        go.set()
+        first_analysis = first_results.get(timeout=60)
+        first.join(60)
+
+        self.assertEqual(first.exitcode, 0)
+        self.assertEqual(first_analysis, second_analysis)
+        self.assertEqual(RPM_Analysis.select().count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()